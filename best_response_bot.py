@@ -1,37 +1,40 @@
-import asyncio
 from dataclasses import dataclass, field
-from typing import Annotated, Any
+from typing import Annotated
 from poe_bot_but_better import poe_bot_but_better
+from poe_bot_but_better.admission import AdmissionControl
 from poe_bot_but_better.dependency_injection import Depends
+from poe_bot_but_better.fanout import Fanout, create_fanout
 import json
 
 @dataclass
 class Config:
     decision_bot: str = "Claude-3-Haiku"
     bots: list[str] = field(default_factory=lambda: ["Claude-3-Haiku", "GPT-3.5-Turbo", "Grok-beta", "GPT-4o", "Llama-3.1-405B", "Gemini-1.5-Pro"])
-
-def create_get_final_response_tuple(get_final_response):
-    async def get_final_response_tuple(request, bot_name) -> tuple[str, str]:
-        try:
-            response = await get_final_response(request, bot_name)
-            return bot_name, response
-        except Exception as e:
-            print(f"Error with bot {bot_name}: {e}")
-            return bot_name, ""
-
-    return get_final_response_tuple
-
+    # seconds per bot and for all of them, slow bots are left out of the decision
+    timeout: float = 60
+    deadline: float = 90
 
 @poe_bot_but_better
 class BestResponseBot:
+    # every query calls 7 bots, spikes wait briefly or are turned away instead of timing out upstream
+    admission_control = AdmissionControl(max_in_flight=50, max_in_flight_per_user=2, max_calls_per_bot=25, queue_timeout=5)
+
     async def get_response(
             self, 
             request, 
             get_final_response, 
-            get_final_response_tuple: Annotated[Any, Depends(create_get_final_response_tuple)],
-            config: Config
+            fanout: Annotated[Fanout, Depends(create_fanout)],
+            config: Annotated[Config, Depends(scope="app")]
         ):
-        responses = dict(await asyncio.gather(*(get_final_response_tuple(request, bot_name) for bot_name in config.bots)))
+        results = await fanout.gather_with_deadline(
+            [(request, bot_name) for bot_name in config.bots], timeout=config.timeout, deadline=config.deadline
+        )
+        responses = {}
+        for result in results:
+            if result.ok:
+                responses[result.bot_name] = result.response
+            else:
+                print(f"Error with bot {result.bot_name}: {result.error!r}")
         prompt = "Which response is best? Output only the key from the json. Nothing else is permitted. \n\n"
         best_key = await get_final_response(prompt+json.dumps(responses, indent=4), config.decision_bot)
         print("Best key:", best_key)
@@ -39,9 +42,9 @@ class BestResponseBot:
             return responses[best_key]
         except KeyError:
             print("Key not found, returning first response. Key:", best_key)
-            return responses[config.bots[0]]
+            return next(iter(responses.values()), "")
     
-    def get_settings(self, config: Annotated[Config, Depends()]):
+    def get_settings(self, config: Annotated[Config, Depends(scope="app")]):
         def count_strings(string_list):
             return {item: string_list.count(item) for item in set(string_list)}
         
@@ -2,7 +2,7 @@ import os
 from typing import Optional
 from modal import App, Image, asgi_app, Secret
 from best_response_bot import BestResponseBot
-import fastapi_poe as fp
+from poe_bot_but_better import make_app, startup_report, warmup
 
 REQUIREMENTS = ["fastapi-poe==0.0.48"]
 image = Image.debian_slim().pip_install(*REQUIREMENTS)
@@ -20,5 +20,8 @@ bot_name = ""
 def fastapi_app():
     access_key = os.environ.get("POE_BOT_ACCESS_KEY")
     bot = BestResponseBot(access_key=access_key, bot_name=bot_name)
-    app = fp.make_app(bot, allow_without_key=(not access_key))
+    # plans and settings are ready before the first request, the settings sync of make_app reuses them
+    warmup(bot)
+    app = make_app(bot, allow_without_key=(not access_key))
+    print(startup_report.render())
     return app
\ No newline at end of file
@@ -0,0 +1,23 @@
+import os
+from modal import App, Image, asgi_app, Secret
+from best_response_bot import BestResponseBot
+from echobot import EchoBot
+from poe_bot_but_better import make_host_app
+
+REQUIREMENTS = ["fastapi-poe==0.0.48"]
+image = Image.debian_slim().pip_install(*REQUIREMENTS)
+app = App("poe-bot-host")
+
+# Many bots in one deployment, sharing the connection pool, the caches and the executor.
+# Each bot is served at /<bot_name> of the deployment URL (or at its own `path`), e.g. https://...modal.run/echo-bot
+# (bot class, bot name, name of the environment variable with its access key), set the names of your bots on Poe
+BOTS = [
+    (BestResponseBot, "best-response-bot", "BEST_RESPONSE_BOT_ACCESS_KEY"),
+    (EchoBot, "echo-bot", "ECHO_BOT_ACCESS_KEY"),
+]
+
+@app.function(image=image, secrets=[Secret.from_dict({})])
+@asgi_app()
+def fastapi_app():
+    bots = [bot_class(bot_name=bot_name, access_key=os.environ.get(key_name)) for bot_class, bot_name, key_name in BOTS]
+    return make_host_app(bots, allow_without_key=not all(bot.access_key for bot in bots))
\ No newline at end of file
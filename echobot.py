@@ -11,5 +11,8 @@ from poe_bot_but_better import poe_bot_but_better
 
 @poe_bot_but_better
 class EchoBot:
+    # cheap enough to run on the event loop
+    run_sync_inline = True
+
     def get_response(self, messages: list[fp.ProtocolMessage]):
         return messages[-1].content.upper()
\ No newline at end of file
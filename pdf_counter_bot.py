@@ -1,43 +1,62 @@
-from typing import AsyncIterable
+from typing import Annotated
 
 import fastapi_poe as fp
-import requests
 from PyPDF2 import PdfReader
 
+from poe_bot_but_better import poe_bot_but_better, Depends
+from poe_bot_but_better.attachments import (
+    AttachmentDownloadError,
+    AttachmentFetcher,
+    FetchAttachmentCallable,
+    create_attachment_fetcher,
+    fetch_attachment,
+)
+from poe_bot_but_better.conversation_state import ConversationState, conversation_state
 
-class FileDownloadError(Exception):
-    pass
 
+def _count_num_pages(path: str) -> int:
+    # runs in the process pool of the fetcher
+    return len(PdfReader(path).pages)
 
-def _fetch_pdf_and_count_num_pages(url: str) -> int:
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise FileDownloadError()
-    with open("temp_pdf_file.pdf", "wb") as f:
-        f.write(response.content)
-    reader = PdfReader("temp_pdf_file.pdf")
-    return len(reader.pages)
 
-
-class PDFSizeBot(fp.PoeBot):
+@poe_bot_but_better
+class PDFSizeBot:
     async def get_response(
-        self, request: fp.QueryRequest
-    ) -> AsyncIterable[fp.PartialResponse]:
-        yield fp.PartialResponse(
-            text="Iterating over the pdfs uploaded in this conversation ..."
-        )
-        for message in reversed(request.query):
+        self,
+        request: fp.QueryRequest,
+        state: Annotated[ConversationState, Depends(conversation_state)],
+        fetch: Annotated[FetchAttachmentCallable, Depends(fetch_attachment)],
+        attachment_fetcher: Annotated[AttachmentFetcher, Depends(create_attachment_fetcher, scope="app")],
+    ):
+        yield "Iterating over the pdfs uploaded in this conversation ...\n"
+        new_messages = state.new_messages(request.query)
+        # [name, pages] of the pdfs counted in the previous turns, only new messages are downloaded
+        pdfs = state.data.setdefault("pdfs", [])
+        # a message with a failed download isn't saved, it's tried again next turn along with the messages after it
+        saved = 0
+        unsaved = []
+        for message in new_messages:
+            counted = []
             for attachment in message.attachments:
                 if attachment.content_type == "application/pdf":
                     try:
-                        num_pages = _fetch_pdf_and_count_num_pages(attachment.url)
-                        yield fp.PartialResponse(
-                            text=f"{attachment.name} has {num_pages} pages.\n"
-                        )
-                    except FileDownloadError:
-                        yield fp.PartialResponse(
-                            text="Failed to retrieve the document."
-                        )
-
-    async def get_settings(self, setting: fp.SettingsRequest) -> fp.SettingsResponse:
+                        # cached on disk by content, a pdf shared again in another conversation isn't downloaded twice
+                        pdf = await fetch(attachment)
+                        counted.append([attachment.name, await attachment_fetcher.parse(_count_num_pages, pdf)])
+                    except AttachmentDownloadError:
+                        counted.append([attachment.name, None])
+            if unsaved or any(num_pages is None for _, num_pages in counted):
+                unsaved.extend(counted)
+            else:
+                pdfs.extend(counted)
+                saved += 1
+        state.mark_processed(request.query[:len(request.query) - len(new_messages) + saved])
+
+        for name, num_pages in reversed(pdfs + unsaved):
+            if num_pages is None:
+                yield f"Failed to retrieve {name}.\n"
+            else:
+                yield f"{name} has {num_pages} pages.\n"
+
+    def get_settings(self):
         return fp.SettingsResponse(allow_attachments=True)
\ No newline at end of file
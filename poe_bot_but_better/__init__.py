@@ -1,3 +1,41 @@
-from .decorator import poe_bot_but_better
-from .client import normalize_request, GetFinalResponseCallable, StreamRequestCallable, RequestOrMessage
-from .dependency_injection import solve_dependencies, Depends
\ No newline at end of file
+import importlib
+import sys
+from typing import TYPE_CHECKING
+from .startup import StartupReport, awarmup, startup_report, warmup
+
+# Exports are imported on first use, `import poe_bot_but_better` alone doesn't load fastapi_poe
+_EXPORTS = {
+    "poe_bot_but_better": ".decorator",
+    "normalize_request": ".client",
+    "GetFinalResponseCallable": ".client",
+    "StreamRequestCallable": ".client",
+    "RequestOrMessage": ".client",
+    "solve_dependencies": ".dependency_injection",
+    "Depends": ".dependency_injection",
+    "shutdown_dependencies": ".dependency_injection",
+    "make_app": ".app",
+    "make_host_app": ".app",
+    "MessageSequence": ".messages",
+}
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if __name__ + module_name in sys.modules:
+        module = sys.modules[__name__ + module_name]
+    else:
+        with startup_report.phase(f"import {__name__}{module_name}"):
+            module = importlib.import_module(module_name, __name__)
+    value = globals()[name] = getattr(module, name)
+    return value
+
+def __dir__():
+    return sorted([*globals(), *_EXPORTS])
+
+if TYPE_CHECKING:
+    from .decorator import poe_bot_but_better
+    from .client import normalize_request, GetFinalResponseCallable, StreamRequestCallable, RequestOrMessage
+    from .dependency_injection import solve_dependencies, Depends, shutdown_dependencies
+    from .app import make_app, make_host_app
+    from .messages import MessageSequence
\ No newline at end of file
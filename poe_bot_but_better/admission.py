@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Optional, TypeVar
+import asyncio
+import time
+from . import metrics
+from .types import PoeBotError
+
+T = TypeVar("T")
+
+class AdmissionRejected(PoeBotError):
+    def __init__(self, message: str, reason: str) -> None:
+        super().__init__(message)
+        self.reason = reason
+
+class Limiter:
+    """
+    At most `limit` holders at a time. Up to max_queue callers wait for a slot, at most queue_timeout seconds,
+    anyone beyond that is rejected right away instead of piling up.
+    """
+    def __init__(self, limit: int, max_queue: Optional[int] = None, queue_timeout: Optional[float] = None) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and self.waiting == 0
+
+    async def acquire(self, name: str) -> None:
+        if not self._semaphore.locked():
+            # a free slot, taken without waiting
+            await self._semaphore.acquire()
+            self.in_flight += 1
+            return
+        if self.max_queue is not None and self.waiting >= self.max_queue:
+            raise AdmissionRejected(f"Too many requests waiting for {name}", "queue_full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise AdmissionRejected(f"Waited more than {self.queue_timeout}s for {name}", "queue_timeout") from None
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+class KeyedLimiters:
+    # A Limiter per key (user, target bot), dropped again once idle
+    def __init__(self, limit: int, max_queue: Optional[int], queue_timeout: Optional[float]) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._limiters: Dict[str, Limiter] = {}
+
+    def __len__(self) -> int:
+        return len(self._limiters)
+
+    async def acquire(self, key: str, name: str) -> Limiter:
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = Limiter(self.limit, self.max_queue, self.queue_timeout)
+        try:
+            await limiter.acquire(name)
+        except BaseException:
+            self._forget(key, limiter)
+            raise
+        return limiter
+
+    def release(self, key: str, limiter: Limiter) -> None:
+        limiter.release()
+        self._forget(key, limiter)
+
+    def _forget(self, key: str, limiter: Limiter) -> None:
+        if limiter.idle and self._limiters.get(key) is limiter:
+            del self._limiters[key]
+
+@dataclass
+class AdmissionControl:
+    """
+    Bounds the work of a worker: responses in flight (all users and per user_id) and concurrent calls to every
+    target bot. Requests over a limit wait in a bounded queue up to queue_timeout seconds, requests that
+    can't be admitted are answered with an ErrorResponse right away. None disables a limit.
+    """
+    max_in_flight: Optional[int] = None
+    max_in_flight_per_user: Optional[int] = None
+    # concurrent calls to one target bot (stream_request / get_final_response)
+    max_calls_per_bot: Optional[int] = None
+    max_queue: Optional[int] = 100
+    queue_timeout: Optional[float] = 10.0
+    rejection_message: str = "The bot is busy right now, please try again in a moment."
+
+    def __post_init__(self) -> None:
+        self._global = Limiter(self.max_in_flight, self.max_queue, self.queue_timeout) if self.max_in_flight else None
+        self._users = KeyedLimiters(self.max_in_flight_per_user, self.max_queue, self.queue_timeout) if self.max_in_flight_per_user else None
+        self._bots = KeyedLimiters(self.max_calls_per_bot, self.max_queue, self.queue_timeout) if self.max_calls_per_bot else None
+
+    async def admit(self, user_id: str) -> Callable[[], None]:
+        # Waits for a response slot and returns the function releasing it. The user's own limit comes first,
+        # a user over their limit doesn't hold a global slot while waiting.
+        start = time.perf_counter()
+        user = await self._acquire(self._users, user_id, "this user") if self._users is not None else None
+        try:
+            if self._global is not None:
+                await self._global.acquire("the bot")
+        except AdmissionRejected as e:
+            if user is not None:
+                self._users.release(user_id, user)
+            self._rejected(e, "response")
+            raise
+        except BaseException:
+            if user is not None:
+                self._users.release(user_id, user)
+            raise
+        if metrics.sink:
+            metrics.sink.observe("poe_bot_admission_wait_seconds", time.perf_counter() - start, (("kind", "response"),))
+
+        def release() -> None:
+            if self._global is not None:
+                self._global.release()
+            if user is not None:
+                self._users.release(user_id, user)
+        return release
+
+    async def _acquire(self, limiters: KeyedLimiters, key: str, name: str) -> Limiter:
+        try:
+            return await limiters.acquire(key, name)
+        except AdmissionRejected as e:
+            self._rejected(e, "response" if limiters is self._users else "bot_call")
+            raise
+
+    def _rejected(self, error: AdmissionRejected, kind: str) -> None:
+        if metrics.sink:
+            metrics.sink.increment("poe_bot_admission_rejected_total", 1, (("kind", kind), ("reason", error.reason)))
+
+    async def limit_calls(self, bot_name: str, open_stream: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        # A call to bot_name holding one of its slots until the stream is finished or closed
+        limiter = await self._acquire(self._bots, bot_name, bot_name) if self._bots is not None else None
+        try:
+            stream = open_stream()
+            try:
+                async for item in stream:
+                    yield item
+            finally:
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+        finally:
+            if limiter is not None:
+                self._bots.release(bot_name, limiter)
\ No newline at end of file
@@ -0,0 +1,156 @@
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+import asyncio
+import logging
+import secrets
+import fastapi_poe as fp
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response
+from sse_starlette.sse import EventSourceResponse
+from .client import HttpClientPool, http_client_pool
+from .dependency_injection import shutdown_dependencies
+from .executor import SyncExecutor, sync_executor
+from .metrics import HistogramRegistry
+
+logger = logging.getLogger(__name__)
+
+def add_dependency_teardown(app: FastAPI, pools: Iterable[HttpClientPool] = (), executors: Iterable[SyncExecutor] = ()) -> FastAPI:
+    # Wraps whatever lifespan the app already has, app scoped dependencies, the http pool
+    # and the sync executor are closed on shutdown
+    original_lifespan = app.router.lifespan_context
+    pools = {http_client_pool, *pools}
+    executors = {sync_executor, *executors}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        async with original_lifespan(app) as state:
+            try:
+                yield state
+            finally:
+                await shutdown_dependencies()
+                for pool in pools:
+                    await pool.aclose()
+                for executor in executors:
+                    executor.shutdown(wait=False)
+
+    app.router.lifespan_context = lifespan
+    return app
+
+def make_app(bot: Union[fp.PoeBot, Sequence[fp.PoeBot]], *args, app: Optional[FastAPI] = None, **kwargs) -> FastAPI:
+    # Same as fp.make_app, plus teardown of app and conversation scoped dependencies, the http pool and the executor
+    app = fp.make_app(bot, *args, app=app or FastAPI(), **kwargs)
+    bots = [bot] if isinstance(bot, fp.PoeBot) else bot
+    return add_dependency_teardown(
+        app,
+        [b.http_client_pool for b in bots if getattr(b, 'http_client_pool', None)],
+        [b.sync_executor for b in bots if getattr(b, 'sync_executor', None)],
+    )
+
+def add_metrics_route(app: FastAPI, registry: HistogramRegistry, path: str = "/metrics") -> FastAPI:
+    # Prometheus scrape endpoint, install the registry with metrics.set_sink to fill it
+    @app.get(path, include_in_schema=False)
+    def metrics_route():
+        return PlainTextResponse(registry.render_prometheus(), media_type="text/plain; version=0.0.4")
+    return app
+
+def routing_table(bots: Sequence[fp.PoeBot]) -> Dict[str, fp.PoeBot]:
+    # path -> bot, every bot is served at its own path (if not "/") and at /<bot_name>, as written and lowercase
+    routes: Dict[str, fp.PoeBot] = {}
+    taken: Dict[str, fp.PoeBot] = {}
+    for bot in bots:
+        paths = {bot.path} if bot.path and bot.path != "/" else set()
+        if bot.bot_name:
+            paths.add(bot.bot_name)
+        if not paths:
+            raise ValueError(f"{bot} needs a path or a bot_name to be hosted with other bots")
+        for path in paths:
+            path = "/" + path.strip("/")
+            if taken.setdefault(path.lower(), bot) is not bot:
+                raise ValueError(f"Multiple bots are trying to use the same path: {path}")
+            routes[path] = routes[path.lower()] = bot
+    return routes
+
+def _authorized(bot: fp.PoeBot, request: Request) -> bool:
+    if bot.access_key is None:
+        return True
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and secrets.compare_digest(credentials.encode(), bot.access_key.encode())
+
+async def _handle(bot: fp.PoeBot, request: Request) -> Response:
+    # the same dispatch as a route of fp.make_app
+    body = await request.json()
+    body["http_request"] = request
+    context = fp.types.RequestContext(http_request=request)
+    request_type = body.get("type")
+    if request_type == "query":
+        key = bot.access_key or "<missing>"
+        return EventSourceResponse(bot.handle_query(fp.QueryRequest.model_validate({**body, "access_key": key, "api_key": key}), context))
+    if request_type == "settings":
+        return await bot.handle_settings(fp.SettingsRequest.model_validate(body), context)
+    if request_type == "report_feedback":
+        return await bot.handle_report_feedback(fp.ReportFeedbackRequest.model_validate(body), context)
+    if request_type == "report_error":
+        return await bot.handle_report_error(fp.ReportErrorRequest.model_validate(body), context)
+    raise HTTPException(status_code=501, detail="Unsupported request type")
+
+def _add_bot_routes(app: FastAPI, path: str, bot: fp.PoeBot) -> None:
+    async def index() -> Response:
+        return PlainTextResponse(f"{bot.bot_name or path} is running")
+
+    async def poe_post(request: Request) -> Response:
+        if not _authorized(bot, request):
+            raise HTTPException(status_code=401, detail="Invalid access key", headers={"WWW-Authenticate": "Bearer"})
+        return await _handle(bot, request)
+
+    app.add_api_route(path, index, methods=["GET"], include_in_schema=False)
+    app.add_api_route(path, poe_post, methods=["POST"], include_in_schema=False)
+
+async def _sync_settings(bots: List[fp.PoeBot]) -> None:
+    # all bots at once on startup, instead of one after the other while the app is built (fp.make_app)
+    async def sync(bot: fp.PoeBot) -> None:
+        try:
+            settings = await bot.get_settings(fp.SettingsRequest(version=fp.client.PROTOCOL_VERSION, type="settings"))
+            await asyncio.to_thread(fp.sync_bot_settings, bot.bot_name, bot.access_key, settings=settings.model_dump())
+        except Exception as e:
+            logger.warning(f"Bot settings sync failed for {bot.bot_name}, please sync them manually: {e}")
+    await asyncio.gather(*[sync(bot) for bot in bots if bot.bot_name and bot.access_key])
+
+def make_host_app(
+    bots: Sequence[fp.PoeBot],
+    *,
+    pool: Optional[HttpClientPool] = None,
+    executor: Optional[SyncExecutor] = None,
+    allow_without_key: bool = False,
+    sync_settings: bool = True,
+    app: Optional[FastAPI] = None,
+) -> FastAPI:
+    """
+    Many bots in one app and one process. Each bot gets its own routes at its path (or /<bot_name>), other
+    routes of the app (e.g. add_metrics_route) work as usual. All bots use the same http pool and sync executor (the process-wide ones if None),
+    app scoped dependencies, response and upload caches are process-wide already.
+    """
+    routes = routing_table(bots)
+    pool = pool or http_client_pool
+    executor = executor or sync_executor
+    hosted = list({id(bot): bot for bot in routes.values()}.values())
+    for bot in hosted:
+        if bot.access_key is None and not allow_without_key:
+            raise ValueError(f"Missing access key on {bot}")
+        bot.http_client_pool = pool
+        bot.sync_executor = executor
+
+    app = app or FastAPI()
+    for path, bot in routes.items():
+        _add_bot_routes(app, path, bot)
+
+    if sync_settings:
+        original_lifespan = app.router.lifespan_context
+
+        @asynccontextmanager
+        async def lifespan(app):
+            async with original_lifespan(app) as state:
+                await _sync_settings(hosted)
+                yield state
+
+        app.router.lifespan_context = lifespan
+    return add_dependency_teardown(app, [pool], [executor])
\ No newline at end of file
@@ -0,0 +1,249 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar, Union
+import asyncio
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import fastapi_poe as fp
+from .client import HttpClientPool, http_client_pool
+from .dependency_injection import Depends
+from .executor import inline
+from .singleflight import SingleFlight
+from .types import PoeBotError
+
+T = TypeVar("T")
+
+class AttachmentDownloadError(PoeBotError):
+    pass
+
+class AttachmentTooLargeError(AttachmentDownloadError):
+    pass
+
+# cache of create_attachment_fetcher, shared by the workers of a user on a machine (the temp directory of Windows is per user)
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"poe-bot-attachments-{os.getuid()}" if hasattr(os, "getuid") else "poe-bot-attachments")
+
+@dataclass(frozen=True)
+class FetchedAttachment:
+    url: str
+    name: str
+    content_type: str
+    # Read only. A file in the temp directory of the request, removed when the request ends.
+    path: str
+    size: int
+    sha256: str
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    @contextmanager
+    def buffer(self) -> Iterator[memoryview]:
+        # memory-mapped, pages are read from disk as they are accessed
+        if self.size == 0:
+            yield memoryview(b"")
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+FetchAttachmentCallable = Callable[[Union[fp.Attachment, str]], Awaitable[FetchedAttachment]]
+
+class AttachmentFetcher:
+    """
+    Streams attachments to disk without blocking the event loop, at most max_bytes each.
+    With a cache_dir, files are stored by their sha256 and found again by URL + ETag (a conditional
+    request, unchanged files aren't downloaded again), concurrent fetches of a URL share one download.
+    CPU heavy parsing (PDFs, images, ...) runs in a process pool with `parse`.
+    """
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_cache_bytes: int = 1024 * 1024 * 1024,
+        chunk_size: int = 64 * 1024,
+        pool: Optional[HttpClientPool] = None,
+        parse_executor: Optional[Executor] = None,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.chunk_size = chunk_size
+        self.pool = pool or http_client_pool
+        self.max_workers = max_workers
+        self._parse_executor = parse_executor
+        self._owns_executor = parse_executor is None
+        self._downloads = SingleFlight()
+        if cache_dir:
+            # only readable by the user, the temp directory is shared with other users
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            for directory in ("objects", "urls", "tmp"):
+                os.makedirs(os.path.join(cache_dir, directory), exist_ok=True)
+
+    def make_temp_dir(self) -> str:
+        # a directory for the files of one request, in the cache so cached files can be hard linked into it
+        return tempfile.mkdtemp(prefix="poe-attachments-", dir=os.path.join(self.cache_dir, "tmp") if self.cache_dir else None)
+
+    async def fetch(self, attachment: Union[fp.Attachment, str], temp_dir: str) -> FetchedAttachment:
+        # temp_dir (see make_temp_dir) holds the files of the caller, it removes them once it's done.
+        # Cached files are linked into it, pruning the cache doesn't take away a file a request still reads.
+        if isinstance(attachment, str):
+            url, name, content_type = attachment, os.path.basename(attachment.split("?")[0]), ""
+        else:
+            url, name, content_type = attachment.url, attachment.name, attachment.content_type
+        if self.cache_dir:
+            for attempt in range(2):
+                object_path, size, sha256 = await self._downloads.call(url, lambda: self._fetch_cached(url))
+                path = os.path.join(temp_dir, sha256)
+                try:
+                    if not os.path.exists(path):
+                        await asyncio.to_thread(_link_or_copy, object_path, path)
+                    break
+                except FileNotFoundError:
+                    # pruned by another fetch in the meantime, downloaded again
+                    if attempt:
+                        raise
+        else:
+            path, size, sha256 = await self._download(url, temp_dir)
+        return FetchedAttachment(url=url, name=name, content_type=content_type, path=path, size=size, sha256=sha256)
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, "objects", sha256)
+
+    def _index_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, "urls", hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def _read_index(self, url: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._index_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if os.path.exists(self._object_path(entry["sha256"])) else None
+
+    async def _fetch_cached(self, url: str) -> Tuple[str, int, str]:
+        entry = self._read_index(url)
+        headers = {"If-None-Match": entry["etag"]} if entry and entry.get("etag") else {}
+        path, size, sha256, etag = await self._stream(url, os.path.join(self.cache_dir, "tmp"), headers)
+        if path is None:
+            # 304, the cached file is current
+            return self._object_path(entry["sha256"]), entry["size"], entry["sha256"]
+
+        object_path = self._object_path(sha256)
+        os.chmod(path, 0o444)
+        # atomic, readers never see a partial file
+        os.replace(path, object_path)
+        index_path = self._index_path(url)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"url": url, "etag": etag, "sha256": sha256, "size": size}, f)
+        os.replace(index_path + ".tmp", index_path)
+        await asyncio.to_thread(self.prune, object_path)
+        return object_path, size, sha256
+
+    async def _download(self, url: str, directory: str) -> Tuple[str, int, str]:
+        path, size, sha256, _ = await self._stream(url, directory, {})
+        return path, size, sha256
+
+    async def _stream(self, url: str, directory: str, headers: Dict[str, str]) -> Tuple[Optional[str], int, str, Optional[str]]:
+        # (path of the new file, size, sha256, etag), path is None when the server answered 304
+        client = self.pool.get()
+        async with client.stream("GET", url, headers=headers, follow_redirects=True) as response:
+            if response.status_code == 304 and headers:
+                return None, 0, "", None
+            if response.status_code != 200:
+                raise AttachmentDownloadError(f"Failed to download {url}: HTTP {response.status_code}")
+            content_length = response.headers.get("Content-Length")
+            if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                raise AttachmentTooLargeError(f"{url} is {content_length} bytes, the limit is {self.max_bytes}")
+
+            # unique per download, concurrent requests never share a file being written
+            fd, path = tempfile.mkstemp(dir=directory, suffix=".part")
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise AttachmentTooLargeError(f"{url} is larger than the limit of {self.max_bytes} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                os.unlink(path)
+                raise
+            return path, size, digest.hexdigest(), response.headers.get("ETag")
+
+    def prune(self, keep: Optional[str] = None) -> None:
+        # drops the least recently stored files while the cache is over max_cache_bytes, except `keep`.
+        # Requests read their own links of the files, the data stays until they are done.
+        objects_dir = os.path.join(self.cache_dir, "objects")
+        files = []
+        for entry in os.scandir(objects_dir):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            if path == keep:
+                continue
+            os.unlink(path)
+            total -= size
+
+    def get_parse_executor(self) -> Executor:
+        if self._parse_executor is None:
+            # spawn, forking a process running an event loop and threads isn't safe
+            self._parse_executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._parse_executor
+
+    async def parse(self, fn: Callable[..., T], attachment: FetchedAttachment, *args: Any) -> T:
+        # fn(path, *args) in the process pool, fn must be a module level function (it's pickled)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_parse_executor(), fn, attachment.path, *args)
+
+    def close(self) -> None:
+        if self._owns_executor and self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=False, cancel_futures=True)
+            self._parse_executor = None
+
+def _link_or_copy(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        pass
+    except FileNotFoundError:
+        raise
+    except OSError:
+        # e.g. a file system without hard links
+        shutil.copyfile(source, destination)
+
+@inline
+def create_attachment_fetcher() -> AttachmentFetcher:
+    return AttachmentFetcher(cache_dir=DEFAULT_CACHE_DIR)
+
+async def fetch_attachment(
+    attachment_fetcher: Annotated[AttachmentFetcher, Depends(create_attachment_fetcher, scope="app")],
+) -> AsyncIterator[FetchAttachmentCallable]:
+    # Files of the request go to a temp directory of their own, removed once the response is complete
+    temp_dir: Optional[str] = None
+
+    async def fetch(attachment: Union[fp.Attachment, str]) -> FetchedAttachment:
+        nonlocal temp_dir
+        if temp_dir is None:
+            temp_dir = attachment_fetcher.make_temp_dir()
+        return await attachment_fetcher.fetch(attachment, temp_dir)
+
+    try:
+        yield fetch
+    finally:
+        if temp_dir is not None:
+            await asyncio.to_thread(shutil.rmtree, temp_dir, True)
\ No newline at end of file
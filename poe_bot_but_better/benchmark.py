@@ -0,0 +1,300 @@
+"""
+
+Benchmarks of the request hot path: dependency injection, the four get_response kinds,
+request/response normalization and end to end SSE through make_app.
+
+    python -m poe_bot_but_better.benchmark
+    python -m poe_bot_but_better.benchmark --json before.json
+    python -m poe_bot_but_better.benchmark --compare before.json   # exits with 1 on a regression
+
+Latency is per operation. Allocations are the peak traced memory of one operation (tracemalloc)
+and the memory blocks still allocated after it (should be 0, anything else is a leak).
+
+"""
+
+from dataclasses import asdict, dataclass
+from typing import Annotated, Any, Awaitable, Callable, Dict, List, Optional
+import argparse
+import asyncio
+import gc
+import inspect
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import fastapi_poe as fp
+import httpx
+from poe_bot_but_better.app import make_app
+from poe_bot_but_better.client import normalize_request
+from poe_bot_but_better.decorator import poe_bot_but_better
+from poe_bot_but_better.dependency_injection import Depends, solve_dependencies
+from poe_bot_but_better.streaming import normalize_response
+from poe_bot_but_better.stub_server import StubPoeServer
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    iterations: int
+    mean_us: float
+    median_us: float
+    p95_us: float
+    peak_kib: float
+    leaked_blocks: float
+
+@dataclass
+class Benchmark:
+    name: str
+    # an operation, awaited once per iteration
+    run: Callable[[], Awaitable[Any]]
+    # slow benchmarks (e.g. end to end) do fewer iterations
+    weight: int = 1
+
+async def measure(benchmark: Benchmark, iterations: int, warmup: int = 10) -> BenchmarkResult:
+    iterations = max(iterations // benchmark.weight, 1)
+    run = benchmark.run
+    for _ in range(warmup):
+        await run()
+
+    timings: List[float] = []
+    perf_counter = time.perf_counter
+    for _ in range(iterations):
+        start = perf_counter()
+        await run()
+        timings.append((perf_counter() - start) * 1_000_000)
+
+    # leaked blocks, measured without tracemalloc, it allocates itself
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in range(iterations):
+        await run()
+    gc.collect()
+    leaked_blocks = max(sys.getallocatedblocks() - blocks, 0) / iterations
+
+    tracemalloc.start()
+    peaks: List[int] = []
+    for _ in range(min(iterations, 100)):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await run()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    timings.sort()
+    return BenchmarkResult(
+        name=benchmark.name,
+        iterations=iterations,
+        mean_us=statistics.fmean(timings),
+        median_us=statistics.median(timings),
+        p95_us=timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0],
+        peak_kib=statistics.median(peaks) / 1024,
+        leaked_blocks=leaked_blocks,
+    )
+
+# Dependency graphs
+
+def chain(depth: int) -> Callable:
+    # target -> dependency -> ... depth levels deep
+    async def leaf():
+        return 0
+
+    dependency = leaf
+    for _ in range(depth - 1):
+        def level(value: Annotated[int, Depends(dependency)]):
+            return value + 1
+        dependency = level
+
+    async def target(value: Annotated[int, Depends(dependency)]):
+        return value
+    return target
+
+def fan_out(width: int) -> Callable:
+    # target with `width` independent dependencies
+    def make_leaf(i):
+        async def leaf():
+            return i
+        return leaf
+
+    params = [
+        inspect.Parameter(f"p{i}", inspect.Parameter.KEYWORD_ONLY, annotation=Annotated[int, Depends(make_leaf(i))])
+        for i in range(width)
+    ]
+
+    async def target(**kwargs):
+        return kwargs
+    target.__signature__ = inspect.Signature(params)
+    target.__annotations__ = {param.name: param.annotation for param in params}
+    return target
+
+def dependency_benchmarks() -> List[Benchmark]:
+    benchmarks = []
+    for depth in (1, 4, 16):
+        target = chain(depth)
+        benchmarks.append(Benchmark(f"solve_dependencies depth={depth}", lambda target=target: solve_dependencies(target, {"request": None})))
+    for width in (8, 32):
+        target = fan_out(width)
+        benchmarks.append(Benchmark(f"solve_dependencies width={width}", lambda target=target: solve_dependencies(target, {"request": None})))
+    return benchmarks
+
+# Handler kinds
+
+query_request = fp.QueryRequest(
+    query=[fp.ProtocolMessage(role="user", content="Hello")],
+    version="1.0",
+    type="query",
+    user_id="benchmark_user",
+    conversation_id="benchmark_conversation",
+    message_id="benchmark_message",
+)
+
+def handler_bots() -> Dict[str, fp.PoeBot]:
+    @poe_bot_but_better
+    class AsyncGenBot:
+        async def get_response(self, messages):
+            for _ in range(10):
+                yield messages[-1].content
+
+    @poe_bot_but_better
+    class CoroutineBot:
+        async def get_response(self, messages):
+            return messages[-1].content
+
+    @poe_bot_but_better
+    class SyncGenBot:
+        def get_response(self, messages):
+            for _ in range(10):
+                yield messages[-1].content
+
+    @poe_bot_but_better
+    class SyncBot:
+        def get_response(self, messages):
+            return messages[-1].content
+
+    @poe_bot_but_better
+    class InlineSyncGenBot(SyncGenBot):
+        run_sync_inline = True
+
+    @poe_bot_but_better
+    class InlineSyncBot(SyncBot):
+        run_sync_inline = True
+
+    return {
+        "async generator": AsyncGenBot(),
+        "coroutine": CoroutineBot(),
+        "sync generator": SyncGenBot(),
+        "sync": SyncBot(),
+        "sync generator (inline)": InlineSyncGenBot(),
+        "sync (inline)": InlineSyncBot(),
+    }
+
+def handler_benchmarks() -> List[Benchmark]:
+    def consume(bot):
+        async def run():
+            async for _ in bot.get_response(query_request):
+                pass
+        return run
+
+    return [Benchmark(f"get_response {kind}", consume(bot)) for kind, bot in handler_bots().items()]
+
+# Normalization
+
+def normalization_benchmarks() -> List[Benchmark]:
+    message = fp.ProtocolMessage(role="user", content="Hello")
+    history = [fp.ProtocolMessage(role="user" if i % 2 else "bot", content=f"Message {i}") for i in range(20)]
+    partial = fp.PartialResponse(text="Hello")
+
+    def sync(fn):
+        async def run():
+            fn()
+        return run
+
+    return [
+        Benchmark("normalize_request str", sync(lambda: normalize_request(query_request, "Hello"))),
+        Benchmark("normalize_request message", sync(lambda: normalize_request(query_request, message))),
+        Benchmark("normalize_request 20 messages", sync(lambda: normalize_request(query_request, history))),
+        Benchmark("normalize_request request", sync(lambda: normalize_request(query_request, query_request))),
+        Benchmark("normalize_response str", sync(lambda: normalize_response("Hello"))),
+        Benchmark("normalize_response partial", sync(lambda: normalize_response(partial))),
+    ]
+
+# End to end
+
+def sse_benchmarks(chunks: int = 100) -> List[Benchmark]:
+    # client -> make_app(relay bot) -> stream_request -> stub Poe server, all in-process
+    stub = StubPoeServer({"Upstream": ["tok "] * chunks})
+
+    @poe_bot_but_better
+    class RelayBot:
+        http_client_pool = stub.pool()
+
+        async def get_response(self, request, stream_request):
+            async for message in stream_request(request, "Upstream"):
+                yield message.text
+
+    app = make_app(RelayBot(path="/bot/Relay"), allow_without_key=True)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), timeout=60)
+
+    async def run():
+        text = await fp.get_final_response(
+            query_request, "Relay", api_key="benchmark", session=client, base_url="http://benchmark/bot/", num_tries=1
+        )
+        assert len(text) == 4 * chunks
+
+    return [Benchmark(f"sse end to end ({chunks} chunks)", run, weight=20)]
+
+def all_benchmarks() -> List[Benchmark]:
+    return dependency_benchmarks() + handler_benchmarks() + normalization_benchmarks() + sse_benchmarks()
+
+async def run_benchmarks(iterations: int = 1000, name_filter: Optional[str] = None) -> List[BenchmarkResult]:
+    results = []
+    for benchmark in all_benchmarks():
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        results.append(await measure(benchmark, iterations, warmup=min(10, iterations)))
+    return results
+
+def format_results(results: List[BenchmarkResult], baseline: Optional[Dict[str, BenchmarkResult]] = None) -> str:
+    lines = [f"{'benchmark':<40} {'median us':>10} {'p95 us':>10} {'peak KiB':>9} {'leaked':>7}" + ("  vs baseline" if baseline else "")]
+    for result in results:
+        line = f"{result.name:<40} {result.median_us:>10.1f} {result.p95_us:>10.1f} {result.peak_kib:>9.1f} {result.leaked_blocks:>7.1f}"
+        if baseline and result.name in baseline:
+            line += f"  {result.median_us / baseline[result.name].median_us:>6.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+def regressions(results: List[BenchmarkResult], baseline: Dict[str, BenchmarkResult], threshold: float) -> List[str]:
+    return [
+        result.name for result in results
+        if result.name in baseline and result.median_us > baseline[result.name].median_us * threshold
+    ]
+
+def load_results(path: str) -> Dict[str, BenchmarkResult]:
+    with open(path) as f:
+        return {result["name"]: BenchmarkResult(**result) for result in json.load(f)}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the poe_bot_but_better hot path")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--filter", help="only benchmarks containing this text")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="results saved with --json to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown of the median counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run_benchmarks(args.iterations, args.filter))
+    baseline = load_results(args.compare) if args.compare else None
+    print(format_results(results, baseline))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if baseline:
+        regressed = regressions(results, baseline, args.threshold)
+        if regressed:
+            print(f"\nRegressed more than {args.threshold}x: {', '.join(regressed)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,214 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import fastapi_poe as fp
+from .singleflight import SingleFlight
+
+# (text, is_replace_response, is_suggested_reply)
+CachedChunk = Tuple[str, bool, bool]
+
+# rough per chunk overhead of python objects, counted towards max_bytes
+CHUNK_OVERHEAD = 64
+
+def request_cache_key(request: fp.QueryRequest, bot_name: str) -> str:
+    # Only what changes the response, ids and keys of the original request are left out
+    payload = [
+        bot_name,
+        [(m.role, m.content, m.content_type, [a.url for a in m.attachments]) for m in request.query],
+        request.temperature,
+        request.skip_system_prompt,
+        request.logit_bias,
+        request.stop_sequences,
+    ]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def chunks_size(chunks: List[CachedChunk]) -> int:
+    return sum(len(text) + CHUNK_OVERHEAD for text, _, _ in chunks)
+
+def final_response_from_chunks(chunks: List[CachedChunk]) -> str:
+    # same as fp.get_final_response
+    parts: List[str] = []
+    for text, is_replace_response, is_suggested_reply in chunks:
+        if is_suggested_reply:
+            continue
+        if is_replace_response:
+            parts.clear()
+        parts.append(text)
+    return "".join(parts)
+
+def chunk_from_message(message: fp.PartialResponse) -> CachedChunk:
+    return (message.text, message.is_replace_response, message.is_suggested_reply)
+
+def message_from_chunk(chunk: CachedChunk) -> fp.PartialResponse:
+    text, is_replace_response, is_suggested_reply = chunk
+    return fp.PartialResponse(text=text, is_replace_response=is_replace_response, is_suggested_reply=is_suggested_reply)
+
+class CacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[List[CachedChunk]]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, chunks: List[CachedChunk]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+class MemoryCacheBackend(CacheBackend):
+    """LRU with optional TTL, bounded by number of entries and approximate memory."""
+    def __init__(self, max_entries: int = 1000, max_bytes: Optional[int] = 64 * 1024 * 1024, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (expires_at, size, chunks)
+        self._entries: "OrderedDict[str, Tuple[Optional[float], int, List[CachedChunk]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    async def get(self, key: str) -> Optional[List[CachedChunk]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, chunks = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return chunks
+
+    async def set(self, key: str, chunks: List[CachedChunk]) -> None:
+        size = chunks_size(chunks)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._pop(key)
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (expires_at, size, chunks)
+        self.size += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self._pop(next(iter(self._entries)))
+
+    async def delete(self, key: str) -> None:
+        if key in self._entries:
+            self._pop(key)
+
+    async def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+class SqliteCacheBackend(CacheBackend):
+    """On-disk LRU with optional TTL, survives restarts and can be shared by workers on one machine."""
+    def __init__(self, path: str, max_entries: int = 100_000, max_bytes: Optional[int] = 1024 * 1024 * 1024, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _execute(self, *args):
+        with self._lock:
+            return self._connection.execute(*args).fetchall()
+
+    def _get(self, key: str) -> Optional[List[CachedChunk]]:
+        now = time.time()
+        rows = self._execute("SELECT chunks, expires_at FROM responses WHERE key = ?", (key,))
+        if not rows:
+            return None
+        chunks, expires_at = rows[0]
+        if expires_at is not None and expires_at <= now:
+            self._execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        self._execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return [tuple(chunk) for chunk in json.loads(chunks)]
+
+    def _set(self, key: str, chunks: List[CachedChunk]) -> None:
+        size = chunks_size(chunks)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        self._execute(
+            "INSERT OR REPLACE INTO responses (key, chunks, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(chunks), size, expires_at, now),
+        )
+        self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        count, total = self._execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses")[0]
+        while count > self.max_entries or (self.max_bytes is not None and total > self.max_bytes):
+            rows = self._execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1")
+            if not rows:
+                break
+            key, size = rows[0]
+            self._execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+
+    async def get(self, key: str) -> Optional[List[CachedChunk]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, chunks: List[CachedChunk]) -> None:
+        await asyncio.to_thread(self._set, key, chunks)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM responses WHERE key = ?", (key,))
+
+    async def clear(self) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+class ResponseCache:
+    """
+    Responses of sub-bot calls stored as the streamed chunks, so hits can be replayed as a stream.
+    Concurrent misses of the same key share one upstream call (`in_flight`).
+    """
+    def __init__(self, backend: Optional[CacheBackend] = None) -> None:
+        self.backend = backend or MemoryCacheBackend()
+        self.in_flight = SingleFlight()
+
+    @staticmethod
+    def key(request: fp.QueryRequest, bot_name: str) -> str:
+        return request_cache_key(request, bot_name)
+
+    async def get(self, key: str) -> Optional[List[CachedChunk]]:
+        return await self.backend.get(key)
+
+    async def set(self, key: str, chunks: List[CachedChunk]) -> None:
+        await self.backend.set(key, chunks)
+
+    async def clear(self) -> None:
+        await self.backend.clear()
+
+    def close(self) -> None:
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            close()
\ No newline at end of file
@@ -1,13 +1,28 @@
-from typing import Any, AsyncGenerator, Awaitable, BinaryIO, Callable, Coroutine, List, Optional, Union
+from typing import Annotated, Any, AsyncGenerator, Awaitable, Callable, Coroutine, Dict, List, Optional, Set, Union
+from dataclasses import dataclass
+import asyncio
+import importlib.util
+import weakref
 import fastapi_poe as fp
+import httpx
 from poe_bot_but_better.types import PoeBotError
+from poe_bot_but_better.cache import CachedChunk, MemoryCacheBackend, ResponseCache, chunk_from_message, final_response_from_chunks, message_from_chunk, request_cache_key
+from poe_bot_but_better.dependency_injection import Depends
+from poe_bot_but_better.executor import inline
+from poe_bot_but_better.singleflight import SingleFlight
+from poe_bot_but_better import metrics
+from poe_bot_but_better.messages import MessageSequence
+from poe_bot_but_better.retry import RetryPolicy, default_retry_policy
+from poe_bot_but_better.uploads import FileData, UploadCache, upload_attachment, upload_cache
+from poe_bot_but_better.admission import AdmissionControl
+from poe_bot_but_better.ratelimit import RequestRateLimiter
 
 def disabled_fn(fn_name, reason = ""):
     def fn(*args, **kwargs):
         raise PoeBotError(f"{fn_name} {reason}")
     return fn
 
-RequestOrMessage = Union[str, fp.QueryRequest, fp.ProtocolMessage, List[fp.ProtocolMessage]]
+RequestOrMessage = Union[str, fp.QueryRequest, fp.ProtocolMessage, List[fp.ProtocolMessage], MessageSequence]
 StreamRequestCallable = Callable[
     [RequestOrMessage, str],
     AsyncGenerator[fp.PartialResponse, None]
@@ -20,7 +35,8 @@ GetFinalResponseCallable = Callable[
 
 def normalize_request(original_request: fp.QueryRequest, request_or_message: RequestOrMessage):
     def create_query_request(query):
-        return fp.QueryRequest(
+        # the messages are validated already, construct skips validating (and copying) them again
+        return fp.QueryRequest.model_construct(
             query=query,
             version=original_request.version,
             type=original_request.type,
@@ -39,6 +55,9 @@ def normalize_request(original_request: fp.QueryRequest, request_or_message: Req
             return create_query_request(request_or_message)
         raise PoeBotError("List must contain only ProtocolMessages")
     
+    elif isinstance(request_or_message, MessageSequence):
+        return create_query_request(request_or_message.to_list())
+
     elif isinstance(request_or_message, fp.QueryRequest):
         return request_or_message
     
@@ -47,35 +66,214 @@ def normalize_request(original_request: fp.QueryRequest, request_or_message: Req
     
     raise PoeBotError(f"Request must be a string, list of strings, QueryRequest, or list of ProtocolMessages. Got: {request_or_message}")
 
+@dataclass
+class HttpClientConfig:
+    base_url: str = "https://api.poe.com/bot/"
+    timeout: float = 600  # same as fastapi_poe
+    max_connections: Optional[int] = 100
+    max_keepalive_connections: Optional[int] = 20
+    keepalive_expiry: Optional[float] = 60
+    max_connections_per_host: Optional[int] = None  # concurrent requests per host, None for no cap
+    http2: bool = True  # only if the optional `h2` package is installed
+    transport: Optional[httpx.AsyncBaseTransport] = None  # e.g. httpx.ASGITransport of a local stand-in server
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]) -> None:
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            release, self._release = self._release, None
+            if release:
+                release()
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    # Caps concurrent requests per host, a slot is held until the response body is closed (streams included)
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_connections_per_host: int) -> None:
+        self._transport = transport
+        self._max_connections_per_host = max_connections_per_host
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self._max_connections_per_host)
+        await semaphore.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, semaphore.release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+def _raise_for_bot_status(base_url: str) -> Callable[[httpx.Response], Awaitable[None]]:
+    # An error page of a bot call would only fail as "not an event stream" (httpx_sse.SSEError),
+    # its status decides whether the call is retried
+    async def hook(response: httpx.Response) -> None:
+        if response.status_code >= 400 and str(response.request.url).startswith(base_url):
+            await response.aread()
+            raise httpx.HTTPStatusError(
+                f"{response.status_code} {response.reason_phrase} from {response.request.url}: {response.text[:500]}",
+                request=response.request,
+                response=response,
+            )
+    return hook
+
+def create_http_client(config: HttpClientConfig) -> httpx.AsyncClient:
+    transport = config.transport or httpx.AsyncHTTPTransport(
+        http2=config.http2 and importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive_connections,
+            keepalive_expiry=config.keepalive_expiry,
+        ),
+    )
+    if config.max_connections_per_host:
+        transport = HostLimitedTransport(transport, config.max_connections_per_host)
+    return httpx.AsyncClient(
+        timeout=config.timeout, transport=transport, event_hooks={"response": [_raise_for_bot_status(config.base_url)]}
+    )
+
+class HttpClientPool:
+    """
+    Keep-alive httpx client shared by all bot-to-bot calls, instead of a new connection per call.
+    Connections belong to an event loop, so there's one client per running loop.
+    """
+    def __init__(self, config: Optional[HttpClientConfig] = None) -> None:
+        self.config = config or HttpClientConfig()
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._closing: "Set[asyncio.Task[None]]" = set()
+
+    def get(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._clients[loop] = create_http_client(self.config)
+        return client
+
+    def configure(self, config: HttpClientConfig) -> None:
+        # applies to clients created from now on, the current ones are closed on their loops
+        self.config = config
+        clients, self._clients = self._clients, weakref.WeakKeyDictionary()
+        for loop, client in list(clients.items()):
+            if not loop.is_closed() and not client.is_closed:
+                loop.call_soon_threadsafe(self._close_later, client)
+
+    def _close_later(self, client: httpx.AsyncClient) -> None:
+        # on the loop of the client, the task is referenced until it's done
+        task = asyncio.ensure_future(client.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def aclose(self) -> None:
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        self._clients = weakref.WeakKeyDictionary()
+        if client is not None:
+            await client.aclose()
+
+# Process-wide pool, closed on app shutdown (see poe_bot_but_better.app.make_app)
+http_client_pool = HttpClientPool()
+
 def on_error(e, msg):
     print(msg)
     raise e
 
-def create_get_final_response(request: fp.QueryRequest) -> GetFinalResponseCallable:
+def open_bot_stream(request: fp.QueryRequest, bot_name: str, api_key: str, pool: HttpClientPool) -> AsyncGenerator[fp.PartialResponse, None]:
+    # One attempt of a bot call, retries are up to the RetryPolicy
+    messages = fp.stream_request(
+        request=request,
+        bot_name=bot_name,
+        api_key=api_key,
+        session=pool.get(),
+        base_url=pool.config.base_url,
+        # If it would up to me I would change these defaults
+        on_error=on_error, # the errors being swallowed is a confusing
+        num_tries=1, # spent a lot of time debugging why my code was executed twice, only to find out it was because of the retries
+    )
+    if not metrics.sink:
+        return messages
+    return _timed_stream(messages, bot_name)
+
+async def _timed_stream(messages: AsyncGenerator[fp.PartialResponse, None], bot_name: str) -> AsyncGenerator[fp.PartialResponse, None]:
+    timer = metrics.SubBotTimer(metrics.sink, bot_name)
+    error = None
+    try:
+        async for message in messages:
+            timer.chunk()
+            yield message
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        timer.finish(error)
+        await messages.aclose()
+
+def create_get_final_response(
+    request: fp.QueryRequest,
+    pool: Optional[HttpClientPool] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    admission: Optional[AdmissionControl] = None,
+    rate_limiter: Optional[RequestRateLimiter] = None,
+) -> GetFinalResponseCallable:
     api_key: str = request.access_key
+    pool = pool or http_client_pool
+    policy = retry_policy or default_retry_policy
     async def get_final_response(
         request_or_message: RequestOrMessage,
         bot_name: str,
     ) -> str:
         # Apply any request modifications
         modified_request = normalize_request(request, request_or_message)
-        
-        # Call original function with pre-configured access key
-        return await fp.get_final_response(
-            request=modified_request,
-            bot_name=bot_name,
-            api_key=api_key,
-            
-            # If it would up to me I would change these defaults
-            on_error=on_error, # the errors being swallowed is a confusing
-            num_tries=1, # spent a lot of time debugging why my code was executed twice, only to find out it was because of the retries
-        )
-    
+
+        # paced before a slot of the target bot is taken, nothing is held while waiting
+        if rate_limiter:
+            await rate_limiter.acquire(bot_name)
+
+        # assembled like fp.get_final_response does, a retry that starts over drops what the failed attempt sent
+        chunks: List[CachedChunk] = []
+        def retried():
+            return policy.stream(bot_name, lambda: open_bot_stream(modified_request, bot_name, api_key, pool), on_restart=chunks.clear)
+        # the slot of the target bot is held for the whole call, retries included
+        messages = admission.limit_calls(bot_name, retried) if admission else retried()
+        try:
+            async for message in messages:
+                if not isinstance(message, fp.MetaResponse):
+                    chunks.append(chunk_from_message(message))
+        finally:
+            await messages.aclose()
+        if not chunks:
+            raise fp.client.BotError(f"Bot {bot_name} sent no response")
+        return final_response_from_chunks(chunks)
+
     return get_final_response
 
 
-def create_stream_request(request: fp.QueryRequest) -> StreamRequestCallable:
+def create_stream_request(
+    request: fp.QueryRequest,
+    pool: Optional[HttpClientPool] = None,
+    retry_policy: Optional[RetryPolicy] = None,
+    admission: Optional[AdmissionControl] = None,
+    rate_limiter: Optional[RequestRateLimiter] = None,
+) -> StreamRequestCallable:
     api_key: str = request.access_key
+    pool = pool or http_client_pool
+    policy = retry_policy or default_retry_policy
     
     async def stream_request(
         request_or_message: RequestOrMessage,
@@ -83,30 +281,162 @@ def create_stream_request(request: fp.QueryRequest) -> StreamRequestCallable:
     ) -> AsyncGenerator[fp.PartialResponse, None]:
         # Apply any request modifications
         modified_request = normalize_request(request, request_or_message)
-        
-        # Call original function with pre-configured access key
-        async for message in fp.stream_request(
-            request=modified_request,
-            bot_name=bot_name,
-            api_key=api_key,
-            # If it would up to me I would change these defaults
-            on_error=on_error, # the errors being swallowed is a confusing
-            num_tries=1, # spent a lot of time debugging why my code was executed twice, only to find out it was because of the retries
-        ):
-            yield message
+
+        if rate_limiter:
+            await rate_limiter.acquire(bot_name)
+
+        # retried only until the first message
+        def retried():
+            return policy.stream(bot_name, lambda: open_bot_stream(modified_request, bot_name, api_key, pool))
+        messages = admission.limit_calls(bot_name, retried) if admission else retried()
+        try:
+            async for message in messages:
+                yield message
+        finally:
+            await messages.aclose()
             
     return stream_request
 
-def create_post_message_attachment(bot: fp.PoeBot, request: fp.QueryRequest) -> Callable[..., Awaitable[fp.types.AttachmentUploadResponse]]:
+def create_post_message_attachment(
+    bot: fp.PoeBot,
+    request: fp.QueryRequest,
+    pool: Optional[HttpClientPool] = None,
+    cache: Optional[UploadCache] = upload_cache,
+) -> Callable[..., Awaitable[fp.types.AttachmentUploadResponse]]:
     message_id: str = request.message_id
+    pool = pool or http_client_pool
     
     async def post_message_attachment(
         download_url: Optional[str] = None,
-        file_data: Optional[Union[bytes, BinaryIO]] = None,
+        file_data: Optional[FileData] = None,
         filename: Optional[str] = None,
         content_type: Optional[str] = None,
         is_inline: bool = False,
+        after: Optional[Awaitable[Any]] = None,
     ) -> fp.types.AttachmentUploadResponse:
-        return await bot.post_message_attachment(download_url=download_url, file_data=file_data, filename=filename, content_type=content_type, is_inline=is_inline, message_id=message_id)
+        # file_data can also be a path, a memoryview or an async iterator of bytes, it's streamed in chunks.
+        # With `after`, the attachment is posted once it is done (see upload_attachment)
+        if not bot.access_key:
+            raise PoeBotError("post_message_attachment requires the bot to have an access_key")
+        task = asyncio.ensure_future(upload_attachment(
+            pool.get(),
+            access_key=bot.access_key,
+            message_id=message_id,
+            download_url=download_url,
+            file_data=file_data,
+            filename=filename,
+            content_type=content_type,
+            is_inline=is_inline,
+            cache=cache,
+            after=after,
+        ))
+        # fastapi_poe waits for the pending uploads of the message before finishing the response
+        pending = bot._pending_file_attachment_tasks.setdefault(message_id, set())
+        pending.add(task)
+        try:
+            return await task
+        finally:
+            pending.discard(task)
     
-    return post_message_attachment
\ No newline at end of file
+    return post_message_attachment
+
+@inline
+def create_response_cache() -> ResponseCache:
+    return ResponseCache(MemoryCacheBackend())
+
+@inline
+def create_cached_get_final_response(
+    request: fp.QueryRequest,
+    get_final_response: GetFinalResponseCallable,
+    response_cache: Annotated[ResponseCache, Depends(create_response_cache, scope="app")],
+) -> GetFinalResponseCallable:
+    async def get_final_response_cached(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> str:
+        key = response_cache.key(normalize_request(request, request_or_message), bot_name)
+        chunks = await response_cache.get(key)
+        if chunks is not None:
+            return final_response_from_chunks(chunks)
+
+        async def fetch() -> str:
+            response = await get_final_response(request_or_message, bot_name)
+            await response_cache.set(key, [(response, False, False)])
+            return response
+
+        return await response_cache.in_flight.call(key, fetch)
+
+    return get_final_response_cached
+
+@inline
+def create_cached_stream_request(
+    request: fp.QueryRequest,
+    stream_request: StreamRequestCallable,
+    response_cache: Annotated[ResponseCache, Depends(create_response_cache, scope="app")],
+) -> StreamRequestCallable:
+    async def stream_request_cached(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> AsyncGenerator[fp.PartialResponse, None]:
+        key = response_cache.key(normalize_request(request, request_or_message), bot_name)
+        chunks = await response_cache.get(key)
+        if chunks is not None:
+            for chunk in chunks:
+                yield message_from_chunk(chunk)
+            return
+
+        # stored only once the stream completes, errors and early exits aren't cached
+        async def fetch() -> AsyncGenerator[fp.PartialResponse, None]:
+            recorded: List[CachedChunk] = []
+            async for message in stream_request(request_or_message, bot_name):
+                if not isinstance(message, fp.MetaResponse):
+                    recorded.append(chunk_from_message(message))
+                yield message
+            await response_cache.set(key, recorded)
+
+        # closed explicitly so leaving early unsubscribes right away, not when garbage collected
+        stream = response_cache.in_flight.stream(key, fetch)
+        try:
+            async for message in stream:
+                yield message
+        finally:
+            await stream.aclose()
+
+    return stream_request_cached
+
+@inline
+def create_coalesced_get_final_response(
+    request: fp.QueryRequest,
+    get_final_response: GetFinalResponseCallable,
+    single_flight: Annotated[SingleFlight, Depends(SingleFlight, scope="app")],
+) -> GetFinalResponseCallable:
+    # Identical concurrent calls (same normalized request and bot) share one upstream call
+    async def get_final_response_coalesced(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> str:
+        key = request_cache_key(normalize_request(request, request_or_message), bot_name)
+        return await single_flight.call(key, lambda: get_final_response(request_or_message, bot_name))
+
+    return get_final_response_coalesced
+
+@inline
+def create_coalesced_stream_request(
+    request: fp.QueryRequest,
+    stream_request: StreamRequestCallable,
+    single_flight: Annotated[SingleFlight, Depends(SingleFlight, scope="app")],
+) -> StreamRequestCallable:
+    # Identical concurrent streams share one upstream stream, every caller gets all the chunks
+    async def stream_request_coalesced(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> AsyncGenerator[fp.PartialResponse, None]:
+        key = request_cache_key(normalize_request(request, request_or_message), bot_name)
+        stream = single_flight.stream(key, lambda: stream_request(request_or_message, bot_name))
+        try:
+            async for message in stream:
+                yield message
+        finally:
+            await stream.aclose()
+
+    return stream_request_coalesced
\ No newline at end of file
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Annotated, AsyncGenerator, Callable, Dict, Iterable, Optional, Tuple
+import hashlib
+import fastapi_poe as fp
+from .client import GetFinalResponseCallable, RequestOrMessage, StreamRequestCallable, normalize_request
+from .dependency_injection import Depends
+from .executor import inline
+from .messages import MessageSequence
+
+# role, separators etc. of one message
+MESSAGE_OVERHEAD = 4
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English, non-ASCII text (e.g. CJK) is closer to one token per 3 bytes
+    if not text:
+        return 0
+    if text.isascii():
+        return (len(text) + 3) // 4
+    return (len(text.encode()) + 2) // 3
+
+@dataclass
+class ContextWindow:
+    """
+    Fits the messages forwarded to another bot into a token budget of that bot.
+    System messages are always kept, the oldest turns are dropped first and the last message is always sent.
+    Token counts of messages are memoized, turns of a conversation repeat the same history every time.
+    """
+    # tokens per target bot, bots not listed get default_budget (None for no limit)
+    budgets: Dict[str, int] = field(default_factory=dict)
+    default_budget: Optional[int] = 8000
+    # e.g. a real tokenizer, estimate_tokens is a heuristic
+    count_tokens: Callable[[str], int] = estimate_tokens
+    max_cached_counts: int = 100_000
+
+    def __post_init__(self) -> None:
+        self._counts: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+
+    def budget(self, bot_name: str) -> Optional[int]:
+        return self.budgets.get(bot_name, self.default_budget)
+
+    def message_tokens(self, message: fp.ProtocolMessage) -> int:
+        # a lookup is much cheaper than tokenizing. Keyed by a digest, the memo doesn't keep the messages alive
+        content = message.content
+        key = (hashlib.blake2b(content.encode(), digest_size=16).digest(), message.role)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        else:
+            count = MESSAGE_OVERHEAD + self.count_tokens(content)
+            self._counts[key] = count
+            if len(self._counts) > self.max_cached_counts:
+                self._counts.popitem(last=False)
+        # parsed attachments are sent along with the message
+        for attachment in message.attachments:
+            if attachment.parsed_content:
+                count += self.count_tokens(attachment.parsed_content)
+        return count
+
+    def tokens(self, messages: Iterable[fp.ProtocolMessage]) -> int:
+        return sum(self.message_tokens(message) for message in messages)
+
+    def fit(self, messages: Iterable[fp.ProtocolMessage], bot_name: str) -> MessageSequence:
+        view = MessageSequence(messages)
+        budget = self.budget(bot_name)
+        if budget is None or not view:
+            return view
+        counts = [self.message_tokens(message) for message in view]
+        if sum(counts) <= budget:
+            return view
+
+        used = sum(count for message, count in zip(view, counts) if message.role == "system")
+        # newest first, the turns kept are contiguous
+        cut = len(view) - 1
+        used += counts[cut]
+        while cut > 0:
+            message, count = view[cut - 1], counts[cut - 1]
+            if message.role != "system":
+                if used + count > budget:
+                    break
+                used += count
+            cut -= 1
+
+        kept_system = [view[i:i + 1] for i in range(cut) if view[i].role == "system"]
+        result = view[cut:]
+        for system in reversed(kept_system):
+            result = system + result
+        return result
+
+    def fit_request(self, request: fp.QueryRequest, bot_name: str) -> fp.QueryRequest:
+        fitted = self.fit(request.query, bot_name)
+        if len(fitted) == len(request.query):
+            return request
+        return request.model_copy(update={"query": fitted.to_list()})
+
+@inline
+def create_windowed_get_final_response(
+    request: fp.QueryRequest,
+    get_final_response: GetFinalResponseCallable,
+    context_window: Annotated[ContextWindow, Depends(scope="app")],
+) -> GetFinalResponseCallable:
+    async def get_final_response_windowed(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> str:
+        fitted = context_window.fit_request(normalize_request(request, request_or_message), bot_name)
+        return await get_final_response(fitted, bot_name)
+
+    return get_final_response_windowed
+
+@inline
+def create_windowed_stream_request(
+    request: fp.QueryRequest,
+    stream_request: StreamRequestCallable,
+    context_window: Annotated[ContextWindow, Depends(scope="app")],
+) -> StreamRequestCallable:
+    async def stream_request_windowed(
+        request_or_message: RequestOrMessage,
+        bot_name: str,
+    ) -> AsyncGenerator[fp.PartialResponse, None]:
+        fitted = context_window.fit_request(normalize_request(request, request_or_message), bot_name)
+        async for message in stream_request(fitted, bot_name):
+            yield message
+
+    return stream_request_windowed
\ No newline at end of file
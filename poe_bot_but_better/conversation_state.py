@@ -0,0 +1,209 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Annotated, Any, AsyncIterator, Dict, Optional, Sequence, Tuple
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import weakref
+import fastapi_poe as fp
+from .dependency_injection import Depends
+from .executor import inline
+from .messages import MessageSequence
+
+def message_key(message: fp.ProtocolMessage) -> str:
+    if message.message_id:
+        return message.message_id
+    return hashlib.sha256(f"{message.role}\0{message.content}".encode()).hexdigest()
+
+@dataclass
+class ConversationState:
+    """
+    State a bot derives from a conversation (parsed attachments, summaries, ...), kept between turns
+    so only the messages added since the last turn have to be processed.
+    """
+    conversation_id: str
+    data: Dict[str, Any] = field(default_factory=dict)
+    # messages already processed and the key of the last one, to notice a changed history
+    processed: int = 0
+    last_message_key: Optional[str] = None
+
+    def new_messages(self, messages: Sequence[fp.ProtocolMessage]) -> MessageSequence:
+        # Messages since the last turn. If the history doesn't continue the processed one
+        # (e.g. a message was regenerated or deleted), the state is reset and everything is new.
+        if self.processed and (
+            len(messages) < self.processed or message_key(messages[self.processed - 1]) != self.last_message_key
+        ):
+            self.reset()
+        return MessageSequence(messages)[self.processed:]
+
+    def mark_processed(self, messages: Sequence[fp.ProtocolMessage]) -> None:
+        self.processed = len(messages)
+        self.last_message_key = message_key(messages[-1]) if messages else None
+
+    def reset(self) -> None:
+        self.data.clear()
+        self.processed = 0
+        self.last_message_key = None
+
+class ConversationStore(ABC):
+    def __init__(self) -> None:
+        # one request per conversation works with the state at a time
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    @abstractmethod
+    async def load(self, conversation_id: str) -> Optional[ConversationState]:
+        ...
+
+    @abstractmethod
+    async def save(self, state: ConversationState) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, conversation_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+    async def discard(self, state: ConversationState) -> None:
+        # A turn working with the state failed. Stores handing out the stored object itself
+        # drop it, it may be half updated.
+        pass
+
+    @asynccontextmanager
+    async def session(self, conversation_id: str) -> AsyncIterator[ConversationState]:
+        # Loads the state and saves it when the block succeeds, a failed turn leaves the stored state untouched
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = self._locks[conversation_id] = asyncio.Lock()
+        async with lock:
+            state = await self.load(conversation_id) or ConversationState(conversation_id)
+            try:
+                yield state
+            except BaseException:
+                await self.discard(state)
+                raise
+            await self.save(state)
+
+class MemoryConversationStore(ConversationStore):
+    """LRU of conversations with optional TTL, the state data can hold any objects."""
+    def __init__(self, max_conversations: int = 10_000, ttl: Optional[float] = None) -> None:
+        super().__init__()
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        # conversation_id -> (expires_at, state)
+        self._states: "OrderedDict[str, Tuple[Optional[float], ConversationState]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    async def load(self, conversation_id: str) -> Optional[ConversationState]:
+        entry = self._states.get(conversation_id)
+        if entry is None:
+            return None
+        expires_at, state = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._states[conversation_id]
+            return None
+        self._states.move_to_end(conversation_id)
+        return state
+
+    async def save(self, state: ConversationState) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._states[state.conversation_id] = (expires_at, state)
+        self._states.move_to_end(state.conversation_id)
+        while len(self._states) > self.max_conversations:
+            self._states.popitem(last=False)
+
+    async def delete(self, conversation_id: str) -> None:
+        self._states.pop(conversation_id, None)
+
+    async def clear(self) -> None:
+        self._states.clear()
+
+    async def discard(self, state: ConversationState) -> None:
+        await self.delete(state.conversation_id)
+
+class SqliteConversationStore(ConversationStore):
+    """On-disk conversation states, survives restarts. The state data has to be JSON serializable."""
+    def __init__(self, path: str, max_conversations: int = 1_000_000, ttl: Optional[float] = None) -> None:
+        super().__init__()
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "conversation_id TEXT PRIMARY KEY, data TEXT NOT NULL, processed INTEGER NOT NULL, "
+            "last_message_key TEXT, updated_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+
+    def _execute(self, *args):
+        with self._lock:
+            return self._connection.execute(*args).fetchall()
+
+    def _load(self, conversation_id: str) -> Optional[ConversationState]:
+        rows = self._execute(
+            "SELECT data, processed, last_message_key, updated_at FROM conversations WHERE conversation_id = ?",
+            (conversation_id,),
+        )
+        if not rows:
+            return None
+        data, processed, last_message_key, updated_at = rows[0]
+        if self.ttl is not None and updated_at + self.ttl <= time.time():
+            self._execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+            return None
+        return ConversationState(conversation_id, json.loads(data), processed, last_message_key)
+
+    def _save(self, state: ConversationState) -> None:
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO conversations (conversation_id, data, processed, last_message_key, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (state.conversation_id, json.dumps(state.data), state.processed, state.last_message_key, now),
+        )
+        if self.ttl is not None:
+            self._execute("DELETE FROM conversations WHERE updated_at <= ?", (now - self.ttl,))
+        count = self._execute("SELECT COUNT(*) FROM conversations")[0][0]
+        if count > self.max_conversations:
+            self._execute(
+                "DELETE FROM conversations WHERE conversation_id IN "
+                "(SELECT conversation_id FROM conversations ORDER BY updated_at LIMIT ?)",
+                (count - self.max_conversations,),
+            )
+
+    async def load(self, conversation_id: str) -> Optional[ConversationState]:
+        return await asyncio.to_thread(self._load, conversation_id)
+
+    async def save(self, state: ConversationState) -> None:
+        await asyncio.to_thread(self._save, state)
+
+    async def delete(self, conversation_id: str) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+
+    async def clear(self) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM conversations")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+@inline
+def create_conversation_store() -> ConversationStore:
+    return MemoryConversationStore()
+
+async def conversation_state(
+    request: fp.QueryRequest,
+    conversation_store: Annotated[ConversationStore, Depends(create_conversation_store, scope="app")],
+) -> AsyncIterator[ConversationState]:
+    # State of the conversation of this request, saved once the response is complete
+    async with conversation_store.session(request.conversation_id) as state:
+        yield state
\ No newline at end of file
@@ -1,24 +1,47 @@
+import time
 import sse_starlette
-from typing import AsyncIterable, Union, Dict, Any
+from starlette.responses import JSONResponse, Response
+from typing import AsyncIterable, Optional, Union, Dict
 from inspect import iscoroutinefunction, isgeneratorfunction, isasyncgenfunction
-from poe_bot_but_better.client import create_get_final_response, create_stream_request, create_post_message_attachment, disabled_fn
-from .dependency_injection import solve_dependencies
+from poe_bot_but_better.client import create_get_final_response, create_stream_request, create_post_message_attachment, disabled_fn, http_client_pool
+from .dependency_injection import DependencyCycleError, LazyContext, ResolutionPlan, compile_plan, request_scope
+from .executor import sync_executor
+from .startup import startup_report
+from . import metrics
+from .metrics import ResponseTimer
+from .admission import AdmissionRejected
+from .ratelimit import RateLimited
+from .uploads import AttachmentQueue
+from .streaming import iterate_sync, normalize_response, normalize_responses
 import fastapi_poe as fp
 from poe_bot_but_better.types import PoeBotError
 
-def normalize_response(response: Union[str, fp.PartialResponse, sse_starlette.sse.ServerSentEvent]) -> Union[fp.PartialResponse, sse_starlette.sse.ServerSentEvent]:
-    if isinstance(response, fp.PartialResponse):
-        return response
-    elif response is None:
-        return fp.PartialResponse(text="")
-    elif isinstance(response, str):
-        return fp.PartialResponse(text=response)
-    elif isinstance(response, sse_starlette.sse.ServerSentEvent):
-        return response
-    else:
-        raise PoeBotError("Response must be a string or PartialResponse. Got: {}".format(response))
+# Context entries built only when a handler or one of its dependencies asks for them,
+# called with (bot, request, pool, rate_limiter)
+RESPONSE_CONTEXT = {
+    "get_final_response": lambda bot, request, pool, rate_limiter: create_get_final_response(request, pool, bot.retry_policy, bot.admission_control, rate_limiter),
+    "stream_request": lambda bot, request, pool, rate_limiter: create_stream_request(request, pool, bot.retry_policy, bot.admission_control, rate_limiter),
+    "post_message_attachment": lambda bot, request, pool, rate_limiter: create_post_message_attachment(bot, request, pool),
+    "attachment_queue": lambda bot, request, pool, rate_limiter: AttachmentQueue(create_post_message_attachment(bot, request, pool), bot.max_concurrent_attachments),
+}
+
+def disabled_context(reason: str):
+    return {name: (lambda bot, request, pool, rate_limiter, name=name: disabled_fn(name, reason)) for name in RESPONSE_CONTEXT}
+
+SYNC_RESPONSE_CONTEXT = disabled_context("is disabled in sync get_response. Use async get_response instead.")
+SETTINGS_CONTEXT = disabled_context("is disabled in get_settings")
+
+def precompile_plan(func) -> Optional[ResolutionPlan]:
+    try:
+        return compile_plan(func)
+    except DependencyCycleError:
+        raise
+    except Exception:
+        # e.g. forward references that can't be resolved yet, retried on the first request
+        return None
 
 def poe_bot_but_better(cls):
+    started, class_name = time.perf_counter(), cls.__name__
     if not hasattr(cls, 'get_response'):
         raise PoeBotError(f"Class {cls.__name__} must implement get_response method")
         
@@ -29,90 +52,230 @@ def poe_bot_but_better(cls):
     
     original_get_response = getattr(cls, 'get_response')
     original_get_settings = getattr(cls, 'get_settings', None)
+
+    # Reflection is done once here, requests only execute the compiled plans
+    get_response_plan = precompile_plan(original_get_response)
+    get_settings_plan = precompile_plan(original_get_settings) if original_get_settings else None
     
     # Add class attribute for context override
     cls.dependency_injection_context_override = None
+    # Pool for bot-to-bot calls, None for the process-wide one
+    if not hasattr(cls, 'http_client_pool'):
+        cls.http_client_pool = None
+    # Retries and circuit breakers of bot-to-bot calls, None for the default RetryPolicy
+    if not hasattr(cls, 'retry_policy'):
+        cls.retry_policy = None
+    # Limits of responses in flight and calls to other bots, None admits everything
+    if not hasattr(cls, 'admission_control'):
+        cls.admission_control = None
+    # Pacing of calls to other bots, checked against the server_bot_dependencies of get_settings, None for no limits
+    if not hasattr(cls, 'rate_limits'):
+        cls.rate_limits = None
+    # Merging of small streamed text chunks (a StreamCoalescing), None sends every chunk as it was yielded
+    if not hasattr(cls, 'stream_coalescing'):
+        cls.stream_coalescing = None
+    # Sync get_response/get_settings and offloaded sync dependencies run in a thread pool (the process-wide one if None),
+    # run_sync_inline keeps them on the event loop, for handlers that are trivially cheap
+    if not hasattr(cls, 'sync_executor'):
+        cls.sync_executor = None
+    if not hasattr(cls, 'run_sync_inline'):
+        cls.run_sync_inline = False
+    # Sync dependency providers run on the event loop unless marked with @offload,
+    # True runs all of them (but @inline ones) in the executor
+    if not hasattr(cls, 'offload_sync_dependencies'):
+        cls.offload_sync_dependencies = False
+    # The settings are computed once per bot instance and served from the cache, see invalidate_settings
+    if not hasattr(cls, 'cache_settings'):
+        cls.cache_settings = True
+    # Uploads of attachment_queue running at the same time
+    if not hasattr(cls, 'max_concurrent_attachments'):
+        cls.max_concurrent_attachments = 4
+
+    is_sync_response = not (isasyncgenfunction(original_get_response) or iscoroutinefunction(original_get_response))
+
+    def get_executor(self):
+        return None if self.run_sync_inline else self.sync_executor or sync_executor
     
+    async def declared_dependencies(self, request: fp.QueryRequest) -> Dict[str, int]:
+        # server_bot_dependencies of get_settings, asked once per bot instance
+        declared = self.__dict__.get("_declared_dependencies")
+        if declared is None:
+            settings = await self.get_settings(fp.SettingsRequest(version=request.version, type="settings"))
+            declared = self._declared_dependencies = dict(settings.server_bot_dependencies)
+        return declared
+
     async def get_response_impl(self, request: fp.QueryRequest) -> AsyncIterable[Union[fp.PartialResponse, sse_starlette.sse.ServerSentEvent]]:
-        context = {
+        pool = self.http_client_pool or http_client_pool
+        rate_limits = self.rate_limits
+        rate_limiter = None
+        if rate_limits and not is_sync_response:
+            declared = await declared_dependencies(self, request) if rate_limits.enforce_declared != "off" else None
+            rate_limiter = rate_limits.for_request(declared)
+        context = LazyContext(SYNC_RESPONSE_CONTEXT if is_sync_response else RESPONSE_CONTEXT, (self, request, pool, rate_limiter), {
             "request": request,
             "messages": request.query,
             "bot_name": self.bot_name,
-
-            "get_final_response": create_get_final_response(request),
-            "stream_request": create_stream_request(request),
-            "post_message_attachment": create_post_message_attachment(self, request),
-        }
+            "http_client_pool": pool,
+        })
         
         if self.dependency_injection_context_override:
             context.update(self.dependency_injection_context_override)
+            if is_sync_response:
+                # bot-to-bot calls stay disabled in sync get_response even when overridden
+                for name in SYNC_RESPONSE_CONTEXT:
+                    context.pop(name, None)
         
-        # Call the original method
-        if isasyncgenfunction(original_get_response):
-            dependencies = await solve_dependencies(original_get_response, context)
-            async for item in original_get_response(self, **dependencies):
-                yield normalize_response(item)
-        elif iscoroutinefunction(original_get_response):
-            dependencies = await solve_dependencies(original_get_response, context)
-            result = await original_get_response(self, **dependencies)
-            yield normalize_response(result)
-        elif isgeneratorfunction(original_get_response):
-            context.update({
-                "get_final_response": disabled_fn("get_final_response", "is disabled in sync get_response. Use async get_response instead."),
-                "stream_request": disabled_fn("stream_request", "is disabled in sync get_response. Use async get_response instead."),
-                "post_message_attachment": disabled_fn("post_message_attachment", "is disabled in sync get_response. Use async get_response instead."),
-            })
-            dependencies = await solve_dependencies(original_get_response, context)
-            for item in original_get_response(self, **dependencies):
-                yield normalize_response(item)
-        else:
-            context.update({
-                "get_final_response": disabled_fn("get_final_response", "is disabled in sync get_response. Use async get_response instead."),
-                "stream_request": disabled_fn("stream_request", "is disabled in sync get_response. Use async get_response instead."),
-                "post_message_attachment": disabled_fn("post_message_attachment", "is disabled in sync get_response. Use async get_response instead."),
-            })
-            dependencies = await solve_dependencies(original_get_response, context)
-            result = original_get_response(self, **dependencies)
-            yield normalize_response(result)        
+        executor = get_executor(self)
+        admission = self.admission_control
+        release = None
+        if admission:
+            try:
+                release = await admission.admit(request.user_id)
+            except AdmissionRejected:
+                yield fp.ErrorResponse(text=admission.rejection_message, allow_retry=True)
+                return
+
+        # Timing hooks, only when a metrics sink is installed
+        timer = metrics.sink and ResponseTimer(metrics.sink, self.bot_name)
+        error = None
+        try:
+            # Generator dependencies are finished once the response is fully streamed (or the stream is closed)
+            async with request_scope() as stack:
+                dependencies = await (get_response_plan or compile_plan(original_get_response)).solve(context, stack=stack, executor=executor, offload_sync=self.offload_sync_dependencies)
+                if timer:
+                    timer.dependencies_resolved()
+
+                # Call the original method
+                items = None
+                if isasyncgenfunction(original_get_response):
+                    items = original_get_response(self, **dependencies)
+                elif iscoroutinefunction(original_get_response):
+                    response = normalize_response(await original_get_response(self, **dependencies))
+                elif isgeneratorfunction(original_get_response):
+                    items = original_get_response(self, **dependencies)
+                    items = executor.iterate(items) if executor else iterate_sync(items)
+                elif executor:
+                    response = normalize_response(await executor.run(original_get_response, self, **dependencies))
+                else:
+                    response = normalize_response(original_get_response(self, **dependencies))
+
+                if items is None:
+                    if timer:
+                        timer.chunk(response)
+                    yield response
+                else:
+                    responses = normalize_responses(items, self.stream_coalescing)
+                    try:
+                        async for response in responses:
+                            if timer:
+                                timer.chunk(response)
+                            yield response
+                    finally:
+                        await responses.aclose()
+
+                # Attachments queued by the handler are finished before the response
+                queue = dict.get(context, "attachment_queue")
+                if isinstance(queue, AttachmentQueue):
+                    for name, failure in await queue.join():
+                        yield fp.ErrorResponse(text=f"Failed to attach {name}: {failure}")
+        except AdmissionRejected as e:
+            # a call to another bot couldn't get a slot
+            error = e
+            yield fp.ErrorResponse(text=admission.rejection_message if admission else str(e), allow_retry=True)
+        except RateLimited as e:
+            error = e
+            yield fp.ErrorResponse(text=rate_limits.rejection_message, allow_retry=True)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if release:
+                release()
+            queue = dict.get(context, "attachment_queue")
+            if isinstance(queue, AttachmentQueue):
+                await queue.aclose()
+            if timer:
+                timer.finish(error)
 
     async def get_settings_impl(self, request: fp.SettingsRequest) -> fp.SettingsResponse:
+        # the same for every settings request, whatever its version
+        cached = self.__dict__.get("_settings") if self.cache_settings else None
+        if cached is not None:
+            return cached
+        result = await compute_settings(self, request)
+        if self.cache_settings:
+            self._settings = result
+        return result
+
+    async def compute_settings(self, request: fp.SettingsRequest) -> fp.SettingsResponse:
         result = fp.SettingsResponse()
         
         if not original_get_settings:
             return result 
             
-        context = {
+        # hand holding, bot-to-bot calls are disabled
+        context = LazyContext(SETTINGS_CONTEXT, (self, request, None, None), {
             "request": request,
             "setting": request,
             "bot_name": self.bot_name,
-
-            # hand holding
-            "get_final_response": disabled_fn("get_final_response", "is disabled in get_settings"),
-            "stream_request": disabled_fn("stream_request", "is disabled in get_settings"),
-            "post_message_attachment": disabled_fn("post_message_attachment", "is disabled in get_settings"),
-        }
+        })
         
         if self.dependency_injection_context_override:
             context.update(self.dependency_injection_context_override)
         
-        dependencies = await solve_dependencies(original_get_settings, context)
-        
-        if iscoroutinefunction(original_get_settings):
-            result = await original_get_settings(self, **dependencies)
-        else:
-            result = original_get_settings(self, **dependencies)
+        executor = get_executor(self)
+        async with request_scope() as stack:
+            dependencies = await (get_settings_plan or compile_plan(original_get_settings)).solve(context, stack=stack, executor=executor, offload_sync=self.offload_sync_dependencies)
+
+            if iscoroutinefunction(original_get_settings):
+                result = await original_get_settings(self, **dependencies)
+            elif executor:
+                result = await executor.run(original_get_settings, self, **dependencies)
+            else:
+                result = original_get_settings(self, **dependencies)
 
         if isinstance(result, dict):
             result = fp.SettingsResponse(**result)
 
         return result
 
+    async def handle_settings_impl(self, settings_request: fp.SettingsRequest, context: fp.types.RequestContext) -> Response:
+        if not self.cache_settings:
+            return await fp.PoeBot.handle_settings(self, settings_request, context)
+        # the serialized body is reused, later settings requests only send bytes
+        body = self.__dict__.get("_settings_body")
+        if body is None:
+            settings = await self.get_settings_with_context(settings_request, context)
+            body = self._settings_body = JSONResponse(settings.model_dump()).body
+        return Response(body, media_type="application/json")
+
+    async def warmup(self) -> None:
+        # what the first requests would do, done up front, see poe_bot_but_better.warmup
+        nonlocal get_response_plan, get_settings_plan
+        with startup_report.phase(f"warmup {class_name} plans"):
+            get_response_plan = get_response_plan or compile_plan(original_get_response)
+            if original_get_settings:
+                get_settings_plan = get_settings_plan or compile_plan(original_get_settings)
+        if self.cache_settings:
+            with startup_report.phase(f"warmup {class_name} settings"):
+                settings = await self.get_settings(fp.SettingsRequest(version=fp.client.PROTOCOL_VERSION, type="settings"))
+                self._settings_body = JSONResponse(settings.model_dump()).body
+
+    def invalidate_settings(self) -> None:
+        # for bots whose settings change at runtime, the next settings request computes them again
+        for name in ("_settings", "_settings_body", "_declared_dependencies"):
+            self.__dict__.pop(name, None)
+
     cls.get_response = get_response_impl
     if original_get_settings:
         cls.get_settings = get_settings_impl
+    cls.handle_settings = handle_settings_impl
+    cls.invalidate_settings = invalidate_settings
+    cls.warmup = warmup
 
     # Todo: 
     #  - add `on_feedback`
     #  - merge the get_response_with_context and add to dependency injection context
     
+    startup_report.record(f"decorate {class_name}", time.perf_counter() - started)
     return cls
\ No newline at end of file
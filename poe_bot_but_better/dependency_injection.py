@@ -1,119 +1,504 @@
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
 from dataclasses import is_dataclass
-from typing import Any, Callable, Dict, Optional, Type, get_type_hints, Annotated
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple, get_type_hints, Annotated
 import inspect
 from typing import get_args, get_origin
 import asyncio
-from functools import partial
+import logging
+import sys
+import weakref
+from .executor import SyncExecutor, is_inline, is_offloaded
+
+logger = logging.getLogger(__name__)
+
+# request - created for every request (cached within the request if use_cache)
+# app, singleton - created once per process
+# conversation - created once per conversation_id
+SCOPES = ("request", "app", "singleton", "conversation")
 
 class Depends:
     def __init__(
-        self, 
+        self,
         dependency: Optional[Callable] = None,
-        use_cache: bool = True
+        use_cache: bool = True,
+        scope: str = "request",
     ) -> None:
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown dependency scope {scope}. Use one of {', '.join(SCOPES)}")
+        if scope != "request" and not use_cache:
+            raise ValueError(f"use_cache=False can't be combined with scope {scope}")
         self.dependency = dependency or (lambda: None)
         self.use_cache = use_cache
+        self.scope = "app" if scope == "singleton" else scope
         self.is_default = dependency is None
 
-async def solve_dependencies(
-    func: Callable,
-    context: Optional[Dict[str, Any]] = None
-) -> Dict[str, Any]:
-    context = context or {}
-    params = {}
-    
+async def _teardown(instance: Any) -> None:
+    try:
+        aclose = getattr(instance, "aclose", None)
+        if aclose is not None:
+            await aclose()
+            return
+        close = getattr(instance, "close", None)
+        if close is not None:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+    except Exception:
+        logger.exception("Error tearing down dependency %r", instance)
+
+async def _close_stack(stack: AsyncExitStack) -> None:
+    try:
+        await stack.aclose()
+    except Exception:
+        logger.exception("Error tearing down dependencies")
+
+class _Scope:
+    __slots__ = ("instances", "stack", "loop")
+
+    def __init__(self) -> None:
+        self.instances: Dict[Hashable, Any] = {}
+        self.stack = AsyncExitStack()
+        # loop the instances were created on
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def stale(self) -> bool:
+        # e.g. created on the temporary loop of asyncio.run in fp.make_app's settings sync, clients
+        # bound to that loop can't be used on the serving loop
+        return self.loop is not None and self.loop.is_closed()
+
+class DependencyStore:
+    """
+    Holds the instances of app and conversation scoped dependencies.
+    Instances are created lazily on first use, concurrent first uses share one creation.
+    On `aclose()` of the store, generator dependencies are finished and instances with
+    `aclose()` or `close()` are closed. Conversation instances also when the conversation is evicted.
+    """
+    def __init__(self, max_conversations: int = 1000) -> None:
+        self.max_conversations = max_conversations
+        self._app = _Scope()
+        self._conversations: "OrderedDict[str, _Scope]" = OrderedDict()
+        self._pending: Dict[Tuple[Hashable, Optional[str]], asyncio.Future] = {}
+        self._teardown_tasks: Set[asyncio.Task] = set()
+
+    def _scope(self, conversation_id: Optional[str]) -> _Scope:
+        if conversation_id is None:
+            if self._app.stale:
+                self._schedule_teardown(self._app)
+                self._app = _Scope()
+            return self._app
+        scope = self._conversations.get(conversation_id)
+        if scope is not None and scope.stale:
+            self._schedule_teardown(self._conversations.pop(conversation_id))
+            scope = None
+        if scope is None:
+            scope = self._conversations[conversation_id] = _Scope()
+            while len(self._conversations) > self.max_conversations:
+                _, evicted = self._conversations.popitem(last=False)
+                self._schedule_teardown(evicted)
+        else:
+            self._conversations.move_to_end(conversation_id)
+        return scope
+
+    def _schedule_teardown(self, scope: _Scope) -> None:
+        if not scope.instances:
+            return
+        task = asyncio.ensure_future(_close_stack(scope.stack))
+        self._teardown_tasks.add(task)
+        task.add_done_callback(self._teardown_tasks.discard)
+
+    async def get_or_create(
+        self,
+        dependency: Hashable,
+        create: Callable[[AsyncExitStack], Awaitable[Any]],
+        conversation_id: Optional[str] = None,
+    ) -> Any:
+        key = (dependency, conversation_id)
+        while True:
+            scope = self._scope(conversation_id)
+            if dependency in scope.instances:
+                return scope.instances[dependency]
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            await asyncio.wait((pending,))
+            # if the creator got cancelled, try again ourselves
+            if not pending.cancelled() and pending.exception() is not None:
+                raise pending.exception()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            # teardown is registered on the stack of the scope the instance lives in
+            value = await create(scope.stack)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, the creator re-raises it
+            raise
+        finally:
+            del self._pending[key]
+
+        scope.instances[dependency] = value
+        if scope.loop is None:
+            scope.loop = asyncio.get_running_loop()
+        future.set_result(value)
+        return value
+
+    async def aclose(self) -> None:
+        scopes = [self._app, *self._conversations.values()]
+        self._app = _Scope()
+        self._conversations.clear()
+        # in reverse order of creation, dependents first
+        for scope in reversed(scopes):
+            await _close_stack(scope.stack)
+        if self._teardown_tasks:
+            await asyncio.gather(*self._teardown_tasks)
+
+# Process-wide store, closed on app shutdown (see poe_bot_but_better.app.make_app)
+dependency_store = DependencyStore()
+
+async def shutdown_dependencies() -> None:
+    await dependency_store.aclose()
+
+class LazyContext(dict):
+    """
+    Context whose entries from `factories` are built on first lookup, called with `args`.
+    Entries no dependency asks for are never built.
+    """
+    __slots__ = ("factories", "args")
+
+    def __init__(self, factories: Dict[str, Callable[..., Any]], args: Tuple[Any, ...] = (), values: Optional[Dict[str, Any]] = None) -> None:
+        super().__init__(values or ())
+        self.factories = factories
+        self.args = args
+
+    def __missing__(self, key: str) -> Any:
+        factory = self.factories.get(key)
+        if factory is None:
+            raise KeyError(key)
+        value = self[key] = factory(*self.args)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return dict.__contains__(self, key) or key in self.factories
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+_empty = inspect.Parameter.empty
+
+class ParamPlan:
+    """How to resolve one parameter when it's not provided by the context."""
+    __slots__ = ("name", "dependency", "use_cache", "plan", "default", "scope")
+
+    def __init__(
+        self,
+        name: str,
+        dependency: Optional[Callable] = None,
+        use_cache: bool = False,
+        plan: Optional["ResolutionPlan"] = None,
+        default: Any = _empty,
+        scope: str = "request",
+    ) -> None:
+        self.name = name
+        self.dependency = dependency
+        self.use_cache = use_cache
+        self.plan = plan
+        self.default = default
+        self.scope = scope
+
+    def get_plan(self) -> "ResolutionPlan":
+        # sub-plans that failed to compile upfront are compiled (and fail) on first use,
+        # same as they would without the plan
+        if self.plan is None:
+            self.plan = compile_plan(self.dependency)
+        return self.plan
+
+# How the callable is invoked
+CALL = "call"
+# sync function, runs on the event loop unless the bot offloads sync dependencies
+SYNC = "sync"
+# sync function marked with @offload, runs in the executor when there is one
+OFFLOAD = "offload"
+COROUTINE = "coroutine"
+GENERATOR = "generator"
+ASYNC_GENERATOR = "async_generator"
+
+def _call_kind(func: Callable) -> str:
+    if inspect.isasyncgenfunction(func):
+        return ASYNC_GENERATOR
+    if inspect.isgeneratorfunction(func):
+        return GENERATOR
+    if inspect.iscoroutinefunction(func):
+        return COROUTINE
+    # classes (e.g. dataclass configs) and providers marked with @inline are always called on the event loop
+    if inspect.isfunction(func) and not is_inline(func):
+        return OFFLOAD if is_offloaded(func) else SYNC
+    return CALL
+
+class ResolutionPlan:
+    """
+    Everything solve_dependencies needs to know about a callable, computed once.
+    Doesn't hold a reference to the callable itself so it can live in a weak-keyed registry.
+    """
+    __slots__ = ("params", "kind", "__weakref__")
+
+    def __init__(self, params: Tuple[ParamPlan, ...], kind: str = CALL) -> None:
+        self.params = params
+        self.kind = kind
+
+    async def solve(
+        self,
+        context: Dict[str, Any],
+        store: Optional[DependencyStore] = None,
+        stack: Optional[AsyncExitStack] = None,
+        executor: Optional[SyncExecutor] = None,
+        offload_sync: bool = False,
+    ) -> Dict[str, Any]:
+        return await Resolver(context, store, stack, executor, offload_sync).solve(self)
+
+class Resolver:
+    """
+    Executes plans for one request.
+    A cached dependency is built once per request no matter how many branches of the graph use it,
+    independent dependencies are built concurrently.
+    Generator dependencies run until their `yield` and are finished when the `stack` is closed.
+    Sync providers are called on the event loop. Ones marked with @offload (all but @inline ones with
+    offload_sync) run in the `executor` if given.
+    """
+    __slots__ = ("context", "store", "stack", "executor", "offload_sync", "cache")
+
+    def __init__(
+        self,
+        context: Dict[str, Any],
+        store: Optional[DependencyStore] = None,
+        stack: Optional[AsyncExitStack] = None,
+        executor: Optional[SyncExecutor] = None,
+        offload_sync: bool = False,
+    ) -> None:
+        self.context = context
+        self.store = store or dependency_store
+        self.stack = stack
+        self.executor = executor
+        self.offload_sync = offload_sync
+        self.cache: Dict[Callable, asyncio.Future] = {}
+
+    async def solve(self, plan: ResolutionPlan) -> Dict[str, Any]:
+        context = self.context
+        params: Dict[str, Any] = {}
+        pending: List[ParamPlan] = []
+        for param in plan.params:
+            if param.name in context:
+                params[param.name] = context[param.name]
+            elif param.dependency is not None:
+                pending.append(param)
+            elif param.default is not _empty:
+                params[param.name] = param.default
+            else:
+                raise ValueError(f"Cannot resolve dependency for parameter {param.name}")
+
+        if not pending:
+            return params
+
+        if len(pending) == 1:
+            params[pending[0].name] = await self.call(pending[0])
+        else:
+            # Resolve all dependencies concurrently
+            resolved = await asyncio.gather(
+                *(self.call(param) for param in pending)
+            )
+            for param, value in zip(pending, resolved):
+                params[param.name] = value
+        return params
+
+    def _conversation_id(self, param: ParamPlan) -> str:
+        conversation_id = getattr(self.context.get("request"), "conversation_id", None)
+        if conversation_id is None:
+            raise ValueError(f"Conversation scoped dependency for parameter {param.name} requires a request with conversation_id")
+        return conversation_id
+
+    async def call(self, param: ParamPlan) -> Any:
+        dependency = param.dependency
+        if param.scope != "request":
+            conversation_id = self._conversation_id(param) if param.scope == "conversation" else None
+            return await self.store.get_or_create(
+                dependency,
+                lambda stack: Resolver(self.context, self.store, stack, self.executor, self.offload_sync).create(param, long_lived=True),
+                conversation_id,
+            )
+
+        if not param.use_cache:
+            return await self.create(param)
+
+        # The first caller builds the dependency, everyone else reaching it concurrently
+        # (from any level of the graph) waits for the same result
+        future = self.cache.get(dependency)
+        if future is not None:
+            return await future
+        future = self.cache[dependency] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self.create(param)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, the creator re-raises it
+            raise
+        future.set_result(result)
+        return result
+
+    async def create(self, param: ParamPlan, long_lived: bool = False) -> Any:
+        plan = param.get_plan()
+        dep_params = await self.solve(plan)
+        kind = plan.kind
+
+        if kind == CALL or kind == SYNC or kind == OFFLOAD or kind == COROUTINE:
+            if self.executor is not None and (kind == OFFLOAD or (kind == SYNC and self.offload_sync)):
+                result = await self.executor.run(param.dependency, **dep_params)
+            else:
+                result = param.dependency(**dep_params)
+            if kind == COROUTINE:
+                result = await result
+            if long_lived:
+                self.stack.push_async_callback(_teardown, result)
+            return result
+
+        if self.stack is None:
+            raise ValueError(f"Generator dependency for parameter {param.name} can only be used with an exit stack")
+        if kind == ASYNC_GENERATOR:
+            return await self.stack.enter_async_context(asynccontextmanager(param.dependency)(**dep_params))
+        manager = contextmanager(param.dependency)(**dep_params)
+        dependency = param.dependency
+        offloaded = is_offloaded(dependency) or (self.offload_sync and not is_inline(dependency))
+        if self.executor is None or not offloaded:
+            return self.stack.enter_context(manager)
+        value = await self.executor.run(manager.__enter__)
+        self.stack.push_async_exit(lambda *exc_info: self.executor.run(manager.__exit__, *exc_info))
+        return value
+
+_cleanup_tasks: Set[asyncio.Task] = set()
+
+async def _shielded(coro: Awaitable[Any]) -> Any:
+    task = asyncio.ensure_future(coro)
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+    return await asyncio.shield(task)
+
+@asynccontextmanager
+async def request_scope() -> AsyncIterator[AsyncExitStack]:
+    # Exit stack for the generator dependencies of one request. The cleanup runs even when
+    # the request is cancelled (e.g. client disconnected mid-stream), it's shielded from the cancellation.
+    stack = AsyncExitStack()
+    try:
+        yield stack
+    except BaseException:
+        if not await _shielded(stack.__aexit__(*sys.exc_info())):
+            raise
+    else:
+        await _shielded(stack.aclose())
+
+class DependencyCycleError(ValueError):
+    pass
+
+# Plans go away together with the function they were compiled for
+_plans: "weakref.WeakKeyDictionary[Callable, ResolutionPlan]" = weakref.WeakKeyDictionary()
+# Callables being compiled right now, sub-plans are compiled depth first so this is the current path
+_compiling: List[Callable] = []
+
+def _name(func: Callable) -> str:
+    return getattr(func, "__qualname__", repr(func))
+
+def compile_plan(func: Callable) -> ResolutionPlan:
     # Handle bound methods by getting the underlying function
     if inspect.ismethod(func):
         func = func.__func__
-    
+
+    try:
+        return _plans[func]
+    except KeyError:
+        cacheable = True
+    except TypeError:
+        # not hashable or not weak referenceable, can't be cached
+        cacheable = False
+
+    if func in _compiling:
+        path = _compiling[_compiling.index(func):] + [func]
+        raise DependencyCycleError("Dependency cycle: " + " -> ".join(_name(f) for f in path))
+
+    _compiling.append(func)
+    try:
+        plan = _compile(func)
+    finally:
+        _compiling.pop()
+    if cacheable:
+        _plans[func] = plan
+    return plan
+
+def _compile_sub_plan(dependency: Callable) -> Optional[ResolutionPlan]:
+    try:
+        return compile_plan(dependency)
+    except DependencyCycleError:
+        raise
+    except (TypeError, ValueError, NameError):
+        return None
+
+def _compile_param(name: str, param: inspect.Parameter, annotation: Any) -> ParamPlan:
+    if get_origin(annotation) is Annotated:
+        args = get_args(annotation)
+        for arg in args:
+            if isinstance(arg, Depends):
+                # Handle empty Depends() with type annotation
+                if arg.is_default and isinstance(args[0], type):
+                    dependency_type = args[0]
+                    plan = _compile_sub_plan(dependency_type) if is_dataclass(dependency_type) else ResolutionPlan(())
+                    return ParamPlan(name, dependency_type, arg.use_cache, plan, scope=arg.scope)
+                return ParamPlan(name, arg.dependency, arg.use_cache, _compile_sub_plan(arg.dependency), scope=arg.scope)
+
+    if isinstance(param.default, Depends):
+        depends = param.default
+        return ParamPlan(name, depends.dependency, depends.use_cache, _compile_sub_plan(depends.dependency), scope=depends.scope)
+
+    if param.default is not _empty:
+        return ParamPlan(name, default=param.default)
+
+    if (is_dataclass(annotation) and
+        annotation is not _empty and
+        isinstance(annotation, type)):
+        return ParamPlan(name, annotation, False, _compile_sub_plan(annotation))
+
+    return ParamPlan(name)
+
+def _compile(func: Callable) -> ResolutionPlan:
     signature = inspect.signature(func)
     hints = get_type_hints(func, include_extras=True)
-    
-    cache: Dict[Callable, Any] = {}
 
-    async def resolve_dependency(param_name: str, param: inspect.Parameter) -> Any:
+    params = []
+    for name, param in signature.parameters.items():
         # Skip self/cls parameters
-        if param.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD and param_name in ('self', 'cls'):
-            return None
-
-        if param_name in context:
-            return context[param_name]
-
-        annotation = hints.get(param_name, param.annotation)
-        
-        if get_origin(annotation) is Annotated:
-            args = get_args(annotation)
-            for arg in args:
-                if isinstance(arg, Depends):
-                    dependency = arg.dependency
-                    if arg.use_cache and dependency in cache:
-                        return cache[dependency]
-                    # Handle empty Depends() with type annotation
-                    if arg.is_default and isinstance(args[0], type):
-                        dependency_type = args[0]
-                        dep_params = await solve_dependencies(dependency_type, context)
-                        result = dependency_type(**dep_params) if is_dataclass(dependency_type) else dependency_type()
-                        if arg.use_cache:
-                            cache[dependency_type] = result
-                        return result
-
-                    dep_params = await solve_dependencies(dependency, context)
-                    
-                    if inspect.iscoroutinefunction(dependency):
-                        result = await dependency(**dep_params)
-                    else:
-                        result = dependency(**dep_params)
-                    
-                    if arg.use_cache:
-                        cache[dependency] = result
-                    return result
-
-        if isinstance(param.default, Depends):
-            dependency = param.default.dependency
-            if param.default.use_cache and dependency in cache:
-                return cache[dependency]
-            
-            dep_params = await solve_dependencies(dependency, context)
-            
-            if inspect.iscoroutinefunction(dependency):
-                result = await dependency(**dep_params)
-            else:
-                result = dependency(**dep_params)
-            
-            if param.default.use_cache:
-                cache[dependency] = result
-            return result
+        if param.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD and name in ('self', 'cls'):
+            continue
+        params.append(_compile_param(name, param, hints.get(name, param.annotation)))
 
-        if param.default != inspect.Parameter.empty:
-            return param.default
-
-        if (is_dataclass(annotation) and 
-            annotation != inspect.Parameter.empty and 
-            isinstance(annotation, type)):
-            
-            class_signature = inspect.signature(annotation)
-            dep_params = await solve_dependencies(annotation, context)
-            return annotation(**dep_params)
-
-        raise ValueError(f"Cannot resolve dependency for parameter {param_name}")
-
-    # Resolve all dependencies concurrently
-    resolved = await asyncio.gather(
-        *(resolve_dependency(name, param) 
-          for name, param in signature.parameters.items())
-    )
-    
-    # Filter out None values (from self/cls parameters)
-    params = {
-        name: value 
-        for name, value, param in zip(signature.parameters.keys(), resolved, signature.parameters.values())
-        if not (param.kind == inspect.Parameter.POSITIONAL_OR_KEYWORD and name in ('self', 'cls'))
-    }
-    
-    return params
+    return ResolutionPlan(tuple(params), _call_kind(func))
+
+async def solve_dependencies(
+    func: Callable,
+    context: Optional[Dict[str, Any]] = None,
+    store: Optional[DependencyStore] = None,
+    stack: Optional[AsyncExitStack] = None,
+    executor: Optional[SyncExecutor] = None,
+    offload_sync: bool = False,
+) -> Dict[str, Any]:
+    return await compile_plan(func).solve(context or {}, store, stack, executor, offload_sync)
 
 def solve_dependencies_sync(
     func: Callable,
-    context: Optional[Dict[str, Any]] = None
+    context: Optional[Dict[str, Any]] = None,
+    store: Optional[DependencyStore] = None,
 ) -> Dict[str, Any]:
-    return asyncio.run(solve_dependencies(func, context))
\ No newline at end of file
+    return asyncio.run(solve_dependencies(func, context, store))
\ No newline at end of file
@@ -0,0 +1,79 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, TypeVar
+import asyncio
+import contextvars
+import functools
+
+T = TypeVar("T")
+
+INLINE_ATTRIBUTE = "__poe_bot_inline__"
+OFFLOAD_ATTRIBUTE = "__poe_bot_offload__"
+
+def inline(func: Callable[..., T]) -> Callable[..., T]:
+    # Marks a cheap sync dependency provider, it stays on the event loop even for bots with offload_sync_dependencies
+    setattr(func, INLINE_ATTRIBUTE, True)
+    return func
+
+def is_inline(func: Callable) -> bool:
+    return getattr(func, INLINE_ATTRIBUTE, False)
+
+def offload(func: Callable[..., T]) -> Callable[..., T]:
+    # Marks a blocking sync dependency provider, it runs in the executor instead of on the event loop
+    setattr(func, OFFLOAD_ATTRIBUTE, True)
+    return func
+
+def is_offloaded(func: Callable) -> bool:
+    return getattr(func, OFFLOAD_ATTRIBUTE, False)
+
+_DONE = object()
+
+class SyncExecutor:
+    """
+    Bounded thread pool for sync handlers and blocking sync dependency providers, so a slow one doesn't
+    stall every other request on the event loop. The pool is created on first use.
+    """
+    def __init__(self, max_workers: Optional[int] = None, thread_name_prefix: str = "poe-bot-sync") -> None:
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, self.thread_name_prefix)
+        return self._executor
+
+    def _submit(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> "Future[T]":
+        # context variables are visible in the thread
+        context = contextvars.copy_context()
+        return self._get().submit(functools.partial(context.run, fn, *args, **kwargs))
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        # same as asyncio.to_thread
+        return await asyncio.wrap_future(self._submit(fn, *args, **kwargs))
+
+    async def iterate(self, items: Iterator[T]) -> AsyncIterator[T]:
+        # Sync generator as an async iterator, every step runs in the executor
+        step: Optional["Future[T]"] = None
+        try:
+            while True:
+                step = self._submit(next, items, _DONE)
+                item = await asyncio.wrap_future(step)
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            if step is not None and not step.done():
+                # cancelled while a step runs in the thread, a generator can't be closed while it executes.
+                # asyncio.wait doesn't cancel the step, the cancellation is raised once the generator is closed
+                await asyncio.wait([asyncio.wrap_future(step)])
+            close = getattr(items, "close", None)
+            if close is not None:
+                await self.run(close)
+
+    def shutdown(self, wait: bool = True) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+# Process-wide executor, shut down on app shutdown (see poe_bot_but_better.app.make_app)
+sync_executor = SyncExecutor()
\ No newline at end of file
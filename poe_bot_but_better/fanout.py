@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+import asyncio
+from .client import GetFinalResponseCallable, RequestOrMessage
+from .executor import inline
+
+Call = Tuple[RequestOrMessage, str]
+
+@dataclass
+class CallResult:
+    bot_name: str
+    response: Optional[str] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class Fanout:
+    """
+    Calls several bots at once with bounded latency.
+    `timeout` limits each call, `deadline` the whole fan-out (seconds from the start).
+    Calls still running when a helper returns are cancelled.
+    """
+    def __init__(self, get_final_response: GetFinalResponseCallable, timeout: Optional[float] = None) -> None:
+        self.get_final_response = get_final_response
+        self.timeout = timeout
+
+    async def _call(self, call: Call, timeout: Optional[float]) -> CallResult:
+        request_or_message, bot_name = call
+        try:
+            response = await asyncio.wait_for(self.get_final_response(request_or_message, bot_name), timeout)
+            return CallResult(bot_name, response=response)
+        except Exception as e:
+            return CallResult(bot_name, error=e)
+
+    async def _run(
+        self,
+        calls: Sequence[Call],
+        *,
+        wanted: Optional[int],
+        timeout: Optional[float],
+        deadline: Optional[float],
+        hedge_delay: Optional[float] = None,
+    ) -> Tuple[List[Optional[CallResult]], List[CallResult]]:
+        # Returns results in call order (None if not finished) and the successes in completion order.
+        # With hedge_delay, calls are started one by one, the next one when the running ones
+        # haven't succeeded within the delay or have all failed.
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        end = loop.time() + deadline if deadline is not None else None
+        results: List[Optional[CallResult]] = [None] * len(calls)
+        successes: List[CallResult] = []
+        running: Dict[asyncio.Task, int] = {}
+        started = 0
+        next_start = loop.time()
+
+        def start(index: int) -> None:
+            running[asyncio.ensure_future(self._call(calls[index], timeout))] = index
+
+        try:
+            while True:
+                now = loop.time()
+                while started < len(calls) and (hedge_delay is None or now >= next_start or not running):
+                    start(started)
+                    started += 1
+                    next_start = now + (hedge_delay or 0)
+                if not running:
+                    break
+
+                if end is not None and now >= end:
+                    break
+                wait_for: Optional[float] = None
+                if end is not None:
+                    wait_for = end - now
+                if hedge_delay is not None and started < len(calls):
+                    wait_for = min(wait_for, next_start - now) if wait_for is not None else next_start - now
+
+                done: Set[asyncio.Task]
+                done, _ = await asyncio.wait(running, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    results[running.pop(task)] = result
+                    if result.ok:
+                        successes.append(result)
+                if wanted is not None and len(successes) >= wanted:
+                    break
+                if end is not None and loop.time() >= end:
+                    break
+        finally:
+            for task in running:
+                task.cancel()
+
+        return results, successes
+
+    async def gather_with_deadline(
+        self, calls: Sequence[Call], *, timeout: Optional[float] = None, deadline: Optional[float] = None
+    ) -> List[CallResult]:
+        # All results in call order, calls that didn't finish in time have a TimeoutError
+        results, _ = await self._run(calls, wanted=None, timeout=timeout, deadline=deadline)
+        return [
+            result or CallResult(bot_name, error=asyncio.TimeoutError())
+            for result, (_, bot_name) in zip(results, calls)
+        ]
+
+    async def first_n(
+        self, calls: Sequence[Call], n: int, *, timeout: Optional[float] = None, deadline: Optional[float] = None
+    ) -> List[CallResult]:
+        # Up to n successful results in completion order, fewer if the rest failed or ran out of time
+        _, successes = await self._run(calls, wanted=n, timeout=timeout, deadline=deadline)
+        return successes[:n]
+
+    async def race(
+        self, calls: Sequence[Call], *, timeout: Optional[float] = None, deadline: Optional[float] = None
+    ) -> Optional[CallResult]:
+        # First successful result, None if every call failed or ran out of time
+        successes = await self.first_n(calls, 1, timeout=timeout, deadline=deadline)
+        return successes[0] if successes else None
+
+    async def hedge(
+        self, calls: Sequence[Call], *, delay: float, timeout: Optional[float] = None, deadline: Optional[float] = None
+    ) -> Optional[CallResult]:
+        # Starts with the first call, adds the next one (backup) every `delay` seconds without a response
+        # or right away when the running ones failed. First success wins.
+        _, successes = await self._run(calls, wanted=1, timeout=timeout, deadline=deadline, hedge_delay=delay)
+        return successes[0] if successes else None
+
+@inline
+def create_fanout(get_final_response: GetFinalResponseCallable) -> Fanout:
+    return Fanout(get_final_response)
\ No newline at end of file
@@ -0,0 +1,111 @@
+from typing import Iterable, Iterator, List, Sequence, Tuple, overload
+import fastapi_poe as fp
+from poe_bot_but_better.types import PoeBotError
+
+# (messages, start, stop), a range of a list/tuple that is shared, never copied
+Segment = Tuple[Sequence[fp.ProtocolMessage], int, int]
+
+class MessageSequence(Sequence[fp.ProtocolMessage]):
+    """
+    Immutable view over conversation messages. prepend, append, slicing, truncate and `+` return new views
+    sharing the messages and the lists holding them, e.g. a 200 message history forwarded to six bots
+    with a different system prompt each is stored once.
+    The lists a view is built from must not be modified afterwards.
+    """
+    __slots__ = ("_segments", "_length")
+
+    def __init__(self, messages: Iterable[fp.ProtocolMessage] = ()) -> None:
+        if isinstance(messages, MessageSequence):
+            segments = messages._segments
+        else:
+            if not isinstance(messages, (list, tuple)):
+                messages = tuple(messages)
+            segments = ((messages, 0, len(messages)),) if messages else ()
+        self._segments: Tuple[Segment, ...] = segments
+        self._length = sum(stop - start for _, start, stop in segments)
+
+    @classmethod
+    def _from_segments(cls, segments: Tuple[Segment, ...]) -> "MessageSequence":
+        view = cls.__new__(cls)
+        view._segments = segments
+        view._length = sum(stop - start for _, start, stop in segments)
+        return view
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[fp.ProtocolMessage]:
+        for messages, start, stop in self._segments:
+            for i in range(start, stop):
+                yield messages[i]
+
+    @overload
+    def __getitem__(self, index: int) -> fp.ProtocolMessage: ...
+    @overload
+    def __getitem__(self, index: slice) -> "MessageSequence": ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return MessageSequence(tuple(self)[index])
+            return self._slice(start, stop)
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("MessageSequence index out of range")
+        for messages, start, stop in self._segments:
+            if index < stop - start:
+                return messages[start + index]
+            index -= stop - start
+
+    def _slice(self, start: int, stop: int) -> "MessageSequence":
+        segments: List[Segment] = []
+        offset = 0
+        for messages, segment_start, segment_stop in self._segments:
+            if offset >= stop:
+                break
+            size = segment_stop - segment_start
+            low, high = max(start - offset, 0), min(stop - offset, size)
+            if low < high:
+                segments.append((messages, segment_start + low, segment_start + high))
+            offset += size
+        return self._from_segments(tuple(segments))
+
+    @staticmethod
+    def _segments_of(messages: Iterable[fp.ProtocolMessage]) -> Tuple[Segment, ...]:
+        if isinstance(messages, MessageSequence):
+            return messages._segments
+        messages = messages if isinstance(messages, (list, tuple)) else tuple(messages)
+        if not all(isinstance(message, fp.ProtocolMessage) for message in messages):
+            raise PoeBotError("MessageSequence can only contain ProtocolMessages")
+        return ((messages, 0, len(messages)),) if messages else ()
+
+    def prepend(self, *messages: fp.ProtocolMessage) -> "MessageSequence":
+        return self._from_segments(self._segments_of(messages) + self._segments)
+
+    def append(self, *messages: fp.ProtocolMessage) -> "MessageSequence":
+        return self._from_segments(self._segments + self._segments_of(messages))
+
+    def truncate(self, max_messages: int) -> "MessageSequence":
+        # the last max_messages messages
+        return self._slice(max(self._length - max_messages, 0), self._length)
+
+    def __add__(self, other: Iterable[fp.ProtocolMessage]) -> "MessageSequence":
+        return self._from_segments(self._segments + self._segments_of(other))
+
+    def __radd__(self, other: Iterable[fp.ProtocolMessage]) -> "MessageSequence":
+        return self._from_segments(self._segments_of(other) + self._segments)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (MessageSequence, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def to_list(self) -> List[fp.ProtocolMessage]:
+        # a new list of the same message objects (references only)
+        return list(self)
+
+    def __repr__(self) -> str:
+        return f"MessageSequence({self.to_list()!r})"
\ No newline at end of file
@@ -0,0 +1,254 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import json
+import secrets
+import threading
+import time
+import httpx
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class MetricsSink:
+    """
+    Receives the measurements of the hot path hooks (get_response and sub-bot calls).
+    Nothing is measured until a sink is installed with set_sink.
+    """
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        pass
+
+    def increment(self, name: str, value: float = 1, labels: Labels = ()) -> None:
+        pass
+
+    def export_span(self, span: "Span") -> None:
+        pass
+
+# Installed sink, None disables the hooks (a single attribute check on the hot path)
+sink: Optional[MetricsSink] = None
+
+def set_sink(new_sink: Optional[MetricsSink]) -> None:
+    global sink
+    sink = new_sink
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class HistogramRegistry(MetricsSink):
+    """In-process histograms and counters, rendered in the Prometheus text format."""
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # (name, labels) -> per bucket counts (last one is +Inf), sum
+        self._histograms: Dict[Tuple[str, Labels], Tuple[List[int], List[float]]] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        # sync handlers run in threads
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = ([0] * (len(self.buckets) + 1), [0.0])
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1][0] += value
+
+    def increment(self, name: str, value: float = 1, labels: Labels = ()) -> None:
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def counter(self, name: str, labels: Labels = ()) -> float:
+        return self._counters.get((name, labels), 0)
+
+    def histogram(self, name: str, labels: Labels = ()) -> Optional[Dict[str, Any]]:
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            return None
+        counts, total = histogram
+        return {"count": sum(counts), "sum": total[0], "counts": list(counts)}
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        typed = set()
+        for (name, labels), (counts, total) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total[0]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+@dataclass
+class Span:
+    # same shape as an OpenTelemetry span, times are unix timestamps
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float
+    end: Optional[float] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("poe_bot_current_span", default=None)
+
+def start_span(name: str, attributes: Optional[Dict[str, Any]] = None, activate: bool = True) -> Tuple[Span, Any]:
+    # Child of the span running in this context, e.g. a sub-bot call made while answering a request.
+    # An activated span is the parent of spans started after it in this context until it ends.
+    parent = _current_span.get()
+    span = Span(
+        name=name,
+        trace_id=parent.trace_id if parent else secrets.token_hex(16),
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent else None,
+        start=time.time(),
+        attributes=attributes or {},
+    )
+    return span, _current_span.set(span) if activate else None
+
+def end_span(span: Span, token: Any, error: Optional[BaseException] = None) -> Span:
+    span.end = time.time()
+    if error is not None:
+        span.error = error_code(error)
+    if token is not None:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # finished from another context, e.g. a stream closed by the garbage collector
+            pass
+    return span
+
+class SpanSink(MetricsSink):
+    """Hands every finished span to `export`, e.g. a function forwarding them to an OpenTelemetry exporter."""
+    def __init__(self, export: Callable[[Span], None]) -> None:
+        self.export = export
+
+    def export_span(self, span: Span) -> None:
+        self.export(span)
+
+class MultiSink(MetricsSink):
+    def __init__(self, *sinks: MetricsSink) -> None:
+        self.sinks = sinks
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        for s in self.sinks:
+            s.observe(name, value, labels)
+
+    def increment(self, name: str, value: float = 1, labels: Labels = ()) -> None:
+        for s in self.sinks:
+            s.increment(name, value, labels)
+
+    def export_span(self, span: Span) -> None:
+        for s in self.sinks:
+            s.export_span(span)
+
+def error_code(error: BaseException) -> str:
+    # HTTP status of the failed call if there is one (fastapi_poe wraps it in BotError),
+    # the error_type of an error event sent by the bot, otherwise the error type
+    seen = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        if isinstance(current, httpx.HTTPStatusError):
+            return str(current.response.status_code)
+        seen.add(id(current))
+        current = current.__cause__ or current.__context__
+    if error.args and isinstance(error.args[0], str) and error.args[0].startswith("{"):
+        try:
+            error_type = json.loads(error.args[0]).get("error_type")
+        except (ValueError, AttributeError):
+            error_type = None
+        if isinstance(error_type, str):
+            return error_type
+    return type(error).__name__
+
+def chunk_size(response: Any) -> int:
+    text = getattr(response, "text", None)
+    if text is None:
+        text = getattr(response, "data", None) or ""
+    return len(text.encode()) if isinstance(text, str) else 0
+
+class ResponseTimer:
+    """Measures one get_response: dependency resolution, first chunk, streamed chunks and the whole response."""
+    __slots__ = ("sink", "labels", "start", "first_chunk", "chunks", "size", "span", "token")
+
+    def __init__(self, sink: MetricsSink, bot_name: Optional[str]) -> None:
+        self.sink = sink
+        self.labels: Labels = (("bot", bot_name or ""),)
+        self.start = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        self.chunks = 0
+        self.size = 0
+        self.span, self.token = start_span("get_response", {"bot": bot_name})
+
+    def dependencies_resolved(self) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.sink.observe("poe_bot_dependencies_seconds", elapsed, self.labels)
+        self.span.attributes["dependencies_seconds"] = elapsed
+
+    def chunk(self, response: Any) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.start
+            self.sink.observe("poe_bot_first_chunk_seconds", self.first_chunk, self.labels)
+        self.chunks += 1
+        self.size += chunk_size(response)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        sink, labels = self.sink, self.labels
+        elapsed = time.perf_counter() - self.start
+        sink.observe("poe_bot_response_seconds", elapsed, labels)
+        sink.increment("poe_bot_chunks_total", self.chunks, labels)
+        sink.increment("poe_bot_chunk_bytes_total", self.size, labels)
+        if error is not None:
+            sink.increment("poe_bot_errors_total", 1, labels + (("code", error_code(error)),))
+        self.span.attributes.update(first_chunk_seconds=self.first_chunk, chunks=self.chunks, bytes=self.size)
+        sink.export_span(end_span(self.span, self.token, error))
+
+class SubBotTimer:
+    """Measures one call to another bot: latency, time to first chunk and errors."""
+    __slots__ = ("sink", "labels", "start", "first_chunk", "span", "token")
+
+    def __init__(self, sink: MetricsSink, bot_name: str) -> None:
+        self.sink = sink
+        self.labels: Labels = (("bot", bot_name),)
+        self.start = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        # not activated, a stream is consumed by code that doesn't belong to the call
+        self.span, self.token = start_span("sub_bot_call", {"bot": bot_name}, activate=False)
+
+    def chunk(self) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter() - self.start
+            self.sink.observe("poe_sub_bot_first_chunk_seconds", self.first_chunk, self.labels)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        elapsed = time.perf_counter() - self.start
+        self.sink.observe("poe_sub_bot_seconds", elapsed, self.labels)
+        if error is not None:
+            self.sink.increment("poe_sub_bot_errors_total", 1, self.labels + (("code", error_code(error)),))
+        self.span.attributes["first_chunk_seconds"] = self.first_chunk
+        self.sink.export_span(end_span(self.span, self.token, error))
\ No newline at end of file
@@ -0,0 +1,134 @@
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+import asyncio
+import threading
+import time
+import warnings
+from . import metrics
+from .types import PoeBotError
+
+class RateLimited(PoeBotError):
+    pass
+
+class UndeclaredDependencyError(PoeBotError):
+    pass
+
+@dataclass
+class Rate:
+    per_second: float
+    # calls that can be made at once after a quiet period
+    burst: float = 1
+
+class TokenBucket:
+    """
+    Paces calls instead of failing them: a call reserves a token and waits until the bucket would have it.
+    Reservations can take the bucket below zero, concurrent callers are spaced 1 / rate apart.
+    """
+    def __init__(self, rate: Rate) -> None:
+        self.rate = rate.per_second
+        self.burst = rate.burst
+        self._tokens = rate.burst
+        self._updated = time.monotonic()
+        # sync handlers call bots from threads
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        # seconds until the reserved tokens are available
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def cancel(self, tokens: float = 1) -> None:
+        # gives back a reservation that wasn't used
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+@dataclass
+class RateLimits:
+    """
+    Rates of calls to other bots. `rates` are shared by the whole process, `request_rates` pace the calls of a
+    single response. The calls of a response are checked against the server_bot_dependencies the bot declares in
+    get_settings: "warn", "raise" (UndeclaredDependencyError) or "off".
+    A call that would have to wait more than max_wait seconds fails with RateLimited, the response ends with
+    rejection_message.
+    """
+    rates: Dict[str, Rate] = field(default_factory=dict)
+    default_rate: Optional[Rate] = None
+    request_rates: Dict[str, Rate] = field(default_factory=dict)
+    default_request_rate: Optional[Rate] = None
+    enforce_declared: str = "warn"
+    max_wait: Optional[float] = 30.0
+    rejection_message: str = "The bot is busy right now, please try again in a moment."
+
+    def __post_init__(self) -> None:
+        if self.enforce_declared not in ("warn", "raise", "off"):
+            raise ValueError(f"Unknown enforce_declared {self.enforce_declared!r}, use warn, raise or off")
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def bucket(self, bot_name: str) -> Optional[TokenBucket]:
+        bucket = self._buckets.get(bot_name)
+        if bucket is None:
+            rate = self.rates.get(bot_name, self.default_rate)
+            if rate is None:
+                return None
+            bucket = self._buckets[bot_name] = TokenBucket(rate)
+        return bucket
+
+    def for_request(self, declared: Optional[Dict[str, int]]) -> "RequestRateLimiter":
+        return RequestRateLimiter(self, declared)
+
+class RequestRateLimiter:
+    # The calls of one response: counted against the declared dependencies and paced by both bucket levels
+    def __init__(self, limits: RateLimits, declared: Optional[Dict[str, int]]) -> None:
+        self.limits = limits
+        self.declared = declared
+        self.calls: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _request_bucket(self, bot_name: str) -> Optional[TokenBucket]:
+        bucket = self._buckets.get(bot_name)
+        if bucket is None:
+            rate = self.limits.request_rates.get(bot_name, self.limits.default_request_rate)
+            if rate is None:
+                return None
+            bucket = self._buckets[bot_name] = TokenBucket(rate)
+        return bucket
+
+    def _check_declared(self, bot_name: str, calls: int) -> None:
+        if self.limits.enforce_declared == "off" or self.declared is None:
+            return
+        allowed = self.declared.get(bot_name, 0)
+        if calls <= allowed:
+            return
+        message = (
+            f"Call {calls} to {bot_name} in one response, server_bot_dependencies declares {allowed}. "
+            "Poe rejects calls that aren't declared."
+        )
+        if self.limits.enforce_declared == "raise":
+            raise UndeclaredDependencyError(message)
+        warnings.warn(message, RuntimeWarning, stacklevel=3)
+
+    async def acquire(self, bot_name: str) -> None:
+        calls = self.calls[bot_name] = self.calls.get(bot_name, 0) + 1
+        self._check_declared(bot_name, calls)
+
+        buckets = [bucket for bucket in (self.limits.bucket(bot_name), self._request_bucket(bot_name)) if bucket]
+        delay = max((bucket.reserve() for bucket in buckets), default=0.0)
+        if not delay:
+            return
+
+        labels = (("bot", bot_name),)
+        max_wait = self.limits.max_wait
+        if max_wait is not None and delay > max_wait:
+            for bucket in buckets:
+                bucket.cancel()
+            if metrics.sink:
+                metrics.sink.increment("poe_sub_bot_rate_limited_total", 1, labels)
+            raise RateLimited(f"Calls to {bot_name} are over their rate, the next one is possible in {delay:.1f}s")
+
+        if metrics.sink:
+            metrics.sink.observe("poe_sub_bot_throttle_seconds", delay, labels)
+        await asyncio.sleep(delay)
\ No newline at end of file
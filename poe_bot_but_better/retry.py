@@ -0,0 +1,205 @@
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, Optional, TypeVar
+import asyncio
+import random
+import threading
+import time
+import fastapi_poe as fp
+import httpx
+from . import metrics
+from .types import PoeBotError
+
+T = TypeVar("T")
+
+class CircuitOpenError(PoeBotError):
+    pass
+
+def is_transient(error: BaseException) -> bool:
+    # Errors a second attempt can fix: connection problems, timeouts, 5xx/429 and bot errors that allow a retry.
+    # Error pages of bot calls are raised as HTTPStatusError by the pool's clients, a 4xx (e.g. a misnamed
+    # bot) fails right away and doesn't count against the circuit breaker.
+    if isinstance(error, fp.client.BotErrorNoRetry):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(error, (httpx.TransportError, fp.client.BotError))
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the calls, so a failing upstream isn't hit with a retry for every call
+    (a retry storm). Every call deposits `ratio` tokens, a retry spends one, min_per_second keeps
+    retries possible when there is little traffic.
+    """
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0, max_tokens: float = 20.0) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        # sync handlers call bots from threads
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_call(self) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+class CircuitBreaker:
+    """
+    Stops calling a bot after failure_threshold transient failures in a row. After reset_timeout one trial
+    call is let through, it closes the circuit again on success.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._trial_running or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+
+    def record_abandoned(self) -> None:
+        # the call was cancelled or closed by the caller, says nothing about the bot
+        self._trial_running = False
+
+class CircuitBreakers:
+    """Circuit breaker of every called bot."""
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, bot_name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(bot_name)
+        if breaker is None:
+            breaker = self._breakers[bot_name] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+# Process-wide, shared by all bots
+retry_budget = RetryBudget()
+circuit_breakers = CircuitBreakers()
+
+@dataclass
+class RetryPolicy:
+    """
+    Retries of bot-to-bot calls. Streams are only retried before their first chunk, the caller has seen
+    nothing yet. With idempotent=True, get_final_response (it buffers the response) also retries a call that
+    failed halfway, the called bot may then run twice.
+    """
+    # attempts per call, 1 disables retries
+    max_attempts: int = 2
+    # backoff before attempt n is random(0, min(max_delay, base_delay * 2 ** (n - 2))), "full jitter"
+    base_delay: float = 0.2
+    max_delay: float = 5.0
+    idempotent: bool = False
+    retry_on: Callable[[BaseException], bool] = is_transient
+    # None disables the budget / the circuit breakers
+    budget: Optional[RetryBudget] = field(default_factory=lambda: retry_budget)
+    breakers: Optional[CircuitBreakers] = field(default_factory=lambda: circuit_breakers)
+
+    def delay(self, attempt: int) -> float:
+        # attempt is the one that failed, 1 for the first
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        if attempt >= self.max_attempts or not self.retry_on(error):
+            return False
+        return self.budget is None or self.budget.try_spend()
+
+    async def stream(
+        self,
+        bot_name: str,
+        open_stream: Callable[[], AsyncIterator[T]],
+        on_restart: Optional[Callable[[], None]] = None,
+    ) -> AsyncIterator[T]:
+        # Items of open_stream(), opened again after a transient failure. on_restart is called before a stream
+        # that already produced items starts over (idempotent policies only), the caller drops what it got.
+        breaker = self.breakers.get(bot_name) if self.breakers else None
+        if self.budget:
+            self.budget.record_call()
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if breaker and not breaker.allow():
+                if metrics.sink:
+                    metrics.sink.increment("poe_sub_bot_circuit_open_total", 1, (("bot", bot_name),))
+                raise CircuitOpenError(f"Calls to {bot_name} are paused after repeated failures")
+
+            started = False
+            outcome_recorded = False
+            stream = open_stream()
+            try:
+                async for item in stream:
+                    started = True
+                    yield item
+            except Exception as e:
+                transient = self.retry_on(e)
+                if breaker:
+                    # a bot answering with its own error is up
+                    if transient:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    outcome_recorded = True
+                restartable = not started or (on_restart is not None and self.idempotent)
+                if not restartable or not self.should_retry(e, attempt):
+                    raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                    outcome_recorded = True
+                return
+            finally:
+                if breaker and not outcome_recorded:
+                    breaker.record_abandoned()
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+            if metrics.sink:
+                metrics.sink.increment("poe_sub_bot_retries_total", 1, (("bot", bot_name),))
+            await asyncio.sleep(self.delay(attempt))
+            if started:
+                on_restart()
+
+# Used by bots that don't set a retry_policy
+default_retry_policy = RetryPolicy()
\ No newline at end of file
@@ -0,0 +1,100 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+import asyncio
+
+T = TypeVar("T")
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future) -> None:
+        self.task = task
+        self.waiters = 0
+
+class _Stream:
+    """One upstream stream, buffered so every subscriber sees the whole chunk sequence."""
+    __slots__ = ("chunks", "finished", "error", "subscribers", "task", "_changed")
+
+    def __init__(self) -> None:
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Future] = None
+        self._changed = asyncio.get_running_loop().create_future()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.get_running_loop().create_future()
+        changed.set_result(None)
+
+    async def pump(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            # asyncio.wait doesn't cancel the shared future when this subscriber is cancelled
+            await asyncio.wait((self._changed,))
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls, callers with the same key share one in-flight call.
+    The call is cancelled once every caller is gone.
+    """
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, _Call] = {}
+        self._streams: Dict[Hashable, _Stream] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls or key in self._streams
+
+    async def call(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                self._forget(self._calls, key, call)
+
+    async def stream(self, key: Hashable, fn: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = self._streams[key] = _Stream()
+            stream.task = asyncio.ensure_future(stream.pump(fn()))
+            stream.task.add_done_callback(lambda _: self._forget(self._streams, key, stream))
+
+        stream.subscribers += 1
+        try:
+            async for chunk in stream.subscribe():
+                yield chunk
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0 and not stream.finished:
+                stream.task.cancel()
+                self._forget(self._streams, key, stream)
+
+    @staticmethod
+    def _forget(flights: Dict[Hashable, Any], key: Hashable, flight: Any) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
\ No newline at end of file
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+import asyncio
+import time
+
+# Imported by the package itself, keep this module free of heavy imports
+
+class StartupReport:
+    """
+    Where the cold start goes: imports of the package modules, decoration of the bots and warmup, in the order
+    they happened. print(startup_report.render()) once the app is built.
+    """
+    def __init__(self) -> None:
+        self.phases: List[Tuple[str, float]] = []
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @property
+    def total(self) -> float:
+        return sum(seconds for _, seconds in self.phases)
+
+    def render(self) -> str:
+        width = max((len(name) for name, _ in self.phases), default=0)
+        lines = [f"{name.ljust(width)}  {seconds * 1000:8.1f} ms" for name, seconds in self.phases]
+        lines.append(f"{'total'.ljust(width)}  {self.total * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+    def clear(self) -> None:
+        self.phases.clear()
+
+# Process-wide
+startup_report = StartupReport()
+
+def _warm_models() -> None:
+    # validation and serialization of the protocol models, their first use is slower than the ones after
+    import fastapi_poe as fp
+    request = fp.QueryRequest.model_validate({
+        "version": fp.client.PROTOCOL_VERSION, "type": "query", "user_id": "", "conversation_id": "", "message_id": "",
+        "query": [{"role": "user", "content": ""}],
+    })
+    fp.SettingsRequest.model_validate({"version": fp.client.PROTOCOL_VERSION, "type": "settings"})
+    request.model_copy(update={"query": request.query})
+    fp.PartialResponse(text="").model_dump_json()
+    fp.MetaResponse(text="").model_dump_json()
+    fp.ErrorResponse(text="").model_dump_json()
+    fp.SettingsResponse().model_dump()
+
+async def awarmup(*bots) -> StartupReport:
+    # async variant of warmup, for an already running event loop
+    with startup_report.phase("warmup models"):
+        _warm_models()
+    for bot in bots:
+        await bot.warmup()
+    return startup_report
+
+def warmup(*bots) -> StartupReport:
+    """
+    Does up front what the first requests would: compiles the dependency injection plans, computes and serializes
+    the settings of the bots and exercises the protocol models. Call it where the app is built, or before a
+    memory snapshot (e.g. Modal's enable_memory_snapshot) so restored containers start warm.
+    It runs on a temporary event loop, app scoped dependencies created there are created again on the loop of the app.
+    """
+    asyncio.run(awarmup(*bots))
+    return startup_report
\ No newline at end of file
@@ -0,0 +1,137 @@
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterable, List, Optional, Tuple, Union
+import asyncio
+import fastapi_poe as fp
+import sse_starlette
+from poe_bot_but_better.types import PoeBotError
+
+Response = Union[fp.PartialResponse, sse_starlette.sse.ServerSentEvent]
+
+@dataclass
+class StreamCoalescing:
+    """
+    Small text chunks are merged before they are sent, a chunk goes out once it has `max_size`
+    characters, `max_delay` seconds after its first part (even while the handler is still waiting), before
+    a chunk that can't be merged and at the end.
+    Replace responses, suggested replies, errors and events are never merged.
+    """
+    max_size: int = 256
+    max_delay: float = 0.005
+
+def normalize_response(response: Union[str, fp.PartialResponse, sse_starlette.sse.ServerSentEvent]) -> Response:
+    if isinstance(response, fp.PartialResponse):
+        return response
+    elif response is None:
+        return fp.PartialResponse(text="")
+    elif isinstance(response, str):
+        return fp.PartialResponse(text=response)
+    elif isinstance(response, sse_starlette.sse.ServerSentEvent):
+        return response
+    else:
+        raise PoeBotError("Response must be a string or PartialResponse. Got: {}".format(response))
+
+def mergeable_text(item: Any) -> Optional[str]:
+    # Text of a plain chunk, None when the chunk has to be sent on its own
+    if isinstance(item, str):
+        return item
+    if item is None:
+        return ""
+    if (
+        type(item) is fp.PartialResponse
+        and not item.is_replace_response
+        and not item.is_suggested_reply
+        and item.data is None
+        and item.raw_response is None
+        and item.full_prompt is None
+        and item.request_id is None
+    ):
+        return item.text
+    return None
+
+async def iterate_sync(items: Iterable[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
+
+_END = object()
+
+async def coalesce_responses(items: AsyncIterator[Any], coalescing: StreamCoalescing) -> AsyncIterator[Response]:
+    # The handler is advanced by one pump task, the response task sends merged text when max_delay is up even
+    # if the handler is still waiting. The 1-slot queue keeps the pump at most one item ahead, a slow client
+    # slows down the bot instead of growing a buffer.
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Tuple[Any, Optional[BaseException]]]" = asyncio.Queue(1)
+
+    async def pump() -> None:
+        try:
+            async for item in items:
+                await queue.put((item, None))
+            await queue.put((_END, None))
+        except Exception as e:
+            await queue.put((_END, e))
+        finally:
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    pump_task = asyncio.ensure_future(pump())
+    getter: "Optional[asyncio.Future[Tuple[Any, Optional[BaseException]]]]" = None
+    buffer: List[str] = []
+    size = 0
+    flush_at = 0.0
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            if buffer:
+                done, _ = await asyncio.wait([getter], timeout=max(0.0, flush_at - loop.time()))
+                if not done:
+                    yield fp.PartialResponse(text="".join(buffer))
+                    buffer.clear()
+                    size = 0
+                    continue
+            item, error = await getter
+            getter = None
+            if item is _END:
+                if buffer:
+                    yield fp.PartialResponse(text="".join(buffer))
+                if error is not None:
+                    raise error
+                return
+
+            text = mergeable_text(item)
+            if text is None:
+                if buffer:
+                    yield fp.PartialResponse(text="".join(buffer))
+                    buffer.clear()
+                    size = 0
+                yield normalize_response(item)
+                continue
+            if not text:
+                continue
+            if not buffer:
+                flush_at = loop.time() + coalescing.max_delay
+            buffer.append(text)
+            size += len(text)
+            if size >= coalescing.max_size:
+                yield fp.PartialResponse(text="".join(buffer))
+                buffer.clear()
+                size = 0
+    finally:
+        if getter is not None:
+            getter.cancel()
+        # the handler is closed by the pump, in the task that advanced it
+        pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+
+async def normalize_responses(items: AsyncIterator[Any], coalescing: Optional[StreamCoalescing] = None) -> AsyncIterator[Response]:
+    if coalescing is not None:
+        async for response in coalesce_responses(items, coalescing):
+            yield response
+        return
+    try:
+        async for item in items:
+            yield normalize_response(item)
+    finally:
+        aclose = getattr(items, "aclose", None)
+        if aclose is not None:
+            await aclose()
\ No newline at end of file
@@ -0,0 +1,32 @@
+from typing import Callable, Dict, List, Union
+import fastapi_poe as fp
+import httpx
+from poe_bot_but_better.client import HttpClientConfig, HttpClientPool
+
+# No test framework imports, used by the tests and by the benchmark
+
+class StubPoeServer:
+    """
+    Local stand-in for the Poe bot query API, serves fastapi_poe bots over an in-process transport.
+    Responses are a string, list of strings or a callable taking the QueryRequest.
+    """
+    base_url = "http://stub-poe/bot/"
+
+    def __init__(self, bots: Dict[str, Union[str, List[str], Callable]]):
+        self.requests: Dict[str, List[fp.QueryRequest]] = {bot_name: [] for bot_name in bots}
+        self.app = fp.make_app([self._create_bot(bot_name, responses) for bot_name, responses in bots.items()], allow_without_key=True)
+
+    def _create_bot(self, bot_name: str, responses: Union[str, List[str], Callable]) -> fp.PoeBot:
+        requests = self.requests[bot_name]
+
+        class StubBot(fp.PoeBot):
+            async def get_response(self, request: fp.QueryRequest):
+                requests.append(request)
+                parts = responses(request) if callable(responses) else responses
+                for part in [parts] if isinstance(parts, str) else parts:
+                    yield fp.PartialResponse(text=part)
+
+        return StubBot(path=f"/bot/{bot_name}")
+
+    def pool(self, **config) -> HttpClientPool:
+        return HttpClientPool(HttpClientConfig(base_url=self.base_url, transport=httpx.ASGITransport(app=self.app), **config))
\ No newline at end of file
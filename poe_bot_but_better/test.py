@@ -1,11 +1,12 @@
 import pytest
 import fastapi_poe as fp
-from typing import Any, AsyncGenerator, Callable, List, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Union
 from dataclasses import dataclass, field
 import uuid
 
 import sse_starlette
 from poe_bot_but_better import normalize_request, solve_dependencies, RequestOrMessage
+from poe_bot_but_better.stub_server import StubPoeServer
 from unittest.mock import AsyncMock, MagicMock
 
 class PoeBotTestError(Exception):
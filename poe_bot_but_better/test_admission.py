@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+import fastapi_poe as fp
+from .admission import AdmissionControl, AdmissionRejected, Limiter
+from .client import create_stream_request, normalize_request
+from .decorator import poe_bot_but_better
+from .stub_server import StubPoeServer
+from .test import mock_query_request
+
+def query_request(user_id):
+    return normalize_request(mock_query_request, "Hello").model_copy(update={"user_id": user_id})
+
+@pytest.mark.asyncio
+async def test_limiter_queue_and_rejection():
+    limiter = Limiter(1, max_queue=1, queue_timeout=0.05)
+    await limiter.acquire("bot")
+    waiter = asyncio.ensure_future(limiter.acquire("bot"))
+    await asyncio.sleep(0)
+
+    # the queue is full
+    with pytest.raises(AdmissionRejected) as rejected:
+        await limiter.acquire("bot")
+    assert rejected.value.reason == "queue_full"
+
+    limiter.release()
+    await waiter
+    assert limiter.in_flight == 1
+
+    # waited longer than the deadline
+    with pytest.raises(AdmissionRejected) as rejected:
+        await limiter.acquire("bot")
+    assert rejected.value.reason == "queue_timeout"
+
+@pytest.mark.asyncio
+async def test_per_user_limit():
+    admission = AdmissionControl(max_in_flight_per_user=1, max_queue=0)
+    release = await admission.admit("alice")
+    with pytest.raises(AdmissionRejected):
+        await admission.admit("alice")
+    # other users aren't affected
+    (await admission.admit("bob"))()
+    release()
+    (await admission.admit("alice"))()
+    assert len(admission._users) == 0
+
+@pytest.mark.asyncio
+async def test_busy_bot_answers_with_error_response():
+    started, finish = asyncio.Event(), asyncio.Event()
+
+    @poe_bot_but_better
+    class SlowBot:
+        admission_control = AdmissionControl(max_in_flight=1, max_queue=0)
+
+        async def get_response(self):
+            started.set()
+            await finish.wait()
+            return "done"
+
+    bot = SlowBot()
+    first = asyncio.ensure_future(_collect(bot.get_response(query_request("alice"))))
+    await started.wait()
+    rejected = await _collect(bot.get_response(query_request("bob")))
+    assert isinstance(rejected[0], fp.ErrorResponse) and rejected[0].allow_retry
+
+    finish.set()
+    assert [r.text for r in await first] == ["done"]
+    # the slot is released with the response
+    assert (await _collect(bot.get_response(query_request("bob"))))[0].text == "done"
+
+async def _collect(responses):
+    return [response async for response in responses]
+
+@pytest.mark.asyncio
+async def test_calls_per_target_bot_are_limited():
+    stub = StubPoeServer({"Upstream": "ok"})
+    admission = AdmissionControl(max_calls_per_bot=2)
+    stream_request = create_stream_request(query_request("alice"), stub.pool(), admission=admission)
+
+    # slots in use of the target bot while each call streams
+    in_flight = []
+
+    async def call():
+        async for message in stream_request("Hi", "Upstream"):
+            in_flight.append(admission._bots._limiters["Upstream"].in_flight)
+        return message.text
+
+    assert await asyncio.gather(*[call() for _ in range(5)]) == ["ok"] * 5
+    assert max(in_flight) <= 2
+    assert len(admission._bots) == 0
\ No newline at end of file
@@ -0,0 +1,78 @@
+from typing import Annotated
+import pytest
+import fastapi_poe as fp
+from fastapi.testclient import TestClient
+from poe_bot_but_better import Depends, make_app, make_host_app, poe_bot_but_better
+from poe_bot_but_better.app import add_metrics_route
+from poe_bot_but_better.dependency_injection import dependency_store
+from poe_bot_but_better.metrics import HistogramRegistry
+
+class Client:
+    closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+@poe_bot_but_better
+class ClientBot:
+    async def get_response(self, client: Annotated[Client, Depends(Client, scope="app")]):
+        return "closed" if client.closed else "open"
+
+@pytest.mark.asyncio
+async def test_app_scope_teardown_on_shutdown():
+    bot = ClientBot()
+    request = fp.QueryRequest(query=[fp.ProtocolMessage(role="user", content="Hello")], version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+    responses = [response async for response in bot.get_response(request)]
+    assert responses[0].text == "open"
+    client = dependency_store._app.instances[Client]
+
+    app = make_app(bot, allow_without_key=True)
+    with TestClient(app):
+        pass
+
+    assert client.closed is True
+    assert Client not in dependency_store._app.instances
+
+
+@poe_bot_but_better
+class NameBot:
+    async def get_response(self, bot_name):
+        return bot_name
+
+    async def get_settings(self):
+        return {"introduction_message": "Hi"}
+
+def test_host_routes_by_bot_name_and_path():
+    first = NameBot(bot_name="First", access_key="a" * 32)
+    second = NameBot(bot_name="Second", access_key="b" * 32, path="/custom")
+    app = make_host_app([first, second], sync_settings=False)
+    assert first.http_client_pool is second.http_client_pool
+
+    query = {"type": "query", "version": "1.0", "user_id": "u", "conversation_id": "c", "message_id": "m",
+             "query": [{"role": "user", "content": "Hi"}]}
+    with TestClient(app) as client:
+        for path in ("/first", "/First"):
+            response = client.post(path, json=query, headers={"Authorization": "Bearer " + "a" * 32})
+            assert '"text": "First"' in response.text
+        for path in ("/custom", "/second"):
+            response = client.post(path, json=query, headers={"Authorization": "Bearer " + "b" * 32})
+            assert '"text": "Second"' in response.text
+
+        # each bot checks its own key
+        assert client.post("/second", json=query, headers={"Authorization": "Bearer " + "a" * 32}).status_code == 401
+        assert client.post("/unknown", json=query).status_code == 404
+
+        settings = client.post("/first", json={"type": "settings", "version": "1.0"}, headers={"Authorization": "Bearer " + "a" * 32})
+        assert settings.json()["introduction_message"] == "Hi"
+
+def test_host_rejects_ambiguous_routes():
+    with pytest.raises(ValueError, match="same path"):
+        make_host_app([NameBot(bot_name="Same", access_key="a" * 32), NameBot(bot_name="same", access_key="b" * 32)])
+
+def test_host_keeps_other_routes_of_the_app():
+    app = make_host_app([NameBot(bot_name="First", access_key="a" * 32)], sync_settings=False)
+    add_metrics_route(app, HistogramRegistry())
+    with TestClient(app) as client:
+        assert client.get("/metrics").status_code == 200
+        assert client.get("/first").text == "First is running"
+        assert client.get("/unknown").status_code == 404
\ No newline at end of file
@@ -0,0 +1,131 @@
+import os
+import pytest
+import httpx
+import fastapi_poe as fp
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated
+from .attachments import AttachmentFetcher, AttachmentTooLargeError, AttachmentDownloadError, FetchAttachmentCallable, fetch_attachment
+from .client import HttpClientConfig, HttpClientPool
+from .decorator import poe_bot_but_better
+from .dependency_injection import Depends
+from .test import BotTestHelper
+
+def file_size(path):
+    # module level, pickled to the process pool
+    return os.path.getsize(path)
+
+class FileServer:
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        name = request.url.path.lstrip("/")
+        if name not in self.files:
+            return httpx.Response(404)
+        content = self.files[name]
+        etag = f'"{len(content)}-{hash(content)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, content=content, headers={"ETag": etag})
+
+    def pool(self):
+        return HttpClientPool(HttpClientConfig(transport=httpx.MockTransport(self.handle)))
+
+def attachment(name):
+    return fp.Attachment(url=f"https://files.test/{name}", content_type="application/pdf", name=name)
+
+@pytest.mark.asyncio
+async def test_fetch_to_temp_dir(tmp_path):
+    server = FileServer({"a.pdf": b"%PDF a"})
+    fetcher = AttachmentFetcher(pool=server.pool())
+    fetched = await fetcher.fetch(attachment("a.pdf"), temp_dir=str(tmp_path))
+    assert fetched.name == "a.pdf"
+    assert fetched.size == 6
+    assert os.path.dirname(fetched.path) == str(tmp_path)
+    assert fetched.read() == b"%PDF a"
+    with fetched.buffer() as buffer:
+        assert bytes(buffer[:4]) == b"%PDF"
+
+@pytest.mark.asyncio
+async def test_size_limit(tmp_path):
+    server = FileServer({"big.pdf": b"x" * 100})
+    fetcher = AttachmentFetcher(pool=server.pool(), max_bytes=10, chunk_size=4)
+    with pytest.raises(AttachmentTooLargeError):
+        await fetcher.fetch(attachment("big.pdf"), temp_dir=str(tmp_path))
+    # the partial download is removed
+    assert os.listdir(tmp_path) == []
+
+@pytest.mark.asyncio
+async def test_download_error(tmp_path):
+    fetcher = AttachmentFetcher(pool=FileServer({}).pool())
+    with pytest.raises(AttachmentDownloadError):
+        await fetcher.fetch(attachment("missing.pdf"), temp_dir=str(tmp_path))
+
+@pytest.mark.asyncio
+async def test_cache_revalidates_with_etag(tmp_path):
+    server = FileServer({"a.pdf": b"%PDF a", "copy.pdf": b"%PDF a"})
+    fetcher = AttachmentFetcher(cache_dir=str(tmp_path), pool=server.pool())
+    temp_dir = fetcher.make_temp_dir()
+    first = await fetcher.fetch(attachment("a.pdf"), temp_dir)
+    second = await fetcher.fetch(attachment("a.pdf"), fetcher.make_temp_dir())
+    assert os.path.samefile(first.path, second.path)
+    assert server.requests[1].headers["If-None-Match"]
+
+    # stored by content, the same file under another url is one object
+    copy = await fetcher.fetch(attachment("copy.pdf"), temp_dir)
+    assert copy.path == first.path
+    assert os.listdir(tmp_path / "objects") == [first.sha256]
+
+    server.files["a.pdf"] = b"%PDF changed"
+    changed = await fetcher.fetch(attachment("a.pdf"), temp_dir)
+    assert changed.read() == b"%PDF changed"
+
+@pytest.mark.asyncio
+async def test_pruning_keeps_files_of_running_requests(tmp_path):
+    server = FileServer({"a.pdf": b"a" * 10, "b.pdf": b"b" * 10})
+    fetcher = AttachmentFetcher(cache_dir=str(tmp_path), pool=server.pool(), max_cache_bytes=15)
+    a = await fetcher.fetch(attachment("a.pdf"), fetcher.make_temp_dir())
+    b = await fetcher.fetch(attachment("b.pdf"), fetcher.make_temp_dir())
+    assert os.listdir(tmp_path / "objects") == [b.sha256]
+    # the request that fetched a.pdf still reads its own link
+    assert a.read() == b"a" * 10
+    with a.buffer() as buffer:
+        assert bytes(buffer[:1]) == b"a"
+
+@pytest.mark.asyncio
+async def test_parse_in_process_pool(tmp_path):
+    server = FileServer({"a.pdf": b"%PDF a"})
+    fetcher = AttachmentFetcher(pool=server.pool(), max_workers=1)
+    try:
+        fetched = await fetcher.fetch(attachment("a.pdf"), temp_dir=str(tmp_path))
+        assert await fetcher.parse(file_size, fetched) == 6
+    finally:
+        fetcher.close()
+
+@pytest.mark.asyncio
+async def test_fetch_attachment_dependency(bot_helper: BotTestHelper, tmp_path):
+    server = FileServer({"a.pdf": b"%PDF a"})
+    fetcher = AttachmentFetcher(pool=server.pool(), parse_executor=ThreadPoolExecutor(1))
+    paths = []
+
+    @poe_bot_but_better
+    class SizeBot:
+        async def get_response(self, fetch: Annotated[FetchAttachmentCallable, Depends(fetch_attachment)]):
+            fetched = await fetch(attachment("a.pdf"))
+            paths.append(fetched.path)
+            return f"{await fetcher.parse(file_size, fetched)} bytes"
+
+    override = {"attachment_fetcher": fetcher}
+    assert await bot_helper.send_message(SizeBot, "Hi", dependency_injection_context_override=override) == "6 bytes"
+    # the temp directory of the request is removed with the response
+    assert not os.path.exists(os.path.dirname(paths[0]))
+
+    # cached, the object stays in the cache
+    cached = AttachmentFetcher(cache_dir=str(tmp_path), pool=server.pool(), parse_executor=ThreadPoolExecutor(1))
+    override = {"attachment_fetcher": cached}
+    fetcher = cached
+    assert await bot_helper.send_message(SizeBot, "Hi", dependency_injection_context_override=override) == "6 bytes"
+    assert not os.path.exists(paths[1])
+    assert os.listdir(tmp_path / "objects") == [os.path.basename(paths[1])]
\ No newline at end of file
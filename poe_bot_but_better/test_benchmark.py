@@ -0,0 +1,22 @@
+import json
+import pytest
+from .benchmark import BenchmarkResult, main, regressions, run_benchmarks
+
+@pytest.mark.asyncio
+async def test_benchmarks_run():
+    results = await run_benchmarks(iterations=2)
+    names = [result.name for result in results]
+    assert "get_response sync generator" in names
+    assert "sse end to end (100 chunks)" in names
+    assert all(result.median_us > 0 for result in results)
+
+def test_compare_flags_regressions(tmp_path):
+    baseline = {"fast": BenchmarkResult("fast", 10, 1.0, 1.0, 1.0, 0.0, 0.0)}
+    slower = BenchmarkResult("fast", 10, 2.0, 2.0, 2.0, 0.0, 0.0)
+    assert regressions([slower], baseline, threshold=1.25) == ["fast"]
+    assert regressions([slower], baseline, threshold=3) == []
+
+    path = tmp_path / "results.json"
+    assert main(["--iterations", "2", "--filter", "normalize_response", "--json", str(path)]) == 0
+    assert [result["name"] for result in json.loads(path.read_text())] == ["normalize_response str", "normalize_response partial"]
+    assert main(["--iterations", "2", "--filter", "normalize_response", "--compare", str(path), "--threshold", "1000"]) == 0
\ No newline at end of file
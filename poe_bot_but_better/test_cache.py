@@ -0,0 +1,59 @@
+import pytest
+from poe_bot_but_better.cache import CHUNK_OVERHEAD, CacheBackend, MemoryCacheBackend, SqliteCacheBackend
+
+@pytest.fixture(params=["memory", "sqlite"])
+def create_backend(request, tmp_path):
+    def create(**kwargs):
+        if request.param == "memory":
+            return MemoryCacheBackend(**kwargs)
+        return SqliteCacheBackend(str(tmp_path / "cache.sqlite"), **kwargs)
+    return create
+
+@pytest.mark.asyncio
+async def test_get_set(create_backend):
+    backend = create_backend()
+    assert await backend.get("key") is None
+    await backend.set("key", [("Hello", False, False), ("Hi", False, True)])
+    assert await backend.get("key") == [("Hello", False, False), ("Hi", False, True)]
+    await backend.delete("key")
+    assert await backend.get("key") is None
+
+@pytest.mark.asyncio
+async def test_lru_eviction(create_backend):
+    backend = create_backend(max_entries=2)
+    await backend.set("a", [("a", False, False)])
+    await backend.set("b", [("b", False, False)])
+    await backend.get("a")  # a is now most recently used
+    await backend.set("c", [("c", False, False)])
+
+    assert await backend.get("a") is not None
+    assert await backend.get("b") is None
+    assert await backend.get("c") is not None
+
+@pytest.mark.asyncio
+async def test_memory_budget(create_backend):
+    backend = create_backend(max_bytes=2 * (10 + CHUNK_OVERHEAD))
+    await backend.set("a", [("x" * 10, False, False)])
+    await backend.set("b", [("x" * 10, False, False)])
+    await backend.set("c", [("x" * 10, False, False)])
+    assert await backend.get("a") is None
+    assert await backend.get("c") is not None
+
+    # larger than the whole budget, never stored
+    await backend.set("huge", [("x" * 1000, False, False)])
+    assert await backend.get("huge") is None
+
+@pytest.mark.asyncio
+async def test_ttl(create_backend):
+    backend = create_backend(ttl=-1)
+    await backend.set("a", [("a", False, False)])
+    assert await backend.get("a") is None
+
+
+def test_incomplete_backend_fails_when_created():
+    class GetOnlyBackend(CacheBackend):
+        async def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyBackend()
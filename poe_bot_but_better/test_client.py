@@ -1,9 +1,13 @@
 import pytest
 import fastapi_poe as fp
-from typing import List
 import asyncio
 
-from poe_bot_but_better.client import create_get_final_response, create_stream_request, normalize_request
+import httpx
+
+from poe_bot_but_better.cache import ResponseCache, request_cache_key
+from poe_bot_but_better.client import HttpClientConfig, create_cached_get_final_response, create_cached_stream_request, create_get_final_response, create_http_client, create_stream_request, normalize_request
+from poe_bot_but_better.stub_server import StubPoeServer
+from poe_bot_but_better.test import mock_query_request
 
 def test_normalize_request_string():
     # Create a sample original request
@@ -43,17 +47,18 @@ async def test_create_get_final_response():
     # Create the wrapped function
     get_final_response = create_get_final_response(original_request)
     
-    # Mock the fastapi_poe.get_final_response function
-    async def mock_get_final_response(*args, **kwargs):
+    # Mock the fastapi_poe.stream_request function, the response is assembled from its messages (retries happen per stream)
+    async def mock_stream_request(*args, **kwargs):
         # Verify the access key was passed correctly
         assert kwargs['api_key'] == original_request.access_key
         # Verify the request was normalized
         assert isinstance(kwargs['request'], fp.QueryRequest)
-        return "Mock response"
+        yield fp.PartialResponse(text="Mock ")
+        yield fp.PartialResponse(text="response")
     
     # Temporarily replace the original function with our mock
-    original_func = fp.get_final_response
-    fp.get_final_response = mock_get_final_response
+    original_func = fp.stream_request
+    fp.stream_request = mock_stream_request
     
     try:
         # Test the wrapper
@@ -65,7 +70,7 @@ async def test_create_get_final_response():
         
     finally:
         # Restore the original function
-        fp.get_final_response = original_func
+        fp.stream_request = original_func
 
 @pytest.mark.asyncio
 async def test_create_stream_request():
@@ -118,4 +123,112 @@ async def test_create_stream_request():
             
     finally:
         # Restore the original function
-        fp.stream_request = original_func
\ No newline at end of file
+        fp.stream_request = original_func
+@pytest.mark.asyncio
+async def test_pooled_client_against_stub_server():
+    server = StubPoeServer({"GPT-4": ["Hello", " World"], "Claude": lambda request: request.query[-1].content.upper()})
+    pool = server.pool()
+    original_request = fp.QueryRequest(
+        query=[],
+        version="1.0",
+        type="query",
+        user_id="test_user",
+        conversation_id="test_conv",
+        message_id="test_msg",
+        access_key="test_key"
+    )
+
+    get_final_response = create_get_final_response(original_request, pool)
+    stream_request = create_stream_request(original_request, pool)
+
+    assert await get_final_response("Hi", "GPT-4") == "Hello World"
+    assert [message.text async for message in stream_request("shout", "Claude")] == ["SHOUT"]
+    assert server.requests["GPT-4"][0].query[0].content == "Hi"
+
+    # one client reused for every call on this loop
+    assert pool.get() is pool.get()
+    await pool.aclose()
+
+@pytest.mark.asyncio
+async def test_configure_closes_current_clients():
+    pool = StubPoeServer({}).pool()
+    client = pool.get()
+    pool.configure(HttpClientConfig(base_url=pool.config.base_url, transport=pool.config.transport))
+    # closed on its loop soon after
+    await asyncio.sleep(0.01)
+    assert client.is_closed
+    assert pool.get() is not client
+
+@pytest.mark.asyncio
+async def test_max_connections_per_host():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, text="ok")
+
+    client = create_http_client(HttpClientConfig(transport=httpx.MockTransport(handler), max_connections_per_host=2))
+    async with client:
+        responses = await asyncio.gather(*(client.get("http://poe.test/") for _ in range(6)))
+
+    assert all(response.text == "ok" for response in responses)
+    assert max_in_flight == 2
+
+@pytest.mark.asyncio
+async def test_cached_stream_request_replays_chunks():
+    calls = 0
+
+    async def stream_request(request_or_message, bot_name):
+        nonlocal calls
+        calls += 1
+        yield fp.PartialResponse(text="Hello")
+        yield fp.PartialResponse(text=" World")
+        yield fp.PartialResponse(text="More", is_suggested_reply=True)
+
+    async def get_final_response(request_or_message, bot_name):
+        raise AssertionError("should be served from the stream recording")
+
+    cache = ResponseCache()
+    stream_request_cached = create_cached_stream_request(mock_query_request, stream_request, cache)
+    get_final_response_cached = create_cached_get_final_response(mock_query_request, get_final_response, cache)
+
+    first = [(m.text, m.is_suggested_reply) async for m in stream_request_cached("Hi", "GPT-4")]
+    second = [(m.text, m.is_suggested_reply) async for m in stream_request_cached("Hi", "GPT-4")]
+    assert first == second == [("Hello", False), (" World", False), ("More", True)]
+    assert calls == 1
+
+    assert await get_final_response_cached("Hi", "GPT-4") == "Hello World"
+
+@pytest.mark.asyncio
+async def test_cached_stream_request_not_stored_on_early_exit():
+    cancelled = False
+
+    async def stream_request(request_or_message, bot_name):
+        nonlocal cancelled
+        yield fp.PartialResponse(text="Hello")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        yield fp.PartialResponse(text=" World")
+
+    cache = ResponseCache()
+    stream = create_cached_stream_request(mock_query_request, stream_request, cache)("Hi", "GPT-4")
+    assert (await stream.__anext__()).text == "Hello"
+    await stream.aclose()
+    await asyncio.sleep(0)
+
+    assert cancelled is True
+    assert await cache.get(cache.key(normalize_request(mock_query_request, "Hi"), "GPT-4")) is None
+
+def test_cache_key_ignores_ids():
+    first = normalize_request(mock_query_request, "Hi")
+    second = first.model_copy(update={"message_id": "other", "user_id": "other"})
+    assert request_cache_key(first, "GPT-4") == request_cache_key(second, "GPT-4")
+    assert request_cache_key(first, "GPT-4") != request_cache_key(first, "Claude")
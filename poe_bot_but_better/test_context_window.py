@@ -0,0 +1,76 @@
+import pytest
+import fastapi_poe as fp
+from typing import Annotated
+from .context_window import ContextWindow, create_windowed_get_final_response, estimate_tokens
+from .decorator import poe_bot_but_better
+from .dependency_injection import Depends
+from .test import BotTestHelper
+
+def message(role, content):
+    return fp.ProtocolMessage(role=role, content=content)
+
+# 10 tokens each with the overhead
+history = [message("system", "s" * 24)] + [message("user" if i % 2 == 0 else "bot", str(i) * 24) for i in range(9)]
+
+def contents(messages):
+    return [m.content[0] for m in messages]
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("日本語") == 3
+
+def test_fit_keeps_system_prompt_and_newest_turns():
+    window = ContextWindow(budgets={"Small": 40}, default_budget=None)
+    assert contents(window.fit(history, "Small")) == ["s", "6", "7", "8"]
+    assert contents(window.fit(history, "Unlimited")) == contents(history)
+
+def test_fit_keeps_system_messages_in_the_middle_and_last_message():
+    messages = [message("user", "a" * 24), message("system", "b" * 24), message("user", "c" * 24), message("user", "d" * 400)]
+    window = ContextWindow(default_budget=30)
+    assert contents(window.fit(messages, "Bot")) == ["b", "d"]
+
+def test_counts_are_memoized():
+    calls = []
+
+    def count_tokens(text):
+        calls.append(text)
+        return len(text)
+
+    window = ContextWindow(default_budget=1000, count_tokens=count_tokens)
+    window.fit(history, "Bot")
+    # the next turn arrives as new objects with the same content
+    window.fit([message(m.role, m.content) for m in history] + [message("user", "new")], "Bot")
+    assert len(calls) == len(history) + 1
+
+    # memoized by a digest of the content, texts of the same length keep their own counts
+    window = ContextWindow(count_tokens=lambda text: text.count("a"))
+    assert window.message_tokens(message("user", "aaaa")) != window.message_tokens(message("user", "bbbb"))
+    assert all(len(digest) == 16 for digest, _ in window._counts)
+
+def test_fit_request_keeps_request_fields():
+    request = fp.QueryRequest(
+        query=history, version="1", type="query", user_id="u", conversation_id="c", message_id="m", temperature=0.5
+    )
+    fitted = ContextWindow(default_budget=30).fit_request(request, "Bot")
+    assert contents(fitted.query) == ["s", "7", "8"]
+    assert fitted.temperature == 0.5
+    assert ContextWindow().fit_request(request, "Bot") is request
+
+@pytest.mark.asyncio
+async def test_windowed_get_final_response(bot_helper: BotTestHelper):
+    @poe_bot_but_better
+    class ForwardBot:
+        async def get_response(
+            self,
+            messages,
+            get_final_response_windowed: Annotated[object, Depends(create_windowed_get_final_response)],
+        ):
+            return await get_final_response_windowed(messages, "Small")
+
+    mock = bot_helper.mock_bot("Small", lambda request: [str(len(request.query))])
+    response = await bot_helper.send_message(
+        ForwardBot, history, dependency_injection_context_override={"context_window": ContextWindow(budgets={"Small": 40})}
+    )
+    assert response == "4"
+    mock.assert_called_once()
\ No newline at end of file
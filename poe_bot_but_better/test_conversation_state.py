@@ -0,0 +1,102 @@
+import pytest
+import fastapi_poe as fp
+from typing import Annotated
+from .conversation_state import ConversationState, ConversationStore, MemoryConversationStore, SqliteConversationStore, conversation_state
+from .decorator import poe_bot_but_better
+from .dependency_injection import Depends
+from .test import BotTestHelper
+
+def message(role, content, message_id=""):
+    return fp.ProtocolMessage(role=role, content=content, message_id=message_id)
+
+@pytest.fixture(params=["memory", "sqlite"])
+def create_store(request, tmp_path):
+    def create(**kwargs):
+        if request.param == "memory":
+            return MemoryConversationStore(**kwargs)
+        return SqliteConversationStore(str(tmp_path / "state.sqlite"), **kwargs)
+    return create
+
+@pytest.mark.asyncio
+async def test_load_save(create_store):
+    store = create_store()
+    assert await store.load("c1") is None
+    await store.save(ConversationState("c1", {"summary": "Hi"}, 2, "m2"))
+    assert await store.load("c1") == ConversationState("c1", {"summary": "Hi"}, 2, "m2")
+    await store.delete("c1")
+    assert await store.load("c1") is None
+
+@pytest.mark.asyncio
+async def test_lru_eviction(create_store):
+    store = create_store(max_conversations=2)
+    for conversation_id in ("a", "b", "c"):
+        await store.save(ConversationState(conversation_id))
+    assert await store.load("a") is None
+    assert await store.load("c") is not None
+
+@pytest.mark.asyncio
+async def test_ttl(create_store):
+    store = create_store(ttl=-1)
+    await store.save(ConversationState("c1"))
+    assert await store.load("c1") is None
+
+@pytest.mark.asyncio
+async def test_session_saves_only_on_success(create_store):
+    store = create_store()
+    async with store.session("c1") as state:
+        state.data["turns"] = 1
+
+    with pytest.raises(ValueError):
+        async with store.session("c1") as state:
+            state.data["turns"] = 2
+            raise ValueError()
+
+    # the memory store hands out the stored state, a failed turn drops it instead of keeping it half updated
+    stored = await store.load("c1")
+    assert stored is None if isinstance(store, MemoryConversationStore) else stored.data == {"turns": 1}
+
+def test_new_messages():
+    history = [message("user", "a", "m1"), message("bot", "b", "m2")]
+    state = ConversationState("c1")
+    assert list(state.new_messages(history)) == history
+    state.mark_processed(history)
+
+    history = history + [message("user", "c", "m3")]
+    assert [m.content for m in state.new_messages(history)] == ["c"]
+
+def test_new_messages_resets_on_changed_history():
+    state = ConversationState("c1", {"summary": "a b"})
+    state.mark_processed([message("user", "a"), message("bot", "b")])
+
+    # the bot message was regenerated
+    history = [message("user", "a"), message("bot", "other"), message("user", "c")]
+    assert len(state.new_messages(history)) == 3
+    assert state.data == {}
+
+@pytest.mark.asyncio
+async def test_bot_processes_only_new_messages(bot_helper: BotTestHelper):
+    seen = []
+
+    @poe_bot_but_better
+    class SummaryBot:
+        async def get_response(self, request, state: Annotated[ConversationState, Depends(conversation_state)]):
+            for m in state.new_messages(request.query):
+                seen.append(m.content)
+                state.data["count"] = state.data.get("count", 0) + 1
+            state.mark_processed(request.query)
+            return f"{state.data['count']} messages"
+
+    override = {"conversation_store": MemoryConversationStore()}
+    first = [message("user", "Hello", "m1")]
+    assert await bot_helper.send_message(SummaryBot, first, dependency_injection_context_override=override) == "1 messages"
+    second = first + [message("bot", "1 messages", "m2"), message("user", "Again", "m3")]
+    assert await bot_helper.send_message(SummaryBot, second, dependency_injection_context_override=override) == "3 messages"
+    assert seen == ["Hello", "1 messages", "Again"]
+
+def test_incomplete_store_fails_when_created():
+    class LoadOnlyStore(ConversationStore):
+        async def load(self, conversation_id):
+            return None
+
+    with pytest.raises(TypeError):
+        LoadOnlyStore()
@@ -1,7 +1,12 @@
+import asyncio
 import pytest
 import fastapi_poe as fp
-from typing import AsyncIterable
+from typing import Annotated, AsyncIterable
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from . import decorator
 from .decorator import poe_bot_but_better  # adjust import path as needed
+from .dependency_injection import DependencyCycleError, Depends
 
 # Mock messages for testing
 mock_message = fp.ProtocolMessage(role="user", content="Hello, world!")
@@ -118,4 +123,187 @@ async def test_error_handling():
     
     with pytest.raises(ValueError):
         async for _ in bot.get_response(request):
-            pass
\ No newline at end of file
+            pass
+
+@pytest.mark.asyncio
+async def test_generator_dependency_cleanup_after_stream():
+    events = []
+
+    async def acquire_slot():
+        events.append("acquire")
+        yield "slot"
+        events.append("release")
+
+    @poe_bot_but_better
+    class SlotBot:
+        async def get_response(self, slot: Annotated[str, Depends(acquire_slot)]):
+            yield "first"
+            events.append("streaming")
+            yield "second"
+
+    request = fp.QueryRequest(query=mock_messages, version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+    responses = [response.text async for response in SlotBot().get_response(request)]
+
+    assert responses == ["first", "second"]
+    assert events == ["acquire", "streaming", "release"]
+
+@pytest.mark.asyncio
+async def test_generator_dependency_cleanup_on_disconnect():
+    events = []
+    streaming = asyncio.Event()
+
+    def acquire_slot():
+        events.append("acquire")
+        try:
+            yield "slot"
+        finally:
+            events.append("release")
+
+    @poe_bot_but_better
+    class SlowBot:
+        async def get_response(self, slot: Annotated[str, Depends(acquire_slot)]):
+            yield "first"
+            streaming.set()
+            await asyncio.sleep(10)
+            yield "never"
+
+    request = fp.QueryRequest(query=mock_messages, version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+
+    async def consume():
+        async for _ in SlowBot().get_response(request):
+            pass
+
+    task = asyncio.create_task(consume())
+    await streaming.wait()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0)
+
+    assert events == ["acquire", "release"]
+
+def test_dependency_cycle_fails_at_decoration():
+    depends_on_second = Depends()
+
+    def first(value: Annotated[int, depends_on_second]):
+        return value
+
+    def second(value: Annotated[int, Depends(first)]):
+        return value
+
+    depends_on_second.dependency = second
+    depends_on_second.is_default = False
+
+    with pytest.raises(DependencyCycleError):
+        @poe_bot_but_better
+        class CycleBot:
+            async def get_response(self, value: Annotated[int, Depends(first)]):
+                return str(value)
+
+@pytest.mark.asyncio
+async def test_context_entries_are_built_on_demand(monkeypatch):
+    built = []
+    monkeypatch.setattr(decorator, "create_get_final_response", lambda *args: built.append("get_final_response"))
+    monkeypatch.setattr(decorator, "create_stream_request", lambda *args: built.append("stream_request"))
+
+    @poe_bot_but_better
+    class MessagesBot:
+        async def get_response(self, messages):
+            return messages[-1].content
+
+    @poe_bot_but_better
+    class StreamBot:
+        async def get_response(self, stream_request):
+            return "ok"
+
+    request = fp.QueryRequest(query=mock_messages, version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+    assert [r.text async for r in MessagesBot().get_response(request)] == [mock_messages[-1].content]
+    assert built == []
+    assert [r.text async for r in StreamBot().get_response(request)] == ["ok"]
+    assert built == ["stream_request"]
+
+@pytest.mark.asyncio
+async def test_bot_calls_stay_disabled_in_sync_get_response():
+    @poe_bot_but_better
+    class SyncBot:
+        run_sync_inline = True
+
+        def get_response(self, get_final_response):
+            get_final_response("Hi", "Assistant")
+
+    bot = SyncBot()
+    bot.dependency_injection_context_override = {"get_final_response": lambda *args: "overridden"}
+    request = fp.QueryRequest(query=mock_messages, version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+    with pytest.raises(Exception, match="disabled in sync get_response"):
+        async for _ in bot.get_response(request):
+            pass
+
+@pytest.mark.asyncio
+async def test_attachment_queue_uploads_while_text_streams(monkeypatch):
+    events = []
+    release = asyncio.Event()
+
+    def create_post_message_attachment(bot, request, pool):
+        async def post_message_attachment(file_data=None, filename=None, **kwargs):
+            events.append(f"start {filename}")
+            await release.wait()
+            if filename == "broken.png":
+                raise ValueError("upload failed")
+            events.append(f"done {filename}")
+            return fp.types.AttachmentUploadResponse(inline_ref=filename, attachment_url=None)
+        return post_message_attachment
+
+    monkeypatch.setattr(decorator, "create_post_message_attachment", create_post_message_attachment)
+
+    @poe_bot_but_better
+    class ImagesBot:
+        max_concurrent_attachments = 2
+
+        async def get_response(self, attachment_queue):
+            for name in ("a.png", "broken.png", "c.png"):
+                attachment_queue(file_data=b"png", filename=name)
+            await asyncio.sleep(0)
+            yield "text is not blocked"
+            release.set()
+
+    request = fp.QueryRequest(query=mock_messages, version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+    responses = []
+    async for response in ImagesBot().get_response(request):
+        responses.append(response)
+        events.append(type(response).__name__)
+
+    # two uploads at a time, the text is sent before they finish, the response waits for all of them
+    assert events[:3] == ["start a.png", "start broken.png", "PartialResponse"]
+    assert events[-1] == "ErrorResponse"
+    assert "done c.png" in events
+    assert responses[-1].text == "Failed to attach broken.png: upload failed"
+
+@pytest.mark.asyncio
+async def test_settings_are_computed_once():
+    calls = []
+
+    @poe_bot_but_better
+    class SettingsBot:
+        async def get_response(self):
+            return "ok"
+
+        def get_settings(self):
+            calls.append(1)
+            return {"introduction_message": f"Hi {len(calls)}"}
+
+    bot = SettingsBot()
+    request = fp.SettingsRequest(version="1", type="settings")
+    context = fp.types.RequestContext(http_request=Request({"type": "http"}))
+    first = await bot.handle_settings(request, context)
+    second = await bot.handle_settings(request, context)
+    assert first.body == second.body == JSONResponse(fp.SettingsResponse(introduction_message="Hi 1").model_dump()).body
+    assert (await bot.get_settings(request)).introduction_message == "Hi 1"
+    assert calls == [1]
+
+    bot.invalidate_settings()
+    assert (await bot.get_settings(request)).introduction_message == "Hi 2"
+    assert b"Hi 2" in (await bot.handle_settings(request, context)).body
+
+    SettingsBot.cache_settings = False
+    assert (await bot.get_settings(request)).introduction_message == "Hi 3"
+    assert b"Hi 4" in (await bot.handle_settings(request, context)).body
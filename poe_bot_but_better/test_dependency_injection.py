@@ -1,8 +1,13 @@
+import asyncio
+import gc
 import pytest
+import weakref
+from contextlib import AsyncExitStack
 from dataclasses import dataclass
+from types import SimpleNamespace
 from typing import Annotated
 
-from poe_bot_but_better.dependency_injection import Depends, solve_dependencies, solve_dependencies_sync
+from poe_bot_but_better.dependency_injection import DependencyCycleError, DependencyStore, Depends, LazyContext, _plans, compile_plan, solve_dependencies, solve_dependencies_sync
 
 @pytest.mark.asyncio
 async def test_basic_dependency():
@@ -124,4 +129,355 @@ def test_sync_wrapper():
         return value
 
     result = solve_dependencies_sync(target)
-    assert result["value"] == 42
\ No newline at end of file
+    assert result["value"] == 42
+
+def test_plan_is_compiled_once():
+    def get_value():
+        return 42
+
+    async def target(value: Annotated[int, Depends(get_value)]):
+        return value
+
+    plan = compile_plan(target)
+    assert compile_plan(target) is plan
+    assert plan.params[0].plan is compile_plan(get_value)
+
+def test_plan_registry_is_weak():
+    async def target(value: int = 1):
+        return value
+
+    compile_plan(target)
+    assert target in _plans
+
+    target_ref = weakref.ref(target)
+    del target
+    gc.collect()
+    assert target_ref() is None
+
+@pytest.mark.asyncio
+async def test_plan_resolves_per_context():
+    def get_value(multiplier):
+        return 21 * multiplier
+
+    async def target(value: Annotated[int, Depends(get_value)]):
+        return value
+
+    plan = compile_plan(target)
+    assert (await plan.solve({"multiplier": 2}))["value"] == 42
+    assert (await plan.solve({"multiplier": 1}))["value"] == 21
+    assert (await plan.solve({"value": 7}))["value"] == 7
+
+@pytest.mark.asyncio
+async def test_unresolvable_parameter():
+    async def target(value):
+        return value
+
+    with pytest.raises(ValueError, match="Cannot resolve dependency for parameter value"):
+        await solve_dependencies(target)
+
+@pytest.mark.asyncio
+async def test_app_scope():
+    store = DependencyStore()
+    call_count = 0
+
+    async def create_client():
+        nonlocal call_count
+        call_count += 1
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def target(client: Annotated[object, Depends(create_client, scope="app")]):
+        return client
+
+    # concurrent first access creates only one instance
+    results = await asyncio.gather(*(solve_dependencies(target, store=store) for _ in range(5)))
+    assert call_count == 1
+    assert len({id(result["client"]) for result in results}) == 1
+
+    await solve_dependencies(target, store=store)
+    assert call_count == 1
+
+@pytest.mark.asyncio
+async def test_singleton_dataclass():
+    store = DependencyStore()
+
+    @dataclass
+    class Config:
+        name: str = "test"
+
+    async def target(config: Annotated[Config, Depends(scope="singleton")]):
+        return config
+
+    first = await solve_dependencies(target, store=store)
+    second = await solve_dependencies(target, store=store)
+    assert first["config"] is second["config"]
+
+@pytest.mark.asyncio
+async def test_conversation_scope():
+    store = DependencyStore(max_conversations=1)
+    closed = []
+
+    class History:
+        def close(self):
+            closed.append(self)
+
+    async def target(history: Annotated[History, Depends(History, scope="conversation")]):
+        return history
+
+    def context(conversation_id):
+        return {"request": SimpleNamespace(conversation_id=conversation_id)}
+
+    first = await solve_dependencies(target, context("a"), store=store)
+    again = await solve_dependencies(target, context("a"), store=store)
+    assert first["history"] is again["history"]
+
+    # evicts conversation "a"
+    other = await solve_dependencies(target, context("b"), store=store)
+    assert other["history"] is not first["history"]
+    await asyncio.sleep(0)
+    assert closed == [first["history"]]
+
+    with pytest.raises(ValueError, match="requires a request with conversation_id"):
+        await solve_dependencies(target, store=store)
+
+@pytest.mark.asyncio
+async def test_failed_creation_is_retried():
+    store = DependencyStore()
+    attempts = 0
+
+    def create_value():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise RuntimeError("blip")
+        return 42
+
+    async def target(value: Annotated[int, Depends(create_value, scope="app")]):
+        return value
+
+    with pytest.raises(RuntimeError):
+        await solve_dependencies(target, store=store)
+    assert (await solve_dependencies(target, store=store))["value"] == 42
+
+@pytest.mark.asyncio
+async def test_store_teardown():
+    store = DependencyStore()
+
+    class Client:
+        closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    async def target(client: Annotated[Client, Depends(Client, scope="app")]):
+        return client
+
+    client = (await solve_dependencies(target, store=store))["client"]
+    await store.aclose()
+    assert client.closed is True
+    assert (await solve_dependencies(target, store=store))["client"] is not client
+
+def test_invalid_scope():
+    with pytest.raises(ValueError, match="Unknown dependency scope"):
+        Depends(scope="forever")
+    with pytest.raises(ValueError, match="use_cache=False"):
+        Depends(scope="app", use_cache=False)
+
+@pytest.mark.asyncio
+async def test_generator_dependencies():
+    events = []
+
+    def open_cursor():
+        events.append("open cursor")
+        yield "cursor"
+        events.append("close cursor")
+
+    async def lease_client():
+        events.append("lease client")
+        yield "client"
+        events.append("release client")
+
+    async def target(
+        cursor: Annotated[str, Depends(open_cursor)],
+        client: Annotated[str, Depends(lease_client)],
+    ):
+        return cursor, client
+
+    async with AsyncExitStack() as stack:
+        result = await solve_dependencies(target, stack=stack)
+        assert result == {"cursor": "cursor", "client": "client"}
+        assert events == ["open cursor", "lease client"]
+    assert events[2:] == ["release client", "close cursor"]
+
+@pytest.mark.asyncio
+async def test_generator_dependency_sees_error():
+    errors = []
+
+    async def lease_client():
+        try:
+            yield "client"
+        except RuntimeError as e:
+            errors.append(e)
+            raise
+
+    async def target(client: Annotated[str, Depends(lease_client)]):
+        return client
+
+    with pytest.raises(RuntimeError):
+        async with AsyncExitStack() as stack:
+            await solve_dependencies(target, stack=stack)
+            raise RuntimeError("handler failed")
+    assert len(errors) == 1
+
+@pytest.mark.asyncio
+async def test_generator_dependency_requires_stack():
+    def open_cursor():
+        yield "cursor"
+
+    async def target(cursor: Annotated[str, Depends(open_cursor)]):
+        return cursor
+
+    with pytest.raises(ValueError, match="can only be used with an exit stack"):
+        await solve_dependencies(target)
+
+@pytest.mark.asyncio
+async def test_app_scoped_generator_dependency():
+    store = DependencyStore()
+    events = []
+
+    async def create_pool():
+        events.append("open")
+        yield "pool"
+        events.append("close")
+
+    async def target(pool: Annotated[str, Depends(create_pool, scope="app")]):
+        return pool
+
+    async with AsyncExitStack() as stack:
+        await solve_dependencies(target, store=store, stack=stack)
+    async with AsyncExitStack() as stack:
+        await solve_dependencies(target, store=store, stack=stack)
+    assert events == ["open"]
+
+    await store.aclose()
+    assert events == ["open", "close"]
+
+def test_app_instances_of_a_closed_loop_are_recreated():
+    # e.g. created during fp.make_app's settings sync, which runs on its own asyncio.run loop
+    store = DependencyStore()
+
+    class Client:
+        closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    async def target(client: Annotated[Client, Depends(Client, scope="app")]):
+        return client
+
+    async def solve():
+        return (await solve_dependencies(target, store=store))["client"]
+
+    first = asyncio.run(solve())
+
+    async def serve():
+        client = await solve()
+        assert client is await solve()
+        await store.aclose()
+        return client
+
+    assert asyncio.run(serve()) is not first
+    assert first.closed
+
+@pytest.mark.asyncio
+async def test_shared_dependency_built_once_across_levels():
+    call_count = 0
+
+    async def get_session():
+        nonlocal call_count
+        call_count += 1
+        await asyncio.sleep(0.01)
+        return object()
+
+    async def get_users(session: Annotated[object, Depends(get_session)]):
+        return session
+
+    async def get_orders(session: Annotated[object, Depends(get_session)]):
+        return session
+
+    async def target(
+        users: Annotated[object, Depends(get_users)],
+        orders: Annotated[object, Depends(get_orders)],
+    ):
+        return users, orders
+
+    result = await solve_dependencies(target)
+    assert call_count == 1
+    assert result["users"] is result["orders"]
+
+@pytest.mark.asyncio
+async def test_independent_dependencies_run_concurrently():
+    async def slow_a():
+        await asyncio.sleep(0.05)
+        return "a"
+
+    async def slow_b():
+        await asyncio.sleep(0.05)
+        return "b"
+
+    async def combined(a: Annotated[str, Depends(slow_a)], b: Annotated[str, Depends(slow_b)]):
+        await asyncio.sleep(0.05)
+        return a + b
+
+    async def target(
+        value: Annotated[str, Depends(combined)],
+        other: Annotated[str, Depends(slow_a)],
+    ):
+        return value
+
+    start = asyncio.get_running_loop().time()
+    result = await solve_dependencies(target)
+    elapsed = asyncio.get_running_loop().time() - start
+
+    assert result == {"value": "ab", "other": "a"}
+    # longest path is two sleeps, not the sum of four
+    assert elapsed < 0.14
+
+def test_cycle_detection():
+    depends_on_b = Depends()
+
+    def a(value: Annotated[int, depends_on_b]):
+        return value
+
+    def b(value: Annotated[int, Depends(a)]):
+        return value
+
+    depends_on_b.dependency = b
+    depends_on_b.is_default = False
+
+    def target(value: Annotated[int, Depends(a)]):
+        return value
+
+    with pytest.raises(DependencyCycleError, match="a -> .*b -> .*a"):
+        compile_plan(target)
+
+@pytest.mark.asyncio
+async def test_lazy_context_builds_only_used_entries():
+    built = []
+
+    def factory(name):
+        def build(prefix):
+            built.append(name)
+            return prefix + name
+        return build
+
+    context = LazyContext({"used": factory("used"), "unused": factory("unused")}, ("lazy-",), {"plain": 1})
+
+    def target(plain: int, used: str):
+        return plain, used
+
+    assert await solve_dependencies(target, context) == {"plain": 1, "used": "lazy-used"}
+    assert await solve_dependencies(target, context) == {"plain": 1, "used": "lazy-used"}
+    assert built == ["used"]
+    assert "unused" in context and "missing" not in context
+    assert context.get("missing") is None
\ No newline at end of file
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+import pytest
+import fastapi_poe as fp
+from contextlib import AsyncExitStack
+from typing import Annotated
+from .decorator import poe_bot_but_better
+from .dependency_injection import Depends, solve_dependencies
+from .executor import SyncExecutor, inline, offload
+
+request = fp.QueryRequest(query=[], version="1", type="query", user_id="123", conversation_id="456", message_id="789")
+
+@pytest.mark.asyncio
+async def test_iterate_sync_generator():
+    threads = set()
+    closed = []
+
+    def numbers():
+        try:
+            for i in range(3):
+                threads.add(threading.get_ident())
+                yield i
+        finally:
+            closed.append(True)
+
+    executor = SyncExecutor(max_workers=1)
+    assert [i async for i in executor.iterate(numbers())] == [0, 1, 2]
+    assert threading.get_ident() not in threads
+    assert closed == [True]
+
+    items = executor.iterate(numbers())
+    assert await items.__anext__() == 0
+    await items.aclose()
+    assert closed == [True, True]
+    executor.shutdown()
+
+@pytest.mark.asyncio
+async def test_response_is_cancelled_mid_step():
+    stepping = threading.Event()
+    closed = []
+
+    @poe_bot_but_better
+    class SlowStreamBot:
+        def get_response(self):
+            try:
+                yield "a"
+                stepping.set()
+                time.sleep(0.1)
+                yield "b"
+            finally:
+                closed.append(True)
+
+    async def consume():
+        responses = SlowStreamBot().get_response(request)
+        try:
+            async for _ in responses:
+                pass
+        finally:
+            await responses.aclose()
+
+    # e.g. the client disconnects while the handler runs in a thread
+    task = asyncio.ensure_future(consume())
+    await asyncio.to_thread(stepping.wait)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # closed once the step finished
+    assert closed == [True]
+
+@pytest.mark.asyncio
+async def test_slow_sync_handler_doesnt_block_the_loop():
+    @poe_bot_but_better
+    class SlowBot:
+        def get_response(self):
+            time.sleep(0.2)
+            return "done"
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker = asyncio.ensure_future(tick())
+    responses = [r.text async for r in SlowBot().get_response(request)]
+    ticker.cancel()
+    assert responses == ["done"]
+    assert ticks > 5
+
+@pytest.mark.asyncio
+async def test_sync_generator_handler_and_inline_option():
+    loop_thread = threading.get_ident()
+
+    @poe_bot_but_better
+    class ThreadBot:
+        def get_response(self):
+            yield str(threading.get_ident() == loop_thread)
+
+        def get_settings(self):
+            return {"introduction_message": str(threading.get_ident() == loop_thread)}
+
+    @poe_bot_but_better
+    class InlineBot(ThreadBot):
+        run_sync_inline = True
+
+    settings_request = fp.SettingsRequest(version="1", type="settings")
+    assert [r.text async for r in ThreadBot().get_response(request)] == ["False"]
+    assert (await ThreadBot().get_settings(settings_request)).introduction_message == "False"
+    assert [r.text async for r in InlineBot().get_response(request)] == ["True"]
+    assert (await InlineBot().get_settings(settings_request)).introduction_message == "True"
+
+@pytest.mark.asyncio
+async def test_sync_dependencies_stay_on_the_loop_unless_offloaded():
+    loop_thread = threading.get_ident()
+    events = []
+
+    def plain():
+        return threading.get_ident() == loop_thread
+
+    @inline
+    def cheap():
+        return threading.get_ident() == loop_thread
+
+    @offload
+    def blocking():
+        return threading.get_ident() == loop_thread
+
+    @offload
+    def resource():
+        events.append(("enter", threading.get_ident() == loop_thread))
+        yield "resource"
+        events.append(("exit", threading.get_ident() == loop_thread))
+
+    async def handler(
+        plain: Annotated[bool, Depends(plain)],
+        cheap: Annotated[bool, Depends(cheap)],
+        blocking: Annotated[bool, Depends(blocking)],
+        resource: Annotated[str, Depends(resource)],
+    ):
+        pass
+
+    executor = SyncExecutor()
+    async with AsyncExitStack() as stack:
+        params = await solve_dependencies(handler, {}, stack=stack, executor=executor)
+        assert params == {"plain": True, "cheap": True, "blocking": False, "resource": "resource"}
+    assert events == [("enter", False), ("exit", False)]
+
+    # a bot with offload_sync_dependencies runs all but @inline ones in the executor
+    params = await solve_dependencies(handler, {}, stack=AsyncExitStack(), executor=executor, offload_sync=True)
+    assert (params["plain"], params["cheap"], params["blocking"]) == (False, True, False)
+
+    # without an executor everything stays on the loop
+    params = await solve_dependencies(handler, {}, stack=AsyncExitStack())
+    assert params["blocking"] is True
+    executor.shutdown()
\ No newline at end of file
@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from .fanout import Fanout
+
+# bot name -> (delay, response), an exception as response is raised
+BOTS = {
+    "fast": (0.01, "fast"),
+    "medium": (0.05, "medium"),
+    "slow": (1, "slow"),
+    "broken": (0, ValueError("broken")),
+}
+
+def create_fanout():
+    started = []
+    cancelled = []
+
+    async def get_final_response(request, bot_name):
+        started.append(bot_name)
+        delay, response = BOTS[bot_name]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(bot_name)
+            raise
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return Fanout(get_final_response), started, cancelled
+
+def calls(*bot_names):
+    return [("Hello", bot_name) for bot_name in bot_names]
+
+@pytest.mark.asyncio
+async def test_gather_with_deadline_returns_partial_results():
+    fanout, _, cancelled = create_fanout()
+    results = await fanout.gather_with_deadline(calls("slow", "fast", "broken"), deadline=0.1)
+    assert [r.bot_name for r in results] == ["slow", "fast", "broken"]
+    assert isinstance(results[0].error, asyncio.TimeoutError)
+    assert results[1].response == "fast"
+    assert isinstance(results[2].error, ValueError)
+    await asyncio.sleep(0)
+    assert cancelled == ["slow"]
+
+@pytest.mark.asyncio
+async def test_gather_with_per_call_timeout():
+    fanout, _, _ = create_fanout()
+    results = await fanout.gather_with_deadline(calls("slow", "medium"), timeout=0.1)
+    assert isinstance(results[0].error, asyncio.TimeoutError)
+    assert results[1].response == "medium"
+
+@pytest.mark.asyncio
+async def test_race_cancels_losers():
+    fanout, _, cancelled = create_fanout()
+    winner = await fanout.race(calls("slow", "broken", "medium", "fast"))
+    assert winner.bot_name == "fast"
+    await asyncio.sleep(0)
+    assert sorted(cancelled) == ["medium", "slow"]
+
+@pytest.mark.asyncio
+async def test_race_nothing_succeeds():
+    fanout, _, _ = create_fanout()
+    assert await fanout.race(calls("broken", "slow"), deadline=0.05) is None
+
+@pytest.mark.asyncio
+async def test_first_n():
+    fanout, _, _ = create_fanout()
+    results = await fanout.first_n(calls("slow", "medium", "broken", "fast"), 2)
+    assert [r.response for r in results] == ["fast", "medium"]
+
+    results = await fanout.first_n(calls("slow", "medium", "fast"), 3, deadline=0.1)
+    assert [r.response for r in results] == ["fast", "medium"]
+
+@pytest.mark.asyncio
+async def test_hedge_starts_backup_after_delay():
+    fanout, started, _ = create_fanout()
+    winner = await fanout.hedge(calls("slow", "fast", "medium"), delay=0.03)
+    assert winner.bot_name == "fast"
+    assert started == ["slow", "fast"]
+
+@pytest.mark.asyncio
+async def test_hedge_primary_wins():
+    fanout, started, _ = create_fanout()
+    winner = await fanout.hedge(calls("fast", "slow"), delay=0.1)
+    assert winner.bot_name == "fast"
+    assert started == ["fast"]
+
+@pytest.mark.asyncio
+async def test_hedge_starts_backup_right_after_failure():
+    fanout, started, _ = create_fanout()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    winner = await fanout.hedge(calls("broken", "fast"), delay=1)
+    assert winner.bot_name == "fast"
+    assert loop.time() - start < 0.5
\ No newline at end of file
@@ -0,0 +1,48 @@
+import pytest
+import fastapi_poe as fp
+from .client import normalize_request
+from .messages import MessageSequence
+from .test import mock_query_request
+from .types import PoeBotError
+
+history = [fp.ProtocolMessage(role="user" if i % 2 == 0 else "bot", content=str(i)) for i in range(10)]
+system = fp.ProtocolMessage(role="system", content="system")
+
+def contents(messages):
+    return [message.content for message in messages]
+
+def test_views_share_messages():
+    view = MessageSequence(history).prepend(system).append(fp.ProtocolMessage(role="user", content="last"))
+    assert len(view) == 12
+    assert contents(view) == ["system", *map(str, range(10)), "last"]
+    assert view[1] is history[0]
+    assert view[-1].content == "last"
+    # no copy of the history list, only references to it
+    assert any(segment[0] is history for segment in view._segments)
+
+def test_slice_and_truncate():
+    view = [system] + MessageSequence(history)
+    assert contents(view[3:6]) == ["2", "3", "4"]
+    assert contents(view[:2]) == ["system", "0"]
+    assert contents(view[::3]) == ["system", "2", "5", "8"]
+    assert contents(view.truncate(3)) == ["7", "8", "9"]
+    assert contents(view.truncate(100)) == contents(view)
+    assert len(view[5:2]) == 0
+    with pytest.raises(IndexError):
+        view[11]
+
+def test_concatenation():
+    view = [system] + MessageSequence(history[:2]) + [history[5]]
+    assert isinstance(view, MessageSequence)
+    assert contents(view) == ["system", "0", "1", "5"]
+    assert view == [system, history[0], history[1], history[5]]
+    with pytest.raises(PoeBotError):
+        MessageSequence(history).append("not a message")
+
+def test_normalize_request_accepts_views():
+    view = MessageSequence(history).prepend(system)
+    request = normalize_request(mock_query_request, view)
+    assert isinstance(request.query, list)
+    assert request.query[1] is history[0]
+    assert request.conversation_id == mock_query_request.conversation_id
+    assert fp.QueryRequest.model_validate(request.model_dump()).query == request.query
\ No newline at end of file
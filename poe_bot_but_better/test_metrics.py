@@ -0,0 +1,94 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from . import metrics
+from .app import add_metrics_route
+from .decorator import poe_bot_but_better
+from .metrics import HistogramRegistry, MultiSink, SpanSink
+from .client import normalize_request
+from .stub_server import StubPoeServer
+from .test import mock_query_request
+
+request = normalize_request(mock_query_request, "Hello")
+
+@pytest.fixture
+def registry():
+    registry = HistogramRegistry()
+    spans = []
+    metrics.set_sink(MultiSink(registry, SpanSink(spans.append)))
+    registry.spans = spans
+    yield registry
+    metrics.set_sink(None)
+
+def relay_bot(stub: StubPoeServer):
+    @poe_bot_but_better
+    class RelayBot:
+        http_client_pool = stub.pool()
+
+        async def get_response(self, request, get_final_response, stream_request):
+            yield await get_final_response(request, "Upstream")
+            async for message in stream_request(request, "Upstream"):
+                yield message.text
+
+    return RelayBot(bot_name="Relay")
+
+@pytest.mark.asyncio
+async def test_response_and_sub_bot_metrics(registry: HistogramRegistry):
+    stub = StubPoeServer({"Upstream": ["a", "b"]})
+    chunks = [chunk.text async for chunk in relay_bot(stub).get_response(request)]
+    assert chunks == ["ab", "a", "b"]
+
+    bot = (("bot", "Relay"),)
+    for name in ("poe_bot_dependencies_seconds", "poe_bot_first_chunk_seconds", "poe_bot_response_seconds"):
+        assert registry.histogram(name, bot)["count"] == 1
+    assert registry.counter("poe_bot_chunks_total", bot) == 3
+    assert registry.counter("poe_bot_chunk_bytes_total", bot) == 4
+
+    upstream = (("bot", "Upstream"),)
+    assert registry.histogram("poe_sub_bot_seconds", upstream)["count"] == 2
+    assert registry.histogram("poe_sub_bot_first_chunk_seconds", upstream)["count"] == 2
+
+    response_span = next(span for span in registry.spans if span.name == "get_response")
+    sub_bot_spans = [span for span in registry.spans if span.name == "sub_bot_call"]
+    assert len(sub_bot_spans) == 2
+    assert all(span.parent_id == response_span.span_id and span.trace_id == response_span.trace_id for span in sub_bot_spans)
+    assert response_span.attributes["chunks"] == 3 and response_span.duration >= 0
+
+@pytest.mark.asyncio
+async def test_sub_bot_errors_are_counted(registry: HistogramRegistry):
+    def broken(request):
+        raise ValueError("broken")
+
+    stub = StubPoeServer({"Upstream": broken})
+    with pytest.raises(Exception):
+        async for _ in relay_bot(stub).get_response(request):
+            pass
+
+    assert sum(value for (name, _), value in registry._counters.items() if name == "poe_sub_bot_errors_total") == 1
+    assert sum(value for (name, _), value in registry._counters.items() if name == "poe_bot_errors_total") == 1
+    assert next(span for span in registry.spans if span.name == "sub_bot_call").error is not None
+
+@pytest.mark.asyncio
+async def test_disabled_by_default():
+    assert metrics.sink is None
+    stub = StubPoeServer({"Upstream": ["a"]})
+    assert [chunk.text async for chunk in relay_bot(stub).get_response(request)] == ["a", "a"]
+
+def test_prometheus_text():
+    registry = HistogramRegistry(buckets=(0.1, 1))
+    registry.observe("latency_seconds", 0.05, (("bot", 'A"1'),))
+    registry.observe("latency_seconds", 0.5, (("bot", 'A"1'),))
+    registry.increment("calls_total", 2)
+
+    app = add_metrics_route(FastAPI(), registry)
+    text = TestClient(app).get("/metrics").text
+    assert text == "\n".join([
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{bot="A\\"1",le="0.1"} 1',
+        'latency_seconds_bucket{bot="A\\"1",le="1.0"} 2',
+        'latency_seconds_bucket{bot="A\\"1",le="+Inf"} 2',
+        'latency_seconds_sum{bot="A\\"1"} 0.55',
+        'latency_seconds_count{bot="A\\"1"} 2',
+        "# TYPE calls_total counter",
+        "calls_total 2",
+    ]) + "\n"
\ No newline at end of file
@@ -0,0 +1,76 @@
+import asyncio
+import time
+import pytest
+import fastapi_poe as fp
+from .client import create_get_final_response, normalize_request
+from .decorator import poe_bot_but_better
+from .ratelimit import Rate, RateLimited, RateLimits, TokenBucket, UndeclaredDependencyError
+from .stub_server import StubPoeServer
+from .test import mock_query_request
+
+def test_token_bucket_paces_instead_of_failing():
+    bucket = TokenBucket(Rate(per_second=10, burst=2))
+    # the burst is free, later calls are spaced 1 / rate apart
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[:2] == [0.0, 0.0]
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+    bucket.cancel()
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+@pytest.mark.asyncio
+async def test_calls_are_paced_per_process_and_rejected_past_max_wait():
+    stub = StubPoeServer({"Upstream": "ok"})
+    limits = RateLimits(rates={"Upstream": Rate(per_second=20)}, enforce_declared="off", max_wait=0.12)
+
+    start = time.monotonic()
+    calls = [create_get_final_response(mock_query_request, stub.pool(), rate_limiter=limits.for_request(None)) for _ in range(3)]
+    assert await asyncio.gather(*[call("Hi", "Upstream") for call in calls]) == ["ok"] * 3
+    # one call immediately, the next two 50ms apart
+    assert time.monotonic() - start >= 0.09
+
+    # the bucket is shared by every request, a call that would wait longer than max_wait fails right away
+    limits = RateLimits(rates={"Upstream": Rate(per_second=20)}, enforce_declared="off", max_wait=0.12)
+    waiting = [asyncio.ensure_future(limits.for_request(None).acquire("Upstream")) for _ in range(3)]
+    await asyncio.sleep(0)
+    with pytest.raises(RateLimited):
+        await limits.for_request(None).acquire("Upstream")
+    await asyncio.gather(*waiting)
+
+@pytest.mark.asyncio
+async def test_calls_are_checked_against_server_bot_dependencies():
+    limits = RateLimits(enforce_declared="raise")
+    limiter = limits.for_request({"Upstream": 1})
+    await limiter.acquire("Upstream")
+    with pytest.raises(UndeclaredDependencyError):
+        await limiter.acquire("Upstream")
+    with pytest.raises(UndeclaredDependencyError):
+        await limiter.acquire("Other")
+
+    limiter = RateLimits().for_request({})
+    with pytest.warns(RuntimeWarning, match="server_bot_dependencies declares 0"):
+        await limiter.acquire("Other")
+
+@pytest.mark.asyncio
+async def test_bot_uses_declared_dependencies():
+    stub = StubPoeServer({"Upstream": "ok"})
+    settings_calls = []
+
+    @poe_bot_but_better
+    class CallingBot:
+        http_client_pool = stub.pool()
+        rate_limits = RateLimits(enforce_declared="raise")
+
+        async def get_settings(self):
+            settings_calls.append(1)
+            return fp.SettingsResponse(server_bot_dependencies={"Upstream": 1})
+
+        async def get_response(self, get_final_response):
+            return await get_final_response("Hi", "Upstream")
+
+    bot = CallingBot()
+    request = normalize_request(mock_query_request, "Hello")
+    for _ in range(2):
+        assert [r.text async for r in bot.get_response(request)] == ["ok"]
+    # the settings are asked once, the count is per response
+    assert settings_calls == [1]
@@ -0,0 +1,143 @@
+import pytest
+import httpx
+import fastapi_poe as fp
+from .client import create_get_final_response, create_stream_request, normalize_request
+from .retry import CircuitBreakers, CircuitOpenError, RetryBudget, RetryPolicy, is_transient
+from .stub_server import StubPoeServer
+from .test import mock_query_request
+
+request = normalize_request(mock_query_request, "Hello")
+
+def policy(**kwargs):
+    return RetryPolicy(**{"base_delay": 0, "budget": None, "breakers": None, **kwargs})
+
+def flaky(*attempts):
+    # one list of items per attempt, an exception item is raised
+    calls = []
+
+    def open_stream():
+        items = attempts[len(calls)]
+        calls.append(items)
+
+        async def stream():
+            for item in items:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        return stream()
+
+    open_stream.calls = calls
+    return open_stream
+
+async def collect(stream):
+    return [item async for item in stream]
+
+def test_is_transient():
+    response = httpx.Response(503, request=httpx.Request("POST", "http://bot"))
+    assert is_transient(httpx.HTTPStatusError("", request=response.request, response=response))
+    assert is_transient(httpx.ConnectError("down"))
+    assert is_transient(fp.client.BotError("{}"))
+    assert not is_transient(fp.client.BotErrorNoRetry("{}"))
+    response = httpx.Response(404, request=httpx.Request("POST", "http://bot"))
+    assert not is_transient(httpx.HTTPStatusError("", request=response.request, response=response))
+    assert not is_transient(ValueError())
+
+@pytest.mark.asyncio
+async def test_retries_transient_errors_before_the_first_chunk():
+    open_stream = flaky([httpx.ConnectError("down")], ["a", "b"])
+    assert await collect(policy().stream("Bot", open_stream)) == ["a", "b"]
+    assert len(open_stream.calls) == 2
+
+    open_stream = flaky([ValueError("bug")], ["a"])
+    with pytest.raises(ValueError):
+        await collect(policy().stream("Bot", open_stream))
+
+@pytest.mark.asyncio
+async def test_stream_is_not_retried_after_the_first_chunk():
+    open_stream = flaky(["a", httpx.ReadError("reset")], ["a", "b"])
+    with pytest.raises(httpx.ReadError):
+        await collect(policy().stream("Bot", open_stream))
+
+    # unless the caller can drop what it got and the call is idempotent
+    restarts = []
+    open_stream = flaky(["a", httpx.ReadError("reset")], ["a", "b"])
+    items = await collect(policy(idempotent=True).stream("Bot", open_stream, on_restart=lambda: restarts.append(1)))
+    assert items == ["a", "a", "b"] and restarts == [1]
+
+@pytest.mark.asyncio
+async def test_max_attempts_and_budget():
+    open_stream = flaky(*[[httpx.ConnectError("down")]] * 3)
+    with pytest.raises(httpx.ConnectError):
+        await collect(policy(max_attempts=3).stream("Bot", open_stream))
+    assert len(open_stream.calls) == 3
+
+    budget = RetryBudget(ratio=0, min_per_second=0, max_tokens=1)
+    open_stream = flaky([httpx.ConnectError("down")], ["a"], [httpx.ConnectError("down")], ["a"])
+    assert await collect(policy(budget=budget).stream("Bot", open_stream)) == ["a"]
+    # the budget is spent, no more retries
+    with pytest.raises(httpx.ConnectError):
+        await collect(policy(budget=budget).stream("Bot", open_stream))
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_and_recovers():
+    breakers = CircuitBreakers(failure_threshold=2, reset_timeout=0)
+    retry = policy(max_attempts=1, breakers=breakers)
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            await collect(retry.stream("Bot", flaky([httpx.ConnectError("down")])))
+    assert breakers.get("Bot").state == "half-open"
+
+    # one trial call, its success closes the circuit
+    assert await collect(retry.stream("Bot", flaky(["a"]))) == ["a"]
+    assert breakers.get("Bot").state == "closed"
+
+    breakers.get("Other").reset_timeout = 60
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            await collect(retry.stream("Other", flaky([httpx.ConnectError("down")])))
+    with pytest.raises(CircuitOpenError):
+        await collect(retry.stream("Other", flaky(["a"])))
+
+class FlakyTransport(httpx.AsyncBaseTransport):
+    # every other request gets a 503 from a proxy in front of the bot
+    def __init__(self, transport):
+        self.transport = transport
+        self.requests = 0
+
+    async def handle_async_request(self, request):
+        self.requests += 1
+        if self.requests % 2:
+            return httpx.Response(503, text="Service Unavailable")
+        return await self.transport.handle_async_request(request)
+
+@pytest.mark.asyncio
+async def test_bot_calls_retry_transient_errors():
+    stub = StubPoeServer({"Upstream": "ok"})
+    pool = stub.pool()
+    transport = pool.config.transport = FlakyTransport(pool.config.transport)
+
+    get_final_response = create_get_final_response(request, pool, policy())
+    assert await get_final_response("Hi", "Upstream") == "ok"
+    stream_request = create_stream_request(request, pool, policy())
+    assert [message.text async for message in stream_request("Hi", "Upstream")] == ["ok"]
+    assert transport.requests == 4
+    assert len(stub.requests["Upstream"]) == 2
+
+@pytest.mark.asyncio
+async def test_bot_calls_fail_fast_on_client_errors():
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        return httpx.Response(404, json={"detail": "Bot not found"})
+
+    pool = StubPoeServer({}).pool()
+    pool.config.transport = httpx.MockTransport(handle)
+    breakers = CircuitBreakers(failure_threshold=2)
+    get_final_response = create_get_final_response(request, pool, policy(breakers=breakers))
+    for _ in range(3):
+        with pytest.raises(httpx.HTTPStatusError, match="404"):
+            await get_final_response("Hi", "Misnamed")
+    # not retried, the circuit stays closed
+    assert len(requests) == 3
+    assert breakers.get("Misnamed").state == "closed"
\ No newline at end of file
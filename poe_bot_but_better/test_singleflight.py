@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from poe_bot_but_better.singleflight import SingleFlight
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_call():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "image.jpg"
+
+    results = await asyncio.gather(*(single_flight.call("key", fetch) for _ in range(5)))
+    assert results == ["image.jpg"] * 5
+    assert calls == 1
+    assert not single_flight.in_flight("key")
+
+    # not in flight anymore, called again
+    await single_flight.call("key", fetch)
+    assert calls == 2
+
+@pytest.mark.asyncio
+async def test_call_error_is_shared():
+    single_flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream failed")
+
+    results = await asyncio.gather(*(single_flight.call("key", fetch) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+@pytest.mark.asyncio
+async def test_call_survives_one_cancelled_waiter():
+    single_flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    first = asyncio.create_task(single_flight.call("key", fetch))
+    second = asyncio.create_task(single_flight.call("key", fetch))
+    await asyncio.sleep(0.005)
+    first.cancel()
+
+    assert await second == "done"
+
+@pytest.mark.asyncio
+async def test_streams_fan_out_same_chunks():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        for chunk in ["a", "b", "c"]:
+            await asyncio.sleep(0.005)
+            yield chunk
+
+    async def consume(delay):
+        await asyncio.sleep(delay)
+        return [chunk async for chunk in single_flight.stream("key", fetch)]
+
+    # late subscribers replay what was already streamed
+    results = await asyncio.gather(consume(0), consume(0.007), consume(0.012))
+    assert results == [["a", "b", "c"]] * 3
+    assert calls == 1
+
+@pytest.mark.asyncio
+async def test_stream_cancelled_when_all_subscribers_leave():
+    single_flight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def fetch():
+        yield "a"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield "b"
+
+    stream = single_flight.stream("key", fetch)
+    assert await stream.__anext__() == "a"
+    await stream.aclose()
+
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert not single_flight.in_flight("key")
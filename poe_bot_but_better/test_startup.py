@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import pytest
+import fastapi_poe as fp
+from .decorator import poe_bot_but_better
+from .startup import StartupReport, awarmup, startup_report
+
+def test_package_import_is_lazy():
+    code = "import sys, poe_bot_but_better; assert 'fastapi_poe' not in sys.modules; poe_bot_but_better.make_app; assert 'fastapi_poe' in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+def test_report_renders_phases():
+    report = StartupReport()
+    report.record("import a", 0.25)
+    with report.phase("warmup"):
+        pass
+    assert [name for name, _ in report.phases] == ["import a", "warmup"]
+    assert report.render().splitlines()[0].startswith("import a")
+    assert report.render().splitlines()[-1].startswith("total")
+
+@pytest.mark.asyncio
+async def test_warmup_computes_settings_up_front():
+    calls = []
+
+    @poe_bot_but_better
+    class WarmBot:
+        async def get_response(self):
+            return "ok"
+
+        def get_settings(self):
+            calls.append(1)
+            return {"introduction_message": "Hi"}
+
+    bot = WarmBot()
+    await awarmup(bot)
+    assert calls == [1]
+    assert b"Hi" in bot._settings_body
+    assert (await bot.get_settings(fp.SettingsRequest(version="1", type="settings"))).introduction_message == "Hi"
+    assert calls == [1]
+    names = [name for name, _ in startup_report.phases]
+    assert "decorate WarmBot" in names and "warmup WarmBot settings" in names
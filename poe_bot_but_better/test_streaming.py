@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+import fastapi_poe as fp
+from poe_bot_but_better import poe_bot_but_better
+from .streaming import StreamCoalescing, coalesce_responses
+from .test import BotTestHelper
+
+async def collect(items, coalescing=StreamCoalescing()):
+    return [response async for response in coalesce_responses(items, coalescing)]
+
+async def stream(*items, delay=0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+@pytest.mark.asyncio
+async def test_merges_small_chunks_by_size():
+    responses = await collect(stream(*["a"] * 10), StreamCoalescing(max_size=4, max_delay=10))
+    assert [r.text for r in responses] == ["aaaa", "aaaa", "aa"]
+
+@pytest.mark.asyncio
+async def test_special_chunks_are_kept_separate_and_in_order():
+    items = stream(
+        "a", fp.PartialResponse(text="b"),
+        fp.PartialResponse(text="R", is_replace_response=True),
+        "c",
+        fp.PartialResponse(text="S", is_suggested_reply=True),
+        fp.ErrorResponse(text="E"),
+        "d",
+    )
+    responses = await collect(items)
+    assert [(type(r).__name__, r.text, r.is_replace_response, r.is_suggested_reply) for r in responses] == [
+        ("PartialResponse", "ab", False, False),
+        ("PartialResponse", "R", True, False),
+        ("PartialResponse", "c", False, False),
+        ("PartialResponse", "S", False, True),
+        ("ErrorResponse", "E", False, False),
+        ("PartialResponse", "d", False, False),
+    ]
+
+@pytest.mark.asyncio
+async def test_flushes_after_time_window():
+    # text isn't merged with a chunk that comes after the window
+    responses = await collect(stream("a", "b", "c", delay=0.02), StreamCoalescing(max_delay=0.01))
+    assert [r.text for r in responses] == ["a", "b", "c"]
+
+    # and isn't held while the handler waits
+    async def pause():
+        yield "a"
+        await asyncio.sleep(0.5)
+        yield "b"
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    responses = coalesce_responses(pause(), StreamCoalescing())
+    assert (await responses.__anext__()).text == "a"
+    assert loop.time() - start < 0.1
+    assert (await responses.__anext__()).text == "b"
+
+@pytest.mark.asyncio
+async def test_handler_runs_in_one_task_and_waits_for_the_client():
+    tasks = set()
+    produced = []
+
+    async def source():
+        for i in range(5):
+            tasks.add(asyncio.current_task())
+            await asyncio.sleep(0.001)
+            produced.append(i)
+            yield "a"
+
+    responses = coalesce_responses(source(), StreamCoalescing(max_size=1))
+    assert (await responses.__anext__()).text == "a"
+    await asyncio.sleep(0.05)
+    # one item handed over and one waiting to be, not the whole stream
+    assert len(produced) <= 3
+    assert "".join([r.text async for r in responses]) == "aaaa"
+    assert len(tasks) == 1
+
+@pytest.mark.asyncio
+async def test_closing_closes_source():
+    closed = []
+
+    async def source():
+        try:
+            while True:
+                yield "a"
+                await asyncio.sleep(0.001)
+        finally:
+            closed.append(True)
+
+    responses = coalesce_responses(source(), StreamCoalescing(max_size=2))
+    assert (await responses.__anext__()).text == "aa"
+    await responses.aclose()
+    assert closed == [True]
+
+@pytest.mark.asyncio
+async def test_bot_response_is_coalesced():
+    @poe_bot_but_better
+    class TokenBot:
+        stream_coalescing = StreamCoalescing()
+
+        async def get_response(self):
+            for _ in range(1000):
+                yield "x"
+            yield fp.PartialResponse(text="more?", is_suggested_reply=True)
+
+    bot = TokenBot(bot_name="TokenBot")
+    bot.dependency_injection_context_override = {}
+    request = fp.QueryRequest(
+        query=[], version="1.0", type="query", user_id="u", conversation_id="c", message_id="m", access_key="k"
+    )
+    chunks = [chunk async for chunk in bot.get_response(request)]
+    assert "".join(c.text for c in chunks if not c.is_suggested_reply) == "x" * 1000
+    assert len(chunks) < 10
+    assert chunks[-1].is_suggested_reply
+
+    response = await BotTestHelper().send_message(TokenBot, "Hello")
+    assert response == "x" * 1000
+    assert response.suggested_replies == ["more?"]
+
+@pytest.mark.asyncio
+async def test_coalescing_is_opt_in():
+    @poe_bot_but_better
+    class TokenBot:
+        def get_response(self):
+            yield "a"
+            yield "b"
+
+    bot = TokenBot(bot_name="TokenBot")
+    request = fp.QueryRequest(
+        query=[], version="1.0", type="query", user_id="u", conversation_id="c", message_id="m", access_key="k"
+    )
+    assert [chunk.text async for chunk in bot.get_response(request)] == ["a", "b"]
\ No newline at end of file
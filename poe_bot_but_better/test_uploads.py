@@ -0,0 +1,145 @@
+import asyncio
+import pytest
+import httpx
+import fastapi_poe as fp
+from email.parser import BytesParser
+from email.policy import HTTP
+from .client import HttpClientConfig, HttpClientPool, create_post_message_attachment, normalize_request
+from .test import mock_query_request
+from .uploads import AttachmentQueue, UploadCache, upload_attachment
+
+class UploadServer:
+    def __init__(self, fail_download_urls=False):
+        self.uploads = []
+        self.fail_download_urls = fail_download_urls
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        content_type = request.headers["Content-Type"]
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            file = fields["file"]
+            self.uploads.append((file.get_filename(), file.get_payload(decode=True), fields["message_id"].get_content()))
+            url = f"https://files.test/{len(self.uploads)}/{file.get_filename()}"
+        else:
+            form = dict(httpx.QueryParams(body.decode()))
+            if self.fail_download_urls:
+                return httpx.Response(400, text="expired")
+            url = form["download_url"]
+        return httpx.Response(200, json={"attachment_url": url, "inline_ref": None})
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+async def upload(server, cache=None, **kwargs):
+    async with server.client() as client:
+        return await upload_attachment(client, access_key="key", message_id="m1", cache=cache, chunk_size=4, **kwargs)
+
+@pytest.mark.asyncio
+async def test_upload_sources(tmp_path):
+    server = UploadServer()
+    path = tmp_path / "tiger.mp4"
+    path.write_bytes(b"0123456789")
+
+    async def chunks():
+        yield b"01234"
+        yield b"56789"
+
+    await upload(server, file_data=str(path))
+    await upload(server, file_data=memoryview(b"0123456789"), filename="view.mp4")
+    await upload(server, file_data=chunks(), filename="stream.mp4")
+    with open(path, "rb") as f:
+        await upload(server, file_data=f, filename="file.mp4")
+
+    assert server.uploads == [
+        ("tiger.mp4", b"0123456789", "m1"),
+        ("view.mp4", b"0123456789", "m1"),
+        ("stream.mp4", b"0123456789", "m1"),
+        ("file.mp4", b"0123456789", "m1"),
+    ]
+
+@pytest.mark.asyncio
+async def test_upload_cache_reuses_url(tmp_path):
+    server = UploadServer()
+    cache = UploadCache()
+    path = tmp_path / "tiger.mp4"
+    path.write_bytes(b"0123456789")
+
+    first = await upload(server, cache, file_data=path)
+    second = await upload(server, cache, file_data=path)
+    assert second.attachment_url == first.attachment_url
+    assert len(server.uploads) == 1
+
+    # the same content from memory
+    await upload(server, cache, file_data=b"0123456789", filename="tiger.mp4")
+    assert len(server.uploads) == 1
+
+    # streams are hashed while they are sent, uploaded but remembered for the next time
+    async def chunks():
+        yield b"abc"
+
+    await upload(server, cache, file_data=chunks(), filename="tiger.mp4")
+    await upload(server, cache, file_data=b"abc", filename="tiger.mp4")
+    assert len(server.uploads) == 2
+
+@pytest.mark.asyncio
+async def test_upload_cache_uploads_again_when_url_fails():
+    cache = UploadCache()
+    await upload(UploadServer(), cache, file_data=b"data", filename="a.txt")
+    server = UploadServer(fail_download_urls=True)
+    await upload(server, cache, file_data=b"data", filename="a.txt")
+    assert len(server.uploads) == 1
+
+@pytest.mark.asyncio
+async def test_post_message_attachment_waits_with_the_bot():
+    server = UploadServer()
+    bot = fp.PoeBot(access_key="key")
+    request = normalize_request(mock_query_request, "Hello")
+    pool = HttpClientPool(HttpClientConfig(transport=httpx.MockTransport(server.handle)))
+    post_message_attachment = create_post_message_attachment(bot, request, pool, cache=None)
+
+    response = await post_message_attachment(file_data=b"data", filename="a.txt")
+    assert response.attachment_url == "https://files.test/1/a.txt"
+    assert server.uploads == [("a.txt", b"data", request.message_id)]
+    assert not bot._pending_file_attachment_tasks[request.message_id]
+
+@pytest.mark.asyncio
+async def test_attachment_queue_cancels_uploads_on_close():
+    started = asyncio.Event()
+
+    async def post_message_attachment(**kwargs):
+        started.set()
+        await asyncio.sleep(10)
+
+    queue = AttachmentQueue(post_message_attachment)
+    task = queue(download_url="https://files.test/a.png")
+    await started.wait()
+    await queue.aclose()
+    assert task.cancelled()
+    assert await queue.join() == []
+
+@pytest.mark.asyncio
+async def test_attachment_queue_posts_in_queued_order():
+    server = UploadServer()
+    bot = fp.PoeBot(access_key="key")
+    request = normalize_request(mock_query_request, "Hello")
+    pool = HttpClientPool(HttpClientConfig(transport=httpx.MockTransport(server.handle)))
+    queue = AttachmentQueue(create_post_message_attachment(bot, request, pool, cache=None))
+    sent = []
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        yield b"slow"
+        sent.append("a.txt")
+
+    async def fast():
+        yield b"fast"
+        sent.append("b.txt")
+
+    queue(file_data=slow(), filename="a.txt")
+    queue(file_data=fast(), filename="b.txt")
+    assert await queue.join() == []
+    # b.txt is sent first, but posted after a.txt
+    assert sent == ["b.txt", "a.txt"]
+    assert [name for name, _, _ in server.uploads] == ["a.txt", "b.txt"]
\ No newline at end of file
@@ -0,0 +1,277 @@
+from collections import OrderedDict
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import hashlib
+import mimetypes
+import os
+import secrets
+import fastapi_poe as fp
+import httpx
+from fastapi_poe.base import AttachmentUploadError
+from .types import PoeBotError
+
+UPLOAD_URL = "https://www.quora.com/poe_api/file_attachment_3RD_PARTY_POST"
+
+# bytes-like, a binary file object, a path or an async iterator of bytes
+FileData = Union[bytes, bytearray, memoryview, BinaryIO, str, "os.PathLike[str]", AsyncIterable[bytes]]
+
+class UploadCache:
+    """
+    Attachment URLs of uploaded files by content hash and filename. A file uploaded before is attached
+    again by its URL, e.g. a static asset sent with every response is uploaded once.
+    """
+    def __init__(self, max_entries: int = 1024) -> None:
+        self.max_entries = max_entries
+        self._urls: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        # (path, size, mtime) -> sha256, files aren't hashed again unless they change
+        self._file_hashes: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+
+    def get(self, sha256: str, filename: str) -> Optional[str]:
+        url = self._urls.get((sha256, filename))
+        if url is not None:
+            self._urls.move_to_end((sha256, filename))
+        return url
+
+    def set(self, sha256: str, filename: str, url: str) -> None:
+        self._urls[(sha256, filename)] = url
+        self._urls.move_to_end((sha256, filename))
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+
+    def discard(self, sha256: str, filename: str) -> None:
+        self._urls.pop((sha256, filename), None)
+
+    async def file_hash(self, path: str, chunk_size: int) -> str:
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        sha256 = self._file_hashes.get(key)
+        if sha256 is None:
+            sha256 = await asyncio.to_thread(_hash_file, path, chunk_size)
+            self._file_hashes[key] = sha256
+            while len(self._file_hashes) > self.max_entries:
+                self._file_hashes.popitem(last=False)
+        return sha256
+
+    def clear(self) -> None:
+        self._urls.clear()
+        self._file_hashes.clear()
+
+# Process-wide, shared by all bots
+upload_cache = UploadCache()
+
+def _hash_file(path: str, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class _Source:
+    # One file to upload: its length if known up front, its sha256 once known and the chunks
+    def __init__(self, file_data: FileData, chunk_size: int) -> None:
+        self.file_data = file_data
+        self.chunk_size = chunk_size
+        self.length: Optional[int] = None
+        self.sha256: Optional[str] = None
+        self.path: Optional[str] = None
+        if isinstance(file_data, (str, os.PathLike)):
+            self.path = os.fspath(file_data)
+            self.length = os.path.getsize(self.path)
+        elif isinstance(file_data, (bytes, bytearray, memoryview)):
+            self.file_data = memoryview(file_data).cast("B")
+            self.length = self.file_data.nbytes
+
+    async def resolve_hash(self, cache: UploadCache) -> Optional[str]:
+        # the hash before the upload, streams are only hashed while they are sent
+        if self.path is not None:
+            self.sha256 = await cache.file_hash(self.path, self.chunk_size)
+        elif isinstance(self.file_data, memoryview):
+            self.sha256 = hashlib.sha256(self.file_data).hexdigest()
+        return self.sha256
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        digest = hashlib.sha256() if self.sha256 is None else None
+        async for chunk in self._read():
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+        if digest is not None:
+            self.sha256 = digest.hexdigest()
+
+    async def _read(self) -> AsyncIterator[bytes]:
+        data, chunk_size = self.file_data, self.chunk_size
+        if self.path is not None:
+            with open(self.path, "rb") as f:
+                while chunk := await asyncio.to_thread(f.read, chunk_size):
+                    yield chunk
+        elif isinstance(data, memoryview):
+            # one chunk sized copy at a time, never the whole buffer
+            for start in range(0, len(data), chunk_size):
+                yield bytes(data[start:start + chunk_size])
+        elif hasattr(data, "__aiter__"):
+            async for chunk in data:
+                yield bytes(chunk)
+        elif hasattr(data, "read"):
+            while chunk := await asyncio.to_thread(data.read, chunk_size):
+                yield chunk
+        else:
+            raise PoeBotError(f"Unsupported file_data {type(data).__name__}, use bytes, a memoryview, a file, a path or an async iterator of bytes")
+
+def _form_field(boundary: str, name: str, value: Any) -> bytes:
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    return f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+
+def _escape_filename(filename: str) -> str:
+    return filename.replace("\\", "\\\\").replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+async def _wait_for(after: Optional[Awaitable[Any]]) -> None:
+    # until `after` is done, its result or error is left to its owner
+    if after is not None:
+        await asyncio.wait([asyncio.ensure_future(after)])
+
+class _MultipartBody(httpx.AsyncByteStream):
+    # Streamed multipart/form-data body, the file is sent in chunks as it is read
+    def __init__(self, fields: Dict[str, Any], source: _Source, filename: str, content_type: str, after: Optional[Awaitable[Any]] = None) -> None:
+        self.boundary = secrets.token_hex(16)
+        self.source = source
+        self.after = after
+        self.head = b"".join(_form_field(self.boundary, name, value) for name, value in fields.items()) + (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; filename="{_escape_filename(filename)}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+        if self.source.length is not None:
+            headers["Content-Length"] = str(len(self.head) + self.source.length + len(self.tail))
+        else:
+            headers["Transfer-Encoding"] = "chunked"
+        return headers
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.head
+        async for chunk in self.source.chunks():
+            yield chunk
+        # the server posts the attachment once the body is complete
+        await _wait_for(self.after)
+        yield self.tail
+
+async def _send(client: httpx.AsyncClient, request: httpx.Request) -> fp.types.AttachmentUploadResponse:
+    response = await client.send(request)
+    try:
+        if response.status_code != 200:
+            body = (await response.aread()).decode(errors="replace")
+            raise AttachmentUploadError(f"{response.status_code} {response.reason_phrase}: {body}")
+        await response.aread()
+        data = response.json()
+    finally:
+        await response.aclose()
+    return fp.types.AttachmentUploadResponse(inline_ref=data.get("inline_ref"), attachment_url=data.get("attachment_url"))
+
+async def upload_attachment(
+    client: httpx.AsyncClient,
+    *,
+    access_key: str,
+    message_id: str,
+    download_url: Optional[str] = None,
+    file_data: Optional[FileData] = None,
+    filename: Optional[str] = None,
+    content_type: Optional[str] = None,
+    is_inline: bool = False,
+    cache: Optional[UploadCache] = None,
+    chunk_size: int = 256 * 1024,
+    after: Optional[Awaitable[Any]] = None,
+) -> fp.types.AttachmentUploadResponse:
+    """
+    Same as fp.PoeBot.post_message_attachment, but the file is streamed in chunks instead of being held
+    in memory and, with a cache, a file uploaded before is attached by the URL of the earlier upload.
+    With `after` (e.g. the previous upload), the file is sent right away but the upload is only completed
+    once `after` is done, the attachment is posted after it.
+    """
+    headers = {"Authorization": access_key}
+    fields = {"message_id": message_id, "is_inline": is_inline}
+    if download_url:
+        if file_data is not None or filename:
+            raise PoeBotError("Cannot provide filename or file_data if download_url is provided.")
+        request = httpx.Request("POST", UPLOAD_URL, data={**fields, "download_url": download_url}, headers=headers)
+        await _wait_for(after)
+        return await _send(client, request)
+
+    if file_data is None:
+        raise PoeBotError("Must provide either download_url or file_data.")
+    if filename is None:
+        if not isinstance(file_data, (str, os.PathLike)):
+            raise PoeBotError("filename is required unless file_data is a path.")
+        filename = os.path.basename(os.fspath(file_data))
+
+    source = _Source(file_data, chunk_size)
+    if cache is not None and await source.resolve_hash(cache):
+        url = cache.get(source.sha256, filename)
+        if url is not None:
+            request = httpx.Request("POST", UPLOAD_URL, data={**fields, "download_url": url}, headers=headers)
+            await _wait_for(after)
+            try:
+                return await _send(client, request)
+            except AttachmentUploadError:
+                # e.g. the earlier upload expired, uploaded again
+                cache.discard(source.sha256, filename)
+
+    body = _MultipartBody(
+        fields, source, filename, content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream", after
+    )
+    response = await _send(client, httpx.Request("POST", UPLOAD_URL, headers={**headers, **body.headers}, stream=body))
+    if cache is not None and source.sha256 and response.attachment_url:
+        cache.set(source.sha256, filename, response.attachment_url)
+    return response
+
+class AttachmentQueue:
+    """
+    Posts attachments in the background while the response keeps streaming, at most max_concurrency at a time.
+    Calling the queue returns the upload task right away (await it for the inline_ref). The response waits for
+    every queued upload before it finishes and reports the failed ones.
+    Files are sent concurrently but each upload is completed after the one queued before it, Poe lists the
+    attachments in the queued order.
+    """
+    def __init__(self, post_message_attachment: Callable[..., Awaitable[fp.types.AttachmentUploadResponse]], max_concurrency: int = 4) -> None:
+        self._post = post_message_attachment
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # (name shown in errors, task) in the queued order
+        self._tasks: List[Tuple[str, "asyncio.Task[fp.types.AttachmentUploadResponse]"]] = []
+
+    def __call__(self, **kwargs: Any) -> "asyncio.Task[fp.types.AttachmentUploadResponse]":
+        # same arguments as post_message_attachment
+        file_data = kwargs.get("file_data")
+        name = kwargs.get("filename") or kwargs.get("download_url") or (
+            os.path.basename(os.fspath(file_data)) if isinstance(file_data, (str, os.PathLike)) else "attachment"
+        )
+        previous = self._tasks[-1][1] if self._tasks else None
+        task = asyncio.ensure_future(self._post_limited(kwargs, previous))
+        self._tasks.append((name, task))
+        return task
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def _post_limited(self, kwargs: Dict[str, Any], previous: Optional["asyncio.Task[Any]"]) -> fp.types.AttachmentUploadResponse:
+        # the semaphore is taken in the queued order, the previous upload always holds it or is done
+        async with self._semaphore:
+            return await self._post(**kwargs, after=previous)
+
+    async def join(self) -> List[Tuple[str, BaseException]]:
+        # waits for every queued upload, returns the failures in the queued order
+        if self._tasks:
+            await asyncio.wait([task for _, task in self._tasks])
+        return [
+            (name, task.exception()) for name, task in self._tasks
+            if not task.cancelled() and task.exception() is not None
+        ]
+
+    async def aclose(self) -> None:
+        # the response failed or was closed, uploads still running are cancelled
+        pending = [task for _, task in self._tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
\ No newline at end of file
@@ -12,14 +12,15 @@ SYSTEM_PROMPT = """
 All your replies are Haikus.
 """.strip()
 
-from poe_bot_but_better import poe_bot_but_better, StreamRequestCallable
+from poe_bot_but_better import poe_bot_but_better, StreamRequestCallable, MessageSequence
 
 @poe_bot_but_better
 class PromptBot:
     async def get_response(
         self, messages: list[fp.ProtocolMessage], stream_request: StreamRequestCallable
     ) -> AsyncIterable[fp.PartialResponse]:
-        messages = [fp.ProtocolMessage(role="system", content=SYSTEM_PROMPT)] + messages
+        # a view, the history isn't copied
+        messages = MessageSequence(messages).prepend(fp.ProtocolMessage(role="system", content=SYSTEM_PROMPT))
         async for msg in stream_request(messages, "Claude-3-Haiku"):
             yield msg
 
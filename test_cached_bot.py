@@ -1,13 +1,16 @@
+import asyncio
 from unittest.mock import AsyncMock
 import pytest
 from cached_bot import CachedBot, create_cached_get_final_response
+from poe_bot_but_better.cache import ResponseCache
+from poe_bot_but_better.test import mock_query_request
 
 @pytest.mark.asyncio
 async def test_get_final_response_cached():
-    cache = {}
+    cache = ResponseCache()
     get_final_response = AsyncMock(side_effect=lambda prompt, bot_name: f"{prompt}-{bot_name}")
     
-    get_final_response_cached = create_cached_get_final_response(get_final_response, cache)
+    get_final_response_cached = create_cached_get_final_response(mock_query_request, get_final_response, cache)
 
     # miss
     response = await get_final_response_cached("Hello", "GPT-4")
@@ -43,4 +46,12 @@ async def test_cached_bot_simple(bot_helper):
     response = await bot_helper.send_message(CachedBot, "Hello")
     assert response == "image.jpg"
     assert mock.call_count == 1
-    
\ No newline at end of file
+    
+
+@pytest.mark.asyncio
+async def test_cached_bot_concurrent_requests(bot_helper):
+    mock = bot_helper.mock_bot("FLUX-pro-1.1", "image.jpg")
+    responses = await asyncio.gather(*(bot_helper.send_message(CachedBot, "Concurrent") for _ in range(5)))
+
+    assert responses == ["image.jpg"] * 5
+    assert mock.call_count == 1
@@ -13,10 +13,8 @@ class VideoBot:
     async def get_response(
         self, request: fp.QueryRequest, post_message_attachment
     ):
-        with open("/root/assets/tiger.mp4", "rb") as file:
-            file_data = file.read()
-
-        await post_message_attachment(file_data=file_data, filename="tiger.mp4")
+        # streamed from disk, uploaded once and attached by its url afterwards
+        await post_message_attachment(file_data="/root/assets/tiger.mp4")
         
         return "Attached a video."
 
@@ -12,20 +12,22 @@ from typing import AsyncIterable
 import fastapi_poe as fp
 from modal import App, Image, asgi_app
 from openai import AsyncOpenAI
+from poe_bot_but_better.context_window import ContextWindow
 
 client = AsyncOpenAI()
+# this is a demo bot, the conversation is cut to a small token budget
+context_window = ContextWindow(budgets={"gpt-4o-mini": 250})
 
 
 async def stream_chat_completion(request: fp.QueryRequest):
     messages = []
-    # this is a demo bot, the messages and message length will be truncated
-    for query in request.query[-5:]:
+    for query in context_window.fit(request.query, "gpt-4o-mini"):
         if query.role == "system":
-            messages.append({"role": "system", "content": query.content[:50]})
+            messages.append({"role": "system", "content": query.content})
         elif query.role == "bot":
-            messages.append({"role": "assistant", "content": query.content[:50]})
+            messages.append({"role": "assistant", "content": query.content})
         elif query.role == "user":
-            messages.append({"role": "user", "content": query.content[:50]})
+            messages.append({"role": "user", "content": query.content})
         else:
             raise
 